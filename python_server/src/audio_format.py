@@ -0,0 +1,128 @@
+import dataclasses
+from collections.abc import AsyncIterator
+from enum import Enum
+
+import numpy as np
+
+from src.azure_speech_synthesizer import WAV_HEADER_SIZE, WavBuffer, wav_header
+
+# ElevenLabs・Azure のどちらも PCM を直接出力できるサンプリングレート
+SUPPORTED_SAMPLE_RATES = (16000, 22050, 24000, 44100)
+
+# Accept ヘッダーで指定できるメディアタイプ(どれも WAV で返す)
+WAV_MEDIA_TYPES = ("audio/wav", "audio/wave", "audio/x-wav", "audio/*", "*/*")
+
+# μ-law の変換に使う定数(G.711、14bit に丸めた値に対するもの)
+_MULAW_BIAS = 0x21
+_MULAW_CLIP = 8159
+
+
+class AudioEncoding(str, Enum):
+    """音声の符号化方式"""
+
+    # 16bit のリニア PCM
+    pcm = "pcm"
+    # 8bit の μ-law(G.711)。PCM の半分のサイズになる
+    mulaw = "mulaw"
+
+
+@dataclasses.dataclass(frozen=True)
+class AudioFormat:
+    """音声のエンドポイントが返す音声のフォーマット(WAV, mono)"""
+
+    encoding: AudioEncoding = AudioEncoding.pcm
+    sample_rate: int = 44100
+
+    @classmethod
+    def parse(cls, value: str) -> "AudioFormat":
+        """pcm_24000 や mulaw_22050 のような文字列から作る
+
+        Raises:
+            ValueError: 対応していないフォーマットの場合
+        """
+        encoding, _, sample_rate = value.partition("_")
+        try:
+            audio_format = cls(encoding=AudioEncoding(encoding), sample_rate=int(sample_rate))
+        except ValueError:
+            raise ValueError(f"Unsupported audio format: {value}") from None
+        if audio_format.sample_rate not in SUPPORTED_SAMPLE_RATES:
+            raise ValueError(f"Unsupported sample rate: {audio_format.sample_rate} (supported: {SUPPORTED_SAMPLE_RATES})")
+        return audio_format
+
+    @classmethod
+    def negotiate(cls, accept: str) -> "AudioFormat | None":
+        """Accept ヘッダーから返すフォーマットを選ぶ(返せるフォーマットがない場合は None)
+
+        audio/wav; codec=mulaw; rate=24000 のように、パラメータ codec(pcm, mulaw)と rate でフォーマットを指定する。
+        省略したパラメータは pcm_44100 と同じ。q の大きい順(同じ場合は先に書いた順)に、返せるものを選ぶ
+        """
+        default = cls()
+        if not accept.strip():
+            return default
+        candidates: list[tuple[float, int, AudioFormat]] = []
+        for index, media_range in enumerate(accept.split(",")):
+            media_type, *params = (part.strip() for part in media_range.split(";"))
+            if media_type.lower() not in WAV_MEDIA_TYPES:
+                continue
+            options = {key.strip().lower(): value.strip().strip('"') for key, _, value in (param.partition("=") for param in params)}
+            try:
+                quality = float(options.pop("q", "1"))
+                audio_format = cls.parse(f"{options.get('codec', default.encoding.value)}_{options.get('rate', default.sample_rate)}")
+            except ValueError:
+                continue
+            if quality > 0:
+                candidates.append((-quality, index, audio_format))
+        return min(candidates)[2] if candidates else None
+
+    def to_wav(self, wav: bytes | memoryview) -> bytes | memoryview:
+        """PCM の WAV をこのフォーマットの WAV にする(PCM の場合はコピーせずにそのまま返す)"""
+        if self.encoding == AudioEncoding.pcm:
+            return wav
+        wav_buffer = self._wav_buffer()
+        wav_buffer.append(self.encode(memoryview(wav)[WAV_HEADER_SIZE:]))
+        return wav_buffer.wav()
+
+    def streaming_wav_header(self) -> bytes:
+        """ストリーミング用の WAV ヘッダー(長さの欄には最大値を入れる)"""
+        return self._wav_header(0xFFFFFFFF - 36)
+
+    def encode(self, pcm: bytes | memoryview) -> bytes:
+        """16bit の PCM をこのフォーマットに符号化する"""
+        if self.encoding == AudioEncoding.pcm:
+            return pcm
+        return pcm_to_mulaw(pcm)
+
+    async def encode_stream(self, pcm_chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+        """PCM のチャンクを順に符号化する(チャンクの境界がサンプルの途中でもよい)"""
+        remainder = b""
+        async for chunk in pcm_chunks:
+            if self.encoding == AudioEncoding.pcm:
+                yield chunk
+                continue
+            pcm = remainder + chunk
+            usable_size = len(pcm) - len(pcm) % 2
+            remainder = pcm[usable_size:]
+            if usable_size:
+                yield self.encode(pcm[:usable_size])
+
+    def _wav_header(self, data_size: int) -> bytes:
+        if self.encoding == AudioEncoding.mulaw:
+            return wav_header(data_size, sample_rate=self.sample_rate, format_tag=7, sample_width=1)
+        return wav_header(data_size, sample_rate=self.sample_rate)
+
+    def _wav_buffer(self) -> WavBuffer:
+        if self.encoding == AudioEncoding.mulaw:
+            return WavBuffer(sample_rate=self.sample_rate, format_tag=7, sample_width=1)
+        return WavBuffer(sample_rate=self.sample_rate)
+
+
+def pcm_to_mulaw(pcm: bytes | memoryview) -> bytes:
+    """16bit の PCM を μ-law に変換する(G.711 のリファレンス実装と同じ結果になる)"""
+    samples = np.frombuffer(pcm, dtype="<i2").astype(np.int32) >> 2
+    sign = np.where(samples < 0, 0x7F, 0xFF)
+    magnitude = np.minimum(np.abs(samples), _MULAW_CLIP) + _MULAW_BIAS
+    segment = np.floor(np.log2(magnitude)).astype(np.int32) - 5
+    mantissa = (magnitude >> (segment + 1)) & 0x0F
+    # 範囲外(最大の区間を超える値)は最大値にする
+    code = np.where(segment > 7, 0x7F, segment << 4 | mantissa)
+    return (code ^ sign).astype(np.uint8).tobytes()
@@ -1,17 +1,32 @@
+import collections
+import contextlib
+import logging
 import struct
+import threading
+from collections.abc import Callable, Iterator
 
 import azure.cognitiveservices.speech as speechsdk
 
 from src.config import settings
 
+LOGGER = logging.getLogger(__name__)
+
+# サンプリングレートごとの出力フォーマット(16bit, mono の PCM)
+_OUTPUT_FORMATS = {
+    16000: speechsdk.SpeechSynthesisOutputFormat.Raw16Khz16BitMonoPcm,
+    22050: speechsdk.SpeechSynthesisOutputFormat.Raw22050Hz16BitMonoPcm,
+    24000: speechsdk.SpeechSynthesisOutputFormat.Raw24Khz16BitMonoPcm,
+    44100: speechsdk.SpeechSynthesisOutputFormat.Raw44100Hz16BitMonoPcm,
+}
+
 
 class AzureSpeechSynthesizer:
     """Azureの音声合成をストリームに保存するためのクラス"""
 
-    def __init__(self, voice_name="ja-JP-KeitaNeural", pitch: str = "+10%", rate: str = "-5%") -> None:
+    def __init__(self, voice_name="ja-JP-KeitaNeural", pitch: str = "+10%", rate: str = "-5%", sample_rate: int = 44100) -> None:
         self.speech_config = speechsdk.SpeechConfig(subscription=settings.AZURE_SPEECH_KEY, region="japaneast")
         self.speech_config.speech_synthesis_voice_name = voice_name
-        self.speech_config.set_speech_synthesis_output_format(speechsdk.SpeechSynthesisOutputFormat.Raw44100Hz16BitMonoPcm)
+        self.speech_config.set_speech_synthesis_output_format(_OUTPUT_FORMATS[sample_rate])
         self.voice_name = voice_name
         self.speech_synthesizer = speechsdk.SpeechSynthesizer(speech_config=self.speech_config, audio_config=None)
         self.pitch = pitch
@@ -25,18 +40,8 @@ class AzureSpeechSynthesizer:
         result = self.speech_synthesizer.speak_ssml_async(ssml_text).get()
 
         if result.reason == speechsdk.ResultReason.SynthesizingAudioCompleted:
-            audio_data_stream = speechsdk.AudioDataStream(result)
-            audio_data_stream.position = 0
-
-            audio_chunks = []
-            while True:
-                audio_buffer = bytes(4096)  # Create a byte buffer of size 4096
-                filled_size = audio_data_stream.read_data(audio_buffer)
-                if filled_size == 0:
-                    break
-                audio_chunks.append(audio_buffer[:filled_size])
-
-            audio_data = b"".join(audio_chunks)
+            # 結果には合成した音声全体が1つのバッファとして入っているので、AudioDataStream で小分けにコピーせずにそのまま使う
+            audio_data = result.audio_data
 
             if self._is_valid_audio(audio_data):
                 return audio_data
@@ -51,6 +56,35 @@ class AzureSpeechSynthesizer:
                 print(f"Error details: {cancellation_details.error_details}")
             return None
 
+    def speech_synthesis_chunks(self, text: str, *, chunk_size: int = 4096) -> Iterator[bytes]:
+        """音声合成しながら、合成できた PCM を順に返す(合成の完了を待たない)
+
+        次のデータが届くまでスレッドをブロックする
+
+        Raises:
+            RuntimeError: 合成がキャンセルされた場合や、音声が空だった場合
+        """
+        ssml_text = self._create_ssml(text, self.pitch, self.rate)
+
+        # 合成の開始を待って、届いた分から読み出す
+        result = self.speech_synthesizer.start_speaking_ssml_async(ssml_text).get()
+        if result.reason != speechsdk.ResultReason.SynthesizingAudioStarted:
+            raise RuntimeError(f"Speech synthesis did not start: {result.reason}")
+
+        audio_data_stream = speechsdk.AudioDataStream(result)
+        # 読み出し用のバッファは使い回す
+        audio_buffer = bytes(chunk_size)
+        total_size = 0
+        while filled_size := audio_data_stream.read_data(audio_buffer):
+            total_size += filled_size
+            yield audio_buffer[:filled_size]
+
+        if audio_data_stream.status == speechsdk.StreamStatus.Canceled:
+            cancellation_details = audio_data_stream.cancellation_details
+            raise RuntimeError(f"Speech synthesis canceled: {cancellation_details.reason} {cancellation_details.error_details}")
+        if total_size == 0:
+            raise RuntimeError("Audio data is empty")
+
     def _create_ssml(self, text: str, pitch: str, rate: str) -> str:
         """SSMLを生成する"""
         ssml_template = """
@@ -71,15 +105,100 @@ class AzureSpeechSynthesizer:
         return False
 
 
+class AzureSpeechSynthesizerPool:
+    """声・ピッチ・話速・サンプリングレートごとに、作成済みの AzureSpeechSynthesizer を使い回すプール
+
+    SpeechSynthesizer は同時に1つの合成しかできないので、貸し出し中のものは他に貸さない(足りない場合は新しく作る)。
+    例外やキャンセルで返されたものは、状態が分からないので捨てる
+    """
+
+    def __init__(self, *, max_idle_per_voice: int = 4, factory: Callable[..., AzureSpeechSynthesizer] = AzureSpeechSynthesizer) -> None:
+        self._max_idle_per_voice = max_idle_per_voice
+        self._factory = factory
+        self._lock = threading.Lock()
+        self._idle: collections.defaultdict[tuple[str, str, str, int], list[AzureSpeechSynthesizer]] = collections.defaultdict(list)
+
+    @contextlib.contextmanager
+    def acquire(self, voice_name="ja-JP-KeitaNeural", pitch: str = "+10%", rate: str = "-5%", sample_rate: int = 44100) -> Iterator[AzureSpeechSynthesizer]:
+        """AzureSpeechSynthesizer を借りる"""
+        key = (voice_name, pitch, rate, sample_rate)
+        with self._lock:
+            idle = self._idle[key]
+            speech_synthesizer = idle.pop() if idle else None
+        if speech_synthesizer is None:
+            speech_synthesizer = self._factory(voice_name=voice_name, pitch=pitch, rate=rate, sample_rate=sample_rate)
+
+        yield speech_synthesizer
+
+        with self._lock:
+            idle = self._idle[key]
+            if len(idle) < self._max_idle_per_voice:
+                idle.append(speech_synthesizer)
+
+    def warm_up(self, voices: list[dict[str, str]]) -> None:
+        """最初の合成で待たないように、指定した声の AzureSpeechSynthesizer を作っておく"""
+        for voice in voices:
+            try:
+                with self.acquire(**voice):
+                    pass
+            except Exception as e:
+                LOGGER.warning("Failed to warm up Azure speech synthesizer %s: %r", voice, e)
+
+    def idle_count(self, voice_name="ja-JP-KeitaNeural", pitch: str = "+10%", rate: str = "-5%", sample_rate: int = 44100) -> int:
+        """待機中の AzureSpeechSynthesizer の数"""
+        with self._lock:
+            return len(self._idle[(voice_name, pitch, rate, sample_rate)])
+
+
+azure_synthesizer_pool = AzureSpeechSynthesizerPool()
+
+
+# add_wav_header / wav_header / WavBuffer が作るヘッダーの長さ
+WAV_HEADER_SIZE = 44
+
+
 def add_wav_header(audio_data, *, sample_rate=44100) -> bytes:
     """Adds a WAV header to the given audio data."""
+    return wav_header(len(audio_data), sample_rate=sample_rate) + audio_data
+
+
+class WavBuffer:
+    """PCM を1つの bytearray に追記し、WAV ヘッダーをその先頭に書き込むバッファ
+
+    チャンクの連結やヘッダーの付加のたびに音声全体をコピーしないようにする。
+    wav() が返した memoryview を使っている間は追記できない(BufferError になる)
+    """
+
+    def __init__(self, *, sample_rate=44100, format_tag: int = 1, sample_width: int = 2) -> None:
+        self._sample_rate = sample_rate
+        self._format_tag = format_tag
+        self._sample_width = sample_width
+        # 先頭はヘッダー用に空けておく
+        self._buffer = bytearray(WAV_HEADER_SIZE)
+
+    @property
+    def data_size(self) -> int:
+        """追記した PCM の長さ"""
+        return len(self._buffer) - WAV_HEADER_SIZE
+
+    def append(self, chunk: bytes | memoryview) -> None:
+        """PCM を追記する"""
+        self._buffer += chunk
+
+    def wav(self) -> memoryview:
+        """ヘッダーを書き込んで、WAV 全体を返す"""
+        self._buffer[:WAV_HEADER_SIZE] = wav_header(self.data_size, sample_rate=self._sample_rate, format_tag=self._format_tag, sample_width=self._sample_width)
+        return memoryview(self._buffer)
+
+
+def wav_header(data_size: int, *, sample_rate=44100, format_tag: int = 1, sample_width: int = 2) -> bytes:
+    """mono の WAV ヘッダー(format_tag は 1: リニア PCM, 7: μ-law)"""
     num_channels = 1  # Mono
-    sample_width = 2  # 2 bytes per sample
     byte_rate = sample_rate * num_channels * sample_width
     block_align = num_channels * sample_width
-    subchunk2_size = len(audio_data)
+    subchunk2_size = data_size
     chunk_size = 36 + subchunk2_size
 
-    wav_header = struct.pack("<4sI4s4sIHHIIHH4sI", b"RIFF", chunk_size, b"WAVE", b"fmt ", 16, 1, num_channels, sample_rate, byte_rate, block_align, sample_width * 8, b"data", subchunk2_size)
-
-    return wav_header + audio_data
+    return struct.pack(
+        "<4sI4s4sIHHIIHH4sI", b"RIFF", chunk_size, b"WAVE", b"fmt ", 16, format_tag, num_channels, sample_rate, byte_rate, block_align, sample_width * 8, b"data", subchunk2_size
+    )
@@ -0,0 +1,138 @@
+import collections
+import contextlib
+import logging
+import time
+from collections.abc import Iterator
+from enum import Enum
+from typing import Any
+
+LOGGER = logging.getLogger(__name__)
+
+
+class CircuitState(str, Enum):
+    """サーキットブレーカーの状態"""
+
+    closed = "closed"
+    open = "open"
+    half_open = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """サーキットブレーカーが開いているため、呼び出しを行わなかった"""
+
+    def __init__(self, name: str) -> None:
+        super().__init__(f"Circuit breaker '{name}' is open")
+        self.name = name
+
+
+class CircuitBreaker:
+    """外部サービスごとのサーキットブレーカー
+
+    直近 window_size 回の呼び出しのうち、失敗(例外 or slow_call_seconds 以上かかった呼び出し)の割合が
+    failure_rate_threshold 以上になったら open にする。
+    open になってから open_seconds 経過すると half_open になり、1件だけ試行を通す。試行が成功すれば closed に戻る。
+    """
+
+    def __init__(
+        self,
+        name: str,
+        *,
+        slow_call_seconds: float,
+        window_size: int = 20,
+        min_calls: int = 5,
+        failure_rate_threshold: float = 0.5,
+        open_seconds: float = 30.0,
+    ) -> None:
+        self.name = name
+        self._slow_call_seconds = slow_call_seconds
+        self._min_calls = min_calls
+        self._failure_rate_threshold = failure_rate_threshold
+        self._open_seconds = open_seconds
+
+        self._outcomes: collections.deque[bool] = collections.deque(maxlen=window_size)
+        self._state = CircuitState.closed
+        self._opened_at = 0.0
+        self._probing = False
+
+    @property
+    def state(self) -> CircuitState:
+        """現在の状態"""
+        if self._state == CircuitState.open and time.monotonic() - self._opened_at >= self._open_seconds:
+            self._state = CircuitState.half_open
+            self._probing = False
+        return self._state
+
+    @property
+    def degraded(self) -> bool:
+        """依存先が不調とみなされているか"""
+        return self.state != CircuitState.closed
+
+    def allow_request(self) -> bool:
+        """呼び出しを行ってよいか(half_open の場合は試行枠を1つ消費する)"""
+        state = self.state
+        if state == CircuitState.closed:
+            return True
+        if state == CircuitState.half_open and not self._probing:
+            self._probing = True
+            return True
+        return False
+
+    @contextlib.contextmanager
+    def guard(self) -> Iterator[None]:
+        """呼び出しの成否と所要時間を記録する
+
+        Raises:
+            CircuitOpenError: ブレーカーが開いている場合
+        """
+        if not self.allow_request():
+            raise CircuitOpenError(self.name)
+
+        started_at = time.monotonic()
+        try:
+            yield
+        except Exception:
+            self._record(ok=False)
+            raise
+        except BaseException:
+            # キャンセルされた場合(クライアントの切断など)は成否が分からないので記録せず、half_open の試行枠を返す
+            self._probing = False
+            raise
+        self._record(ok=time.monotonic() - started_at < self._slow_call_seconds)
+
+    def snapshot(self) -> dict[str, Any]:
+        """現在の状態を返す(ステータス表示用)"""
+        return {
+            "state": self.state.value,
+            "calls": len(self._outcomes),
+            "failures": self._outcomes.count(False),
+        }
+
+    def _record(self, *, ok: bool) -> None:
+        if self._state == CircuitState.half_open:
+            self._probing = False
+            if ok:
+                LOGGER.info("Circuit breaker '%s' is closed", self.name)
+                self._state = CircuitState.closed
+                self._outcomes.clear()
+            else:
+                self._open()
+            return
+
+        self._outcomes.append(ok)
+        if self._state == CircuitState.closed and len(self._outcomes) >= self._min_calls:
+            failure_rate = self._outcomes.count(False) / len(self._outcomes)
+            if failure_rate >= self._failure_rate_threshold:
+                self._open()
+
+    def _open(self) -> None:
+        LOGGER.warning("Circuit breaker '%s' is open", self.name)
+        self._state = CircuitState.open
+        self._opened_at = time.monotonic()
+        self._outcomes.clear()
+
+
+gemini_breaker = CircuitBreaker("gemini", slow_call_seconds=20.0)
+elevenlabs_breaker = CircuitBreaker("elevenlabs", slow_call_seconds=10.0)
+azure_breaker = CircuitBreaker("azure", slow_call_seconds=10.0)
+
+CIRCUIT_BREAKERS = [gemini_breaker, elevenlabs_breaker, azure_breaker]
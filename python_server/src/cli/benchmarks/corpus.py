@@ -0,0 +1,61 @@
+import csv
+import pathlib
+
+import pandas as pd
+from langchain.schema.document import Document
+from langchain.text_splitter import CharacterTextSplitter
+from langchain_community.vectorstores import FAISS
+from langchain_core.embeddings import Embeddings
+
+from src.config import settings
+
+KNOWLEDGE_CSV_PATH = settings.PYTHON_SERVER_ROOT / "faiss_knowledge" / "manifesto_demo_slides.csv"
+QA_CSV_PATH = settings.PYTHON_SERVER_ROOT / "faiss_qa" / "sample_tsukuyomi.csv"
+
+
+def load_knowledge_documents(csv_path: pathlib.Path = KNOWLEDGE_CSV_PATH) -> list[Document]:
+    """知識 DB と同じ方法で、スライドの CSV(title, text, filename)をチャンクに分割する"""
+    docs = []
+    manifests = pd.read_csv(csv_path)
+    for i, row in enumerate(manifests.to_dict(orient="records")):
+        page_content = f"Title: {row['title']}\n {row['text']}"
+        docs.append(Document(page_content=page_content, metadata={"row": i, "image": row["filename"]}))
+
+    text_splitter = CharacterTextSplitter(
+        separator="\n",  # セパレータ
+        chunk_size=300,  # チャンクの文字数
+        chunk_overlap=0,  # チャンクオーバーラップの文字数
+    )
+    return text_splitter.split_documents(docs)
+
+
+def load_qa_documents(csv_path: pathlib.Path = QA_CSV_PATH, encoding: str = "cp932") -> list[Document]:
+    """Q&A の CSV(question, answer)を Q&A DB と同じ形式の Document にする"""
+    with csv_path.open(encoding=encoding) as f:
+        rows = list(csv.DictReader(f))
+    return [
+        Document(page_content=f"question: {row['question']}\nanswer: {row['answer']}", metadata={"question": row["question"], "answer": row["answer"]})
+        for row in rows
+        if row["question"] and row["answer"]
+    ]
+
+
+def scale_documents(docs: list[Document], size: int) -> list[Document]:
+    """文書を複製して size 件にする(大規模なコーパスでの性能を見るため)
+
+    複製した文書には連番を付け、内容が完全には重複しないようにする
+    """
+    scaled = []
+    for i in range(size):
+        doc = docs[i % len(docs)]
+        copy_index = i // len(docs)
+        page_content = doc.page_content if copy_index == 0 else f"{doc.page_content}\n(複製 {copy_index})"
+        scaled.append(Document(page_content=page_content, metadata={**doc.metadata, "copy": copy_index}))
+    return scaled
+
+
+def build_faiss_db(docs: list[Document], embeddings: Embeddings, db_dir: pathlib.Path) -> FAISS:
+    """FAISS の DB を作成して保存する"""
+    vector = FAISS.from_documents(docs, embeddings)
+    vector.save_local(db_dir)
+    return vector
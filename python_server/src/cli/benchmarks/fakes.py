@@ -0,0 +1,170 @@
+import asyncio
+import contextlib
+import dataclasses
+import functools
+import json
+import pathlib
+import time
+import types
+import zlib
+from collections.abc import AsyncIterator, Iterator
+from unittest import mock
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from src.azure_speech_synthesizer import AzureSpeechSynthesizerPool
+from src.config import settings
+from src.tts_cache import AudioCache
+
+# 各プロンプト(回答生成、リランク、ハルシネーションチェック、コメントのフィルタ)が期待するキーを全て含んだレスポンス
+DEFAULT_GEMINI_RESPONSE = json.dumps(
+    {
+        "response": "ご質問ありがとうございます。政策の詳細はマニフェストをご覧ください。",
+        "results": [1, 2, 3],
+        "result": 0,
+        "question_index": [0],
+    },
+    ensure_ascii=False,
+)
+
+# text-embedding-004 と同じ次元数
+EMBEDDING_DIMENSIONS = 768
+
+SAMPLE_RATE = 44100
+
+
+@dataclasses.dataclass
+class FakeServiceConfig:
+    """外部 API の代替実装の応答内容と遅延(秒)
+
+    ベンチマークで API の利用枠を使わないように、Gemini・埋め込み・ElevenLabs・Azure を決定的に動くローカルの実装に置き換える
+    """
+
+    gemini_response: str = DEFAULT_GEMINI_RESPONSE
+    gemini_delay: float = 1.0
+    embedding_delay: float = 0.1
+    # ElevenLabs: 最初のチャンクまでの遅延と、以降のチャンクごとの遅延
+    elevenlabs_first_chunk_delay: float = 0.3
+    elevenlabs_chunk_delay: float = 0.02
+    azure_delay: float = 0.5
+    # 1文字あたりの音声の長さ
+    seconds_per_char: float = 0.15
+
+
+class FakeGenerativeModel:
+    """google.generativeai.GenerativeModel の代替"""
+
+    def __init__(self, config: FakeServiceConfig, model_name: str, generation_config: dict | None = None) -> None:
+        self._config = config
+        self.model_name = model_name
+
+    async def generate_content_async(self, prompt: str) -> types.SimpleNamespace:
+        """設定した遅延の後に、設定したレスポンスを返す"""
+        await asyncio.sleep(self._config.gemini_delay)
+        usage = types.SimpleNamespace(prompt_token_count=len(prompt) // 2, candidates_token_count=len(self._config.gemini_response) // 2)
+        return types.SimpleNamespace(text=self._config.gemini_response, usage_metadata=usage)
+
+
+class HashingEmbeddings(Embeddings):
+    """文字 bigram をハッシュして作る埋め込み(GoogleGenerativeAIEmbeddings の代替)
+
+    同じ文字列は同じベクトルになり、文字の重なりが多いほど近くなる
+    """
+
+    def __init__(self, dimensions: int = EMBEDDING_DIMENSIONS, delay: float = 0.0) -> None:
+        self._dimensions = dimensions
+        self._delay = delay
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        """文書を埋め込む"""
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        """クエリを埋め込む(本物と同じく同期的に API を待つ)"""
+        if self._delay:
+            time.sleep(self._delay)
+        return self._embed(text)
+
+    def _embed(self, text: str) -> list[float]:
+        hashes = np.array([zlib.crc32(text[i : i + 2].encode()) for i in range(max(len(text) - 1, 1))], dtype=np.int64)
+        vector = np.zeros(self._dimensions)
+        np.add.at(vector, hashes % self._dimensions, np.where((hashes >> 16) & 1, 1.0, -1.0))
+        norm = np.linalg.norm(vector) or 1.0
+        return (vector / norm).tolist()
+
+
+def fake_pcm(text: str, *, seconds_per_char: float, sample_rate: int = SAMPLE_RATE) -> bytes:
+    """テキストの長さに応じた長さの PCM(16bit, mono)を作る"""
+    num_samples = int(sample_rate * seconds_per_char * max(len(text), 1))
+    # 無音と判定されないように、小さな振幅のノコギリ波にする
+    return (np.arange(num_samples) % 200 - 100).astype("<i2").tobytes()
+
+
+class _FakeElevenLabsConverter:
+    def __init__(self, config: FakeServiceConfig, *, chunk_size: int = 4096) -> None:
+        self._config = config
+        self._chunk_size = chunk_size
+
+    def convert_as_stream(self, *, text: str | None = None, audio: bytes | None = None, output_format: str = "pcm_44100", **kwargs) -> AsyncIterator[bytes]:
+        # STS の場合は入力音声と同じ長さの音声を返す
+        sample_rate = int(output_format.removeprefix("pcm_"))
+        pcm = fake_pcm(text, seconds_per_char=self._config.seconds_per_char, sample_rate=sample_rate) if text is not None else audio or b""
+        return self._stream(pcm)
+
+    async def _stream(self, pcm: bytes) -> AsyncIterator[bytes]:
+        await asyncio.sleep(self._config.elevenlabs_first_chunk_delay)
+        for start in range(0, len(pcm), self._chunk_size):
+            if start:
+                await asyncio.sleep(self._config.elevenlabs_chunk_delay)
+            yield pcm[start : start + self._chunk_size]
+
+
+class FakeElevenLabs:
+    """AsyncElevenLabs の代替(text_to_speech / speech_to_speech の convert_as_stream のみ)"""
+
+    def __init__(self, config: FakeServiceConfig) -> None:
+        self.text_to_speech = _FakeElevenLabsConverter(config)
+        self.speech_to_speech = _FakeElevenLabsConverter(config)
+
+
+class FakeAzureSpeechSynthesizer:
+    """AzureSpeechSynthesizer の代替(本物と同じく、合成が終わるまでスレッドをブロックする)"""
+
+    def __init__(self, config: FakeServiceConfig, voice_name: str = "ja-JP-KeitaNeural", pitch: str = "+10%", rate: str = "-5%", sample_rate: int = SAMPLE_RATE) -> None:
+        self._config = config
+        self.voice_name = voice_name
+        self.sample_rate = sample_rate
+
+    def speech_synthesis_to_audio_data_stream(self, text: str) -> bytes:
+        """設定した遅延の後に PCM を返す"""
+        time.sleep(self._config.azure_delay)
+        return fake_pcm(text, seconds_per_char=self._config.seconds_per_char, sample_rate=self.sample_rate)
+
+    def speech_synthesis_chunks(self, text: str, *, chunk_size: int = 4096) -> Iterator[bytes]:
+        """設定した遅延の後に、PCM を chunk_size ずつ返す"""
+        pcm = self.speech_synthesis_to_audio_data_stream(text)
+        for start in range(0, len(pcm), chunk_size):
+            yield pcm[start : start + chunk_size]
+
+
+@contextlib.contextmanager
+def offline_services(config: FakeServiceConfig, *, faiss_knowledge_db_dir: pathlib.Path, faiss_qa_db_dir: pathlib.Path) -> Iterator[None]:
+    """with ブロック内で、外部 API の呼び出しを代替実装に置き換える
+
+    FAISS の DB は HashingEmbeddings で作成したものを指定する
+    """
+
+    def create_embeddings(**kwargs) -> HashingEmbeddings:
+        return HashingEmbeddings(delay=config.embedding_delay)
+
+    with contextlib.ExitStack() as stack:
+        stack.enter_context(mock.patch("src.gemini.genai.GenerativeModel", functools.partial(FakeGenerativeModel, config)))
+        stack.enter_context(mock.patch("src.get_faiss_vector.GoogleGenerativeAIEmbeddings", create_embeddings))
+        stack.enter_context(mock.patch("src.text_to_speech.client", FakeElevenLabs(config)))
+        stack.enter_context(mock.patch("src.text_to_speech.azure_synthesizer_pool", AzureSpeechSynthesizerPool(factory=functools.partial(FakeAzureSpeechSynthesizer, config))))
+        # 毎回合成するように、音声のキャッシュは使わない
+        stack.enter_context(mock.patch("src.text_to_speech.tts_cache", AudioCache(faiss_knowledge_db_dir, max_bytes=0)))
+        stack.enter_context(mock.patch.object(settings, "FAISS_KNOWLEDGE_DB_DIR", faiss_knowledge_db_dir))
+        stack.enter_context(mock.patch.object(settings, "FAISS_QA_DB_DIR", faiss_qa_db_dir))
+        yield
@@ -0,0 +1,173 @@
+import asyncio
+import collections
+import dataclasses
+import logging
+import pathlib
+import random
+import tempfile
+import time
+
+import click
+import httpx
+import numpy as np
+import pandas as pd
+
+from src.cli.benchmarks.corpus import build_faiss_db, load_knowledge_documents, load_qa_documents
+from src.cli.benchmarks.fakes import FakeServiceConfig, HashingEmbeddings, offline_services
+from src.cli.wrap.sync import sync
+from src.web.api import app
+
+LOGGER = logging.getLogger(__name__)
+
+# 負荷をかけるエンドポイント
+ENDPOINTS = ["reply", "voice", "voice_v2", "get_info"]
+
+
+@dataclasses.dataclass
+class LoadTestReport:
+    """負荷試験の結果"""
+
+    elapsed: float
+    # エンドポイントごとの (ステータスコード, 所要時間) のリスト
+    results: dict[str, list[tuple[int, float]]]
+    # イベントループの遅延(秒)
+    loop_lags: list[float]
+
+    def summary(self) -> pd.DataFrame:
+        """エンドポイントごとのスループットと所要時間のパーセンタイル"""
+        rows = {}
+        for endpoint, results in self.results.items():
+            latencies = np.array([latency for _, latency in results])
+            statuses = collections.Counter(status for status, _ in results)
+            rows[endpoint] = {
+                "requests": len(results),
+                "errors": sum(count for status, count in statuses.items() if status >= 400),
+                "throughput": len(results) / self.elapsed,
+                **_percentiles(latencies),
+                "statuses": dict(sorted(statuses.items())),
+            }
+        return pd.DataFrame.from_dict(rows, orient="index")
+
+    def loop_lag_summary(self) -> dict[str, float]:
+        """イベントループの遅延のパーセンタイル"""
+        return _percentiles(np.array(self.loop_lags))
+
+
+async def run_load_test(
+    client: httpx.AsyncClient,
+    *,
+    rate: float,
+    duration: float,
+    weights: dict[str, float],
+    questions: list[str],
+    seed: int = 0,
+    lag_interval: float = 0.01,
+) -> LoadTestReport:
+    """平均 rate 件/秒のポアソン到着でリクエストを送り続ける(前のリクエストの完了は待たない)"""
+    rng = random.Random(seed)  # noqa: S311
+    endpoints = list(weights)
+    results: dict[str, list[tuple[int, float]]] = {endpoint: [] for endpoint in endpoints}
+    loop_lags: list[float] = []
+
+    async def send(endpoint: str, question: str) -> None:
+        started_at = time.perf_counter()
+        try:
+            response = await _request(client, endpoint, question)
+            status_code = response.status_code
+        except Exception as e:
+            LOGGER.warning("Request to %s failed: %r", endpoint, e)
+            status_code = 599
+        results[endpoint].append((status_code, time.perf_counter() - started_at))
+
+    async def monitor_loop_lag() -> None:
+        while True:
+            started_at = time.perf_counter()
+            await asyncio.sleep(lag_interval)
+            loop_lags.append(time.perf_counter() - started_at - lag_interval)
+
+    monitor = asyncio.create_task(monitor_loop_lag())
+    tasks = []
+    started_at = time.perf_counter()
+    next_at = started_at
+    while True:
+        next_at += rng.expovariate(rate)
+        if next_at - started_at >= duration:
+            break
+        await asyncio.sleep(max(next_at - time.perf_counter(), 0))
+        endpoint = rng.choices(endpoints, weights=[weights[endpoint] for endpoint in endpoints])[0]
+        tasks.append(asyncio.create_task(send(endpoint, rng.choice(questions))))
+
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started_at
+    monitor.cancel()
+    return LoadTestReport(elapsed=elapsed, results=results, loop_lags=loop_lags)
+
+
+async def _request(client: httpx.AsyncClient, endpoint: str, question: str) -> httpx.Response:
+    if endpoint == "reply":
+        return await client.post("/reply", data={"inputtext": question})
+    if endpoint == "voice":
+        return await client.post("/voice", params={"text": question})
+    if endpoint == "voice_v2":
+        return await client.post("/voice/v2", params={"text": question})
+    if endpoint == "get_info":
+        return await client.get("/get_info", params={"query": question, "top_k": 5})
+    raise ValueError(f"Unknown endpoint: {endpoint}")
+
+
+def _percentiles(values: np.ndarray) -> dict[str, float]:
+    if len(values) == 0:
+        return {"p50": float("nan"), "p95": float("nan"), "p99": float("nan"), "max": float("nan")}
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {"p50": p50, "p95": p95, "p99": p99, "max": values.max()}
+
+
+@click.command()
+@click.option("--rate", type=float, default=2.0, help="1秒あたりの平均リクエスト数")
+@click.option("--duration", type=float, default=60.0, help="リクエストを送り続ける秒数")
+@click.option("--endpoint", "endpoints", type=click.Choice(ENDPOINTS), multiple=True, default=ENDPOINTS, help="負荷をかけるエンドポイント(複数指定可、均等に送る)")
+@click.option("--gemini-delay", type=float, default=FakeServiceConfig.gemini_delay, help="Gemini の応答までの秒数")
+@click.option("--embedding-delay", type=float, default=FakeServiceConfig.embedding_delay, help="埋め込みの応答までの秒数")
+@click.option("--elevenlabs-delay", type=float, default=FakeServiceConfig.elevenlabs_first_chunk_delay, help="ElevenLabs の最初のチャンクまでの秒数")
+@click.option("--azure-delay", type=float, default=FakeServiceConfig.azure_delay, help="Azure TTS の応答までの秒数")
+@click.option("--seed", type=int, default=0, help="乱数のシード")
+@sync
+async def main(
+    rate: float,
+    duration: float,
+    endpoints: tuple[str, ...],
+    gemini_delay: float,
+    embedding_delay: float,
+    elevenlabs_delay: float,
+    azure_delay: float,
+    seed: int,
+) -> None:
+    """外部 API をローカルの代替実装に置き換えて、API サーバーに負荷をかける
+
+    FastAPI のアプリをプロセス内で直接呼び出すので、API の利用枠は消費しない。
+    対話ログは本番のログに混ざらないように書き出さない。
+    """
+    config = FakeServiceConfig(gemini_delay=gemini_delay, embedding_delay=embedding_delay, elevenlabs_first_chunk_delay=elevenlabs_delay, azure_delay=azure_delay)
+    qa_docs = load_qa_documents()
+    questions = [doc.metadata["question"] for doc in qa_docs]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        knowledge_db_dir = pathlib.Path(tmp_dir) / "knowledge"
+        qa_db_dir = pathlib.Path(tmp_dir) / "qa"
+        embeddings = HashingEmbeddings()
+        build_faiss_db(load_knowledge_documents(), embeddings, knowledge_db_dir)
+        build_faiss_db(qa_docs, embeddings, qa_db_dir)
+
+        logging.getLogger("interaction_logger").disabled = True
+        with offline_services(config, faiss_knowledge_db_dir=knowledge_db_dir, faiss_qa_db_dir=qa_db_dir):
+            async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://load-test", timeout=None) as client:
+                report = await run_load_test(client, rate=rate, duration=duration, weights=dict.fromkeys(endpoints, 1.0), questions=questions, seed=seed)
+
+    with pd.option_context("display.float_format", "{:.3f}".format, "display.width", 200):
+        click.echo(f"elapsed: {report.elapsed:.1f}s, target rate: {rate}/s")
+        click.echo(report.summary().to_string())
+        click.echo("event loop lag: " + ", ".join(f"{name}={value:.3f}s" for name, value in report.loop_lag_summary().items()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+import contextlib
+import functools
+import io
+import pathlib
+import resource
+import tempfile
+import time
+from collections.abc import Callable
+from unittest import mock
+
+import click
+import numpy as np
+import pandas as pd
+from langchain.schema.document import Document
+from langchain_community.retrievers import BM25Retriever
+
+from src.cli.benchmarks.corpus import KNOWLEDGE_CSV_PATH, QA_CSV_PATH, build_faiss_db, load_knowledge_documents, load_qa_documents, scale_documents
+from src.cli.benchmarks.fakes import FakeServiceConfig, HashingEmbeddings, offline_services
+from src.get_faiss_vector import get_bm25_knowledge, get_hybrid_knowledge, get_multiple_qa, preprocess
+
+# 計測する検索方法(新しい検索方法を追加したらここに登録する)
+RETRIEVERS: dict[str, Callable[[str], object]] = {
+    "bm25_knowledge": lambda query: get_bm25_knowledge(query, top_k=5),
+    "hybrid_knowledge": lambda query: get_hybrid_knowledge(query, top_k=5),
+    "multiple_qa": lambda query: get_multiple_qa(query=query, top_k=5),
+}
+
+
+def benchmark_retrieval(
+    *,
+    knowledge_docs: list[Document],
+    qa_docs: list[Document],
+    sizes: list[int],
+    queries: list[str],
+    retrievers: dict[str, Callable[[str], object]] = RETRIEVERS,
+) -> pd.DataFrame:
+    """コーパスの件数ごとに、各検索方法の1回あたりの所要時間とメモリ使用量を計測する
+
+    Args:
+        sizes: コーパスの件数(0 の場合は元のコーパスをそのまま使う)
+
+    Returns:
+        (件数, 検索方法) ごとの行を持つ DataFrame
+    """
+    rows = []
+    for size in sizes:
+        scaled_knowledge_docs = scale_documents(knowledge_docs, size) if size else knowledge_docs
+        scaled_qa_docs = scale_documents(qa_docs, size) if size else qa_docs
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            knowledge_db_dir = pathlib.Path(tmp_dir) / "knowledge"
+            qa_db_dir = pathlib.Path(tmp_dir) / "qa"
+            rss_before = _current_rss_bytes()
+            started_at = time.perf_counter()
+            embeddings = HashingEmbeddings()
+            build_faiss_db(scaled_knowledge_docs, embeddings, knowledge_db_dir)
+            build_faiss_db(scaled_qa_docs, embeddings, qa_db_dir)
+            bm25_retriever = BM25Retriever.from_documents(scaled_knowledge_docs, preprocess_func=preprocess)
+            build_seconds = time.perf_counter() - started_at
+            rss_delta = _current_rss_bytes() - rss_before
+            index_bytes = sum(path.stat().st_size for path in pathlib.Path(tmp_dir).rglob("*") if path.is_file())
+
+            config = FakeServiceConfig(embedding_delay=0)
+            with (
+                offline_services(config, faiss_knowledge_db_dir=knowledge_db_dir, faiss_qa_db_dir=qa_db_dir),
+                mock.patch("src.get_faiss_vector._create_bm25_knowledge_db", _cached_factory(bm25_retriever)),
+            ):
+                for name, retrieve in retrievers.items():
+                    latencies = _time_queries(retrieve, queries)
+                    rows.append(
+                        {
+                            "size": len(scaled_knowledge_docs),
+                            "retriever": name,
+                            "p50_ms": np.percentile(latencies, 50) * 1000,
+                            "p95_ms": np.percentile(latencies, 95) * 1000,
+                            "mean_ms": np.mean(latencies) * 1000,
+                            "build_seconds": build_seconds,
+                            "index_mb": index_bytes / 1024 / 1024,
+                            "rss_delta_mb": rss_delta / 1024 / 1024,
+                        }
+                    )
+    return pd.DataFrame(rows)
+
+
+def _cached_factory(retriever: BM25Retriever) -> Callable[[], BM25Retriever]:
+    """_create_bm25_knowledge_db の代わりに、作成済みの索引を返す(cache_info を持つように lru_cache にする)"""
+
+    @functools.lru_cache(maxsize=1)
+    def factory() -> BM25Retriever:
+        return retriever
+
+    return factory
+
+
+def _time_queries(retrieve: Callable[[str], object], queries: list[str]) -> list[float]:
+    latencies = []
+    # 検索関数の print で出力が埋もれないようにする
+    with contextlib.redirect_stdout(io.StringIO()):
+        # 初回の読み込みなどを除くため、1回空打ちする
+        retrieve(queries[0])
+        for query in queries:
+            started_at = time.perf_counter()
+            retrieve(query)
+            latencies.append(time.perf_counter() - started_at)
+    return latencies
+
+
+def _current_rss_bytes() -> int:
+    """現在の RSS(/proc がない環境ではピークの RSS)"""
+    statm = pathlib.Path("/proc/self/statm")
+    if statm.exists():
+        return int(statm.read_text().split()[1]) * resource.getpagesize()
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+@click.command()
+@click.option("--size", "sizes", type=int, multiple=True, default=[0, 10_000], help="コーパスの件数(複製して水増しする。0 は元のコーパス。複数指定可)")
+@click.option("--knowledge-csv", type=click.Path(exists=True, dir_okay=False, path_type=pathlib.Path), multiple=True, default=[KNOWLEDGE_CSV_PATH], help="知識の CSV(title, text, filename)")
+@click.option("--qa-csv", type=click.Path(exists=True, dir_okay=False, path_type=pathlib.Path), default=QA_CSV_PATH, help="Q&A の CSV(question, answer)")
+@click.option("--queries", "num_queries", type=int, default=50, help="計測に使うクエリの数")
+@click.option("--output", type=click.Path(dir_okay=False, path_type=pathlib.Path), default=None, help="結果を保存する CSV(リリース間の比較用)")
+def main(sizes: tuple[int, ...], knowledge_csv: tuple[pathlib.Path, ...], qa_csv: pathlib.Path, num_queries: int, output: pathlib.Path | None) -> None:
+    """同梱のコーパスから索引を作り、検索方法ごとの所要時間とメモリ使用量を計測する
+
+    埋め込みはローカルの HashingEmbeddings を使うので、API の利用枠は消費しない。
+    100000 件などの大きな件数は、元のコーパスを複製して作る。
+    """
+    knowledge_docs = [doc for path in knowledge_csv for doc in load_knowledge_documents(path)]
+    qa_docs = load_qa_documents(qa_csv)
+    queries = [doc.metadata["question"] for doc in qa_docs[:num_queries]]
+
+    results = benchmark_retrieval(knowledge_docs=knowledge_docs, qa_docs=qa_docs, sizes=list(sizes), queries=queries)
+
+    with pd.option_context("display.float_format", "{:.2f}".format, "display.width", 200):
+        click.echo(results.to_string(index=False))
+    if output is not None:
+        results.to_csv(output, index=False)
+        click.echo(f"Saved to {output}")
+
+
+if __name__ == "__main__":
+    main()
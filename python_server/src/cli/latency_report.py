@@ -0,0 +1,33 @@
+import datetime
+import pathlib
+
+import click
+import pandas as pd
+
+from src.config import settings
+from src.interaction_log_parquet import latency_percentiles, load_interaction_logs
+
+
+@click.command()
+@click.option("--log-dir", type=click.Path(exists=True, file_okay=False, path_type=pathlib.Path), default=settings.PYTHON_SERVER_ROOT / "log", help="ローテートした対話ログのディレクトリ")
+@click.option("--hours", type=int, default=None, help="直近何時間分のログを集計するか(指定しない場合は全て)")
+@click.option("--doc-retrieval-type", type=str, default=None, help="集計する検索方法(指定しない場合は全て)")
+def main(log_dir: pathlib.Path, hours: int | None, doc_retrieval_type: str | None) -> None:
+    """ローテートした対話ログから、ステージごとの所要時間の p50 / p95 / p99 を出力する
+
+    log/interaction_log-*.parquet を集計する(ローテーション時に作られる)
+    """
+    logs = load_interaction_logs(sorted(log_dir.glob("interaction_log-*.parquet")))
+    if hours is not None:
+        since = datetime.datetime.now(tz=datetime.UTC) - datetime.timedelta(hours=hours)
+        logs = logs[logs["timestamp"] >= since]
+    if doc_retrieval_type is not None:
+        logs = logs[logs["doc_retrieval_type"] == doc_retrieval_type]
+
+    with pd.option_context("display.float_format", "{:.3f}".format):
+        click.echo(f"{len(logs)} interactions")
+        click.echo(latency_percentiles(logs).to_string())
+
+
+if __name__ == "__main__":
+    main()
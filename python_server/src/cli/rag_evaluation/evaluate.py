@@ -8,20 +8,21 @@ import re
 import typing
 
 import click
-import google.generativeai as genai
+import tenacity
 from pydantic import BaseModel
 
 from src.cli.loaders.qa_dataset import load_qa_dataset, split_qa_data_train_test
 from src.cli.wrap.sync import sync
 from src.config import settings
+from src.gemini import generate_json_content
 from src.gpt import DocumentRetrievalType, generate_response
 from src.logger import setup_logger
+from src.rate_limiter import GeminiLane, RateLimitExceeded
 
 setup_logger()
 
 LOGGER = logging.getLogger(__name__)
 
-genai.configure(api_key=settings.GOOGLE_API_KEY)
 os.environ["GOOGLE_API_KEY"] = settings.GOOGLE_API_KEY
 
 
@@ -243,10 +244,14 @@ async def _evaluate_row(judge_input: JudgeInput, doc_retrieval_type: DocumentRet
     )
 
 
+@tenacity.retry(
+    retry=tenacity.retry_if_exception_type(RateLimitExceeded),
+    wait=tenacity.wait_exponential(min=1, max=30),
+    stop=tenacity.stop_after_attempt(10),
+    reraise=True,
+)
 async def _async_generate_response(prompt: str):
-    model = genai.GenerativeModel("gemini-1.5-pro", generation_config={"response_mime_type": "application/json"})
-    response = await model.generate_content_async(prompt)
-    json_reply = response.text
+    json_reply = await generate_json_content(prompt, lane=GeminiLane.background)
     try:
         return json.loads(json_reply).get("response", "")
     except Exception as e:
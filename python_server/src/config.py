@@ -1,5 +1,5 @@
 import pathlib
-from typing import Any
+from typing import Any, Literal
 from zoneinfo import ZoneInfo
 
 from dotenv import load_dotenv
@@ -28,6 +28,46 @@ class Settings(BaseSettings):
     GOOGLE_DRIVE_FOLDER_ID: str
     GOOGLE_API_KEY: str
 
+    # Gemini のレートリミット(プロセス全体で共有)
+    GEMINI_REQUESTS_PER_MINUTE: int = 60
+    GEMINI_BURST: int = 5
+    GEMINI_MAX_QUEUE_DEPTH: int = 30
+
+    # トレースの出力先
+    # memory: 直近のトレースをメモリに保持して GET /traces/{trace_id} で参照する, file: log/traces.jsonl に追記する
+    TRACE_EXPORTER: Literal["memory", "file", "none"] = "memory"
+
+    # 遅かったリクエストを保持するフライトレコーダー(直近 WINDOW_SECONDS 秒のうち遅い順に CAPACITY 件)
+    FLIGHT_RECORDER_CAPACITY: int = 20
+    FLIGHT_RECORDER_WINDOW_SECONDS: int = 60 * 60
+
+    # 合成した音声のキャッシュ(合計サイズが MAX_BYTES を超えたら古く使われたものから削除する。0 の場合はキャッシュしない)
+    TTS_CACHE_DIR: pathlib.Path = PYTHON_SERVER_ROOT / "tts_cache"
+    TTS_CACHE_MAX_BYTES: int = 1024 * 1024 * 1024
+
+    # 文ごとに並列に音声合成する場合の同時に合成する文の数と、文の間に入れる無音の秒数
+    TTS_SENTENCE_CONCURRENCY: int = 3
+    TTS_SENTENCE_SILENCE_SECONDS: float = 0.3
+    # 合成した音声の前後の無音を削り、声ごとの音量の違いをそろえる
+    TTS_POSTPROCESS: bool = True
+    # /voice/v2 で、クエリパラメータ split の指定がない場合も文ごとに Azure TTS -> STS をパイプライン処理する
+    VOICE_V2_SPLIT_SENTENCES: bool = False
+    # /voice で、クエリパラメータ hedge の指定がない場合も ElevenLabs TTS -> Azure TTS の順にプロバイダーを試す
+    # ElevenLabs の最初の音声が期限(直近の TTS_HEDGE_PERCENTILE パーセンタイルを MIN〜MAX 秒に収めたもの)までに届かなければ Azure TTS でも合成し、先に届いた方を返す
+    VOICE_HEDGE: bool = False
+    TTS_HEDGE_PERCENTILE: float = 95
+    TTS_HEDGE_MIN_SECONDS: float = 0.5
+    TTS_HEDGE_MAX_SECONDS: float = 3.0
+    # 起動後にバックグラウンドで音声を合成しておく声(/voice, /voice/v2, /voice/azure, /voice/male に対応する v1, v2, azure, male。空の場合は合成しない)
+    # 対象はテンプレートメッセージ・テンプレート質問・NG メッセージ
+    PRESYNTHESIS_VOICES: list[Literal["v1", "v2", "azure", "male"]] = ["male", "azure"]
+    PRESYNTHESIS_CONCURRENCY: int = 2
+    # 合成中の音声を同じリクエストで共有する場合に、後から来たリクエストのために最初から保持しておく PCM の上限(超えた後に来たリクエストは新しく合成する)
+    SINGLE_FLIGHT_MAX_REPLAY_BYTES: int = 1024 * 1024
+
+    # 管理用エンドポイント(プロファイラなど)の認証トークン。未設定の場合は管理用エンドポイントを使えない
+    ADMIN_TOKEN: str | None = None
+
     # Postgres
     PG_HOST: str
     PG_PORT: int
@@ -1,10 +1,12 @@
+import time
 from collections.abc import Iterator
 from contextlib import contextmanager
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import Session, declarative_base, sessionmaker
 
 from src.config import settings
+from src.metrics import STAGE_DURATION, STAGE_ERRORS, doc_retrieval_type_var, endpoint_var
 
 assert settings.SQLALCHEMY_DATABASE_URI is not None
 
@@ -13,6 +15,27 @@ engine = create_engine(
     pool_pre_ping=True,
 )
 
+
+# DB クエリの所要時間を計測する
+@event.listens_for(engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+    conn.info.setdefault("query_started_at", []).append(time.perf_counter())
+
+
+@event.listens_for(engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+    started_at = conn.info["query_started_at"].pop()
+    STAGE_DURATION.observe(time.perf_counter() - started_at, stage="db_query", endpoint=endpoint_var.get(), doc_retrieval_type=doc_retrieval_type_var.get())
+
+
+@event.listens_for(engine, "handle_error")
+def _handle_error(exception_context) -> None:
+    conn = exception_context.connection
+    if conn is not None and conn.info.get("query_started_at"):
+        conn.info["query_started_at"].pop()
+    STAGE_ERRORS.inc(stage="db_query", endpoint=endpoint_var.get(), doc_retrieval_type=doc_retrieval_type_var.get())
+
+
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 Base = declarative_base()
@@ -0,0 +1,81 @@
+import collections
+import dataclasses
+import datetime
+import heapq
+import threading
+import time
+from typing import Any
+
+from src.config import settings
+from src.metrics import InteractionStats
+
+# フライトレコーダーで記録するエンドポイント(前方一致)
+RECORDED_ENDPOINT_PREFIXES = ("/reply", "/voice", "/get_info")
+
+
+@dataclasses.dataclass
+class FlightRecord:
+    """遅かったリクエストの記録"""
+
+    endpoint: str
+    method: str
+    status_code: int
+    trace_id: str | None
+    started_at: datetime.datetime
+    duration: float
+    question: str | None
+    stage_durations: dict[str, float]
+    llm_calls: list[dict]
+    retrieval_candidates: dict[str, list[dict]]
+    cache_hits: dict[str, bool]
+
+    @classmethod
+    def from_stats(cls, stats: InteractionStats, **kwargs: Any) -> "FlightRecord":
+        """リクエスト全体の InteractionStats から作る"""
+        return cls(
+            question=stats.question,
+            stage_durations=dict(stats.stage_durations),
+            llm_calls=list(stats.llm_calls),
+            retrieval_candidates=dict(stats.retrieval_candidates),
+            cache_hits=dict(stats.cache_hits),
+            **kwargs,
+        )
+
+    def to_dict(self) -> dict[str, Any]:
+        """JSON で出力するための dict"""
+        return {**dataclasses.asdict(self), "started_at": self.started_at.isoformat()}
+
+
+class FlightRecorder:
+    """直近 window_seconds 秒のうち、所要時間の長かった上位 capacity 件のリクエストを返す
+
+    窓の中のリクエストは全て記録した順に保持し、上位は slowest() で選ぶ(遅いリクエストが窓から外れた後も、その間に記録したリクエストから選び直せる)。
+    """
+
+    def __init__(self, *, capacity: int, window_seconds: float) -> None:
+        self._capacity = capacity
+        self._window_seconds = window_seconds
+        # (記録した時刻, FlightRecord) を記録した順に保持する
+        self._records: collections.deque[tuple[float, FlightRecord]] = collections.deque()
+        self._lock = threading.Lock()
+
+    def record(self, record: FlightRecord) -> None:
+        """リクエストを記録する"""
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            self._records.append((now, record))
+
+    def slowest(self) -> list[FlightRecord]:
+        """窓の中のリクエストのうち、遅い上位 capacity 件を遅い順に返す"""
+        with self._lock:
+            self._expire(time.monotonic())
+            records = [record for _, record in self._records]
+        return heapq.nlargest(self._capacity, records, key=lambda record: record.duration)
+
+    def _expire(self, now: float) -> None:
+        while self._records and now - self._records[0][0] >= self._window_seconds:
+            self._records.popleft()
+
+
+flight_recorder = FlightRecorder(capacity=settings.FLIGHT_RECORDER_CAPACITY, window_seconds=settings.FLIGHT_RECORDER_WINDOW_SECONDS)
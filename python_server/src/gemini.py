@@ -0,0 +1,45 @@
+import time
+
+import google.generativeai as genai
+
+from src.circuit_breaker import gemini_breaker
+from src.config import settings
+from src.metrics import record_llm_call
+from src.rate_limiter import GeminiLane, PriorityRateLimiter
+from src.tracing import tracer
+
+genai.configure(api_key=settings.GOOGLE_API_KEY)
+
+DEFAULT_GEMINI_MODEL = "gemini-1.5-pro"
+
+# プロセス内の Gemini 呼び出しはすべてこのレートリミッタを経由する
+gemini_rate_limiter = PriorityRateLimiter(
+    rate_per_sec=settings.GEMINI_REQUESTS_PER_MINUTE / 60,
+    burst=settings.GEMINI_BURST,
+    max_queue_depth=settings.GEMINI_MAX_QUEUE_DEPTH,
+)
+
+
+async def generate_json_content(prompt: str, *, lane: GeminiLane, model_name: str = DEFAULT_GEMINI_MODEL) -> str:
+    """Gemini に JSON mode で問い合わせ、レスポンスのテキストを返す
+
+    Raises:
+        RateLimitExceeded: レートリミッタの待ち行列から破棄された場合
+        CircuitOpenError: Gemini のサーキットブレーカーが開いている場合
+    """
+    # 2024/08/31現在、生のAPIでないとjson modeが使えない
+    # geminiはVertexではなくGoogle AI Studio経由で利用する。
+    model = genai.GenerativeModel(model_name, generation_config={"response_mime_type": "application/json"})
+    with tracer.start_span("gemini", lane=lane.name, model=model_name, prompt_chars=len(prompt)) as span:
+        enqueued_at = time.perf_counter()
+        async with gemini_rate_limiter.acquire(lane):
+            span.set_attribute("queue_wait_seconds", time.perf_counter() - enqueued_at)
+            with gemini_breaker.guard():
+                response = await model.generate_content_async(prompt)
+
+        usage = response.usage_metadata
+        if usage:
+            span.set_attribute("prompt_tokens", usage.prompt_token_count)
+            span.set_attribute("response_tokens", usage.candidates_token_count)
+            record_llm_call(lane=lane.name, prompt_chars=len(prompt), prompt_tokens=usage.prompt_token_count, response_tokens=usage.candidates_token_count)
+    return response.text
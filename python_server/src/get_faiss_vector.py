@@ -4,7 +4,6 @@ import logging
 import os
 import re
 
-import google.generativeai as genai
 import MeCab
 import pandas as pd
 from langchain.retrievers.ensemble import EnsembleRetriever
@@ -14,11 +13,14 @@ from langchain_community.retrievers import BM25Retriever
 from langchain_community.vectorstores import FAISS
 from langchain_google_genai import GoogleGenerativeAIEmbeddings
 
+from src.circuit_breaker import CircuitOpenError, gemini_breaker
 from src.config import settings
+from src.gemini import generate_json_content
+from src.metrics import observe_stage, record_cache_hit, record_retrieval_candidates
+from src.rate_limiter import GeminiLane, RateLimitExceeded
 
 LOGGER = logging.getLogger(__name__)
 
-genai.configure(api_key=settings.GOOGLE_API_KEY)
 os.environ["GOOGLE_API_KEY"] = settings.GOOGLE_API_KEY
 
 
@@ -48,6 +50,11 @@ def _create_bm25_knowledge_db():
     return bm25_search
 
 
+def _get_bm25_retriever():
+    record_cache_hit("bm25_index", _create_bm25_knowledge_db.cache_info().currsize > 0)
+    return _create_bm25_knowledge_db()
+
+
 @functools.lru_cache(maxsize=1)
 def load_stopwords() -> list[str]:
     """ストップワードを読み込む"""
@@ -81,32 +88,54 @@ def preprocess(text):
 
 def get_bm25_knowledge(query, top_k=5):
     """bm25での検索"""
-    bm25_retriever = _create_bm25_knowledge_db()
+    bm25_retriever = _get_bm25_retriever()
     bm25_retriever.k = top_k
-    context_docs = bm25_retriever.get_relevant_documents(query)
+    with observe_stage("bm25"):
+        context_docs = bm25_retriever.get_relevant_documents(query)
     print(f"len={len(context_docs)}")
     top_docs = context_docs[:top_k]
+    _record_candidates("bm25_knowledge", top_docs)
     return [(doc.page_content, doc.metadata) for doc in top_docs]
 
 
 def get_hybrid_knowledge(query, top_k=5):
     """ハイブリッド検索"""
-    bm25_retriever = _create_bm25_knowledge_db()
+    bm25_retriever = _get_bm25_retriever()
     bm25_retriever.k = top_k
-    embeddings = GoogleGenerativeAIEmbeddings(model="models/text-embedding-004")
-    vector = FAISS.load_local(
-        settings.FAISS_KNOWLEDGE_DB_DIR,
-        embeddings,
-        allow_dangerous_deserialization=True,
-    )
+    with observe_stage("bm25"):
+        bm25_docs = bm25_retriever.get_relevant_documents(query)
+    vector, faiss_docs = _similarity_search(settings.FAISS_KNOWLEDGE_DB_DIR, query, k=top_k)
     faiss_retriever = vector.as_retriever(search_kwargs={"k": top_k})
+    # 各検索の所要時間を計測するために、EnsembleRetriever には検索済みの結果の統合だけを行わせる
     ensemble_retriever = EnsembleRetriever(retrievers=[bm25_retriever, faiss_retriever], weights=[0.5, 0.5])
-    context_docs = ensemble_retriever.get_relevant_documents(query)
+    context_docs = ensemble_retriever.weighted_reciprocal_rank([bm25_docs, faiss_docs])
     print(f"len={len(context_docs)}")
     top_docs = context_docs[:top_k]
+    _record_candidates("hybrid_knowledge", top_docs)
     return [(doc.page_content, doc.metadata) for doc in top_docs]
 
 
+def _similarity_search(db_dir, query, k=4) -> tuple[FAISS, list[Document]]:
+    """FAISS の DB を読み込み、クエリの埋め込みと近傍検索を行う"""
+    embeddings = GoogleGenerativeAIEmbeddings(model="models/text-embedding-004")
+    with observe_stage("faiss_load"):
+        vector = FAISS.load_local(
+            db_dir,
+            embeddings,
+            allow_dangerous_deserialization=True,
+        )
+    with observe_stage("embedding"):
+        query_vector = embeddings.embed_query(query)
+    with observe_stage("faiss"):
+        docs = vector.similarity_search_by_vector(query_vector, k=k)
+    return vector, docs
+
+
+def _record_candidates(name: str, docs: list[Document]) -> None:
+    """検索結果の候補をフライトレコーダー用に記録する(本文は先頭のみ)"""
+    record_retrieval_candidates(name, [{"metadata": doc.metadata, "snippet": doc.page_content[:100]} for doc in docs])
+
+
 def get_qa(query):
     """回答例を一つ取得する"""
     result = get_multiple_qa(query=query, top_k=1)
@@ -115,6 +144,16 @@ def get_qa(query):
 
 def get_multiple_qa(*, query, top_k=5):
     """回答例を取得する"""
+    _, context_docs = _similarity_search(settings.FAISS_QA_DB_DIR, query)
+    print(f"len={len(context_docs)}")
+
+    top_docs = context_docs[:top_k]
+    _record_candidates("qa", top_docs)
+    return [doc.page_content for doc in top_docs]
+
+
+async def get_faq_answer(query, min_relevance=0.7) -> str | None:
+    """想定FAQの中で質問に最も近いものの回答をそのまま返す(十分近いものがなければNone)"""
     embeddings = GoogleGenerativeAIEmbeddings(model="models/text-embedding-004")
     vector = FAISS.load_local(
         settings.FAISS_QA_DB_DIR,
@@ -122,13 +161,15 @@ def get_multiple_qa(*, query, top_k=5):
         allow_dangerous_deserialization=True,
     )
 
-    retriever = vector.as_retriever()
-
-    context_docs = retriever.get_relevant_documents(query)
-    print(f"len={len(context_docs)}")
-
-    top_docs = context_docs[:top_k]
-    return [doc.page_content for doc in top_docs]
+    with observe_stage("faiss"):
+        docs_and_scores = await vector.asimilarity_search_with_relevance_scores(query=query, k=1)
+    if not docs_and_scores:
+        return None
+    doc, score = docs_and_scores[0]
+    LOGGER.info("The closest FAQ (score=%f): %s", score, doc.metadata.get("question"))
+    if score < min_relevance:
+        return None
+    return doc.metadata.get("answer")
 
 
 def get_knowledge(query):
@@ -139,19 +180,11 @@ def get_knowledge(query):
 
 def get_multiple_knowledge(*, query, top_k=10):
     """RAGナレッジを取得する"""
-    embeddings = GoogleGenerativeAIEmbeddings(model="models/text-embedding-004")
-    vector = FAISS.load_local(
-        settings.FAISS_KNOWLEDGE_DB_DIR,
-        embeddings,
-        allow_dangerous_deserialization=True,
-    )
-
-    retriever = vector.as_retriever(search_kwargs={"k": top_k})
-
-    context_docs = retriever.get_relevant_documents(query)
+    _, context_docs = _similarity_search(settings.FAISS_KNOWLEDGE_DB_DIR, query, k=top_k)
     print(f"len={len(context_docs)}")
 
     top_docs = context_docs[:top_k]
+    _record_candidates("knowledge", top_docs)
     for doc in top_docs:
         print(f"metadata={doc.metadata}")
     return [(doc.page_content, doc.metadata) for doc in top_docs]
@@ -163,6 +196,10 @@ DEFAULT_FALLBACK_KNOWLEDGE_METADATA = {"row": 1, "image": "slide_1.png"}
 async def get_best_knowledge(query, top_k=15):
     """RAGナレッジを取得した上でLLMで評価する"""
     top_docs = get_multiple_knowledge(query=query, top_k=top_k)
+    if gemini_breaker.degraded:
+        # Gemini が不調な間はリランクを省略する
+        LOGGER.warning("Skipped reranking because Gemini is degraded")
+        return top_docs[0]
     docs = ""
     for idx, (doc, metadata) in enumerate(top_docs, 1):
         print(f"metadata={metadata}")
@@ -184,9 +221,13 @@ async def get_best_knowledge(query, top_k=15):
 
 """
     LOGGER.debug("Ask the AI to find the best knowledge (top_k=%d, found_docs=%d, query=%s)", top_k, len(top_docs), query)
-    model = genai.GenerativeModel("gemini-1.5-pro", generation_config={"response_mime_type": "application/json"})
-    response = model.generate_content(system_prompt)
-    reply = response.text
+    try:
+        with observe_stage("rerank"):
+            reply = await generate_json_content(system_prompt, lane=GeminiLane.verification)
+    except (RateLimitExceeded, CircuitOpenError) as e:
+        # 混雑時や Gemini の不調時はリランクせずに検索結果の先頭を使う
+        LOGGER.warning("Skipped reranking: %s", e)
+        return top_docs[0]
 
     LOGGER.warning("AI response: %s", reply)
     LOGGER.warning("文書数: %s", len(top_docs))
@@ -225,7 +266,8 @@ async def get_best_knowledge_with_score(query):
         allow_dangerous_deserialization=True,
     )
 
-    docs_and_scores = await vector.asimilarity_search_with_relevance_scores(query=query, k=1)
+    with observe_stage("faiss"):
+        docs_and_scores = await vector.asimilarity_search_with_relevance_scores(query=query, k=1)
     doc, score = docs_and_scores[0]
     doc_in_prompt = f"関連度（-1.0 ~ +1.0）: {score}\n関連情報本文: {doc.page_content}"
     return doc_in_prompt, doc.metadata
@@ -234,6 +276,10 @@ async def get_best_knowledge_with_score(query):
 async def get_n_best_knowledge(query, top_k=5, top_n=5):
     """RAGナレッジを取得した上でLLMで評価し、最大top_n個を返す"""
     top_docs = get_hybrid_knowledge(query=query, top_k=top_k)
+    if gemini_breaker.degraded:
+        # Gemini が不調な間はリランクを省略する
+        LOGGER.warning("Skipped reranking because Gemini is degraded")
+        return top_docs[:top_n]
     docs = ""
     for idx, (doc, metadata) in enumerate(top_docs, 1):
         print(f"metadata={metadata}")
@@ -263,9 +309,13 @@ async def get_n_best_knowledge(query, top_k=5, top_n=5):
 
 """
     LOGGER.debug("Ask the AI to find the best knowledge (top_k=%d, found_docs=%d, query=%s)", top_k, len(top_docs), query)
-    model = genai.GenerativeModel("gemini-1.5-pro", generation_config={"response_mime_type": "application/json"})
-    response = model.generate_content(system_prompt)
-    reply = response.text
+    try:
+        with observe_stage("rerank"):
+            reply = await generate_json_content(system_prompt, lane=GeminiLane.verification)
+    except (RateLimitExceeded, CircuitOpenError) as e:
+        # 混雑時や Gemini の不調時はリランクせずに検索結果の上位を使う
+        LOGGER.warning("Skipped reranking: %s", e)
+        return top_docs[:top_n]
 
     try:
         obj = json.loads(reply)
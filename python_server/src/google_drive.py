@@ -1,6 +1,9 @@
 import pathlib
+import threading
 from typing import Literal
 
+import google_auth_httplib2
+import httplib2
 import structlog
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
@@ -10,35 +13,53 @@ from src.config import settings
 
 slogger = structlog.get_logger(__name__)
 
+# レジューム可能アップロードのチャンクサイズ(256KB の倍数である必要がある)
+UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+
 
 class GoogleDrive:
-    """Google Drive API"""
+    """Google Drive API
+
+    1つのインスタンスを複数スレッドから使えるように、HTTP のコネクションはスレッドごとに作る
+    """
 
     def __init__(self) -> None:
-        credentials = service_account.Credentials.from_service_account_file(settings.GOOGLE_APPLICATION_CREDENTIALS, scopes=["https://www.googleapis.com/auth/drive.file"])
+        self._credentials = service_account.Credentials.from_service_account_file(settings.GOOGLE_APPLICATION_CREDENTIALS, scopes=["https://www.googleapis.com/auth/drive.file"])
 
-        self._service = build("drive", "v3", credentials=credentials)
+        self._service = build("drive", "v3", credentials=self._credentials)
+        self._local = threading.local()
 
     def upload(
         self,
         *,
         file_path: pathlib.Path,
         folder_id: str,
-        mime_type: Literal["text/csv"] | Literal["application/json"],
+        mime_type: Literal["text/csv"] | Literal["application/json"] | Literal["application/vnd.apache.parquet"],
     ) -> None:
-        """Google Driveにファイルをアップロードする
+        """Google Driveにファイルをチャンクに分けてアップロードする
 
         Args:
             file_path: アップロードするファイルのパス
             mime_type: ファイルのMIMEタイプ
         """
-        media = MediaFileUpload(file_path, mimetype=mime_type)
+        media = MediaFileUpload(file_path, mimetype=mime_type, chunksize=UPLOAD_CHUNK_SIZE, resumable=True)
 
         file_metadata = {
             "name": file_path.name,
             "parents": [folder_id],
         }
 
-        file = self._service.files().create(body=file_metadata, media_body=media, fields="id").execute()
+        request = self._service.files().create(body=file_metadata, media_body=media, fields="id")
+
+        file = None
+        while file is None:
+            # 一時的なエラーの場合は、中断したチャンクから再開する
+            _, file = request.next_chunk(http=self._http(), num_retries=3)
 
         slogger.info(f"Uploaded {file_path}", file_id=file.get("id"), file_path=file_path)
+
+    def _http(self) -> google_auth_httplib2.AuthorizedHttp:
+        """スレッドごとの認証済み HTTP クライアント(httplib2 はスレッドセーフではないため)"""
+        if not hasattr(self._local, "http"):
+            self._local.http = google_auth_httplib2.AuthorizedHttp(self._credentials, http=httplib2.Http())
+        return self._local.http
@@ -0,0 +1,84 @@
+import datetime
+import json
+import pathlib
+from collections.abc import Iterable
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from src.metrics import LOGGED_STAGES
+
+# 対話ログを分析用に Parquet で保存する際のスキーマ
+INTERACTION_LOG_SCHEMA = pa.schema(
+    [
+        ("timestamp", pa.timestamp("us", tz="UTC")),
+        ("doc_retrieval_type", pa.dictionary(pa.int8(), pa.string())),
+        ("rag_qa", pa.string()),
+        ("rag_knowledge", pa.string()),
+        ("metadata", pa.string()),
+        ("image", pa.string()),
+        ("question", pa.string()),
+        ("response", pa.string()),
+        ("latency", pa.float64()),
+        *((f"{stage}_seconds", pa.float64()) for stage in LOGGED_STAGES),
+        ("prompt_tokens", pa.int64()),
+        ("response_tokens", pa.int64()),
+        ("cache_hits", pa.string()),
+        ("trace_id", pa.string()),
+    ]
+)
+
+
+def export_interaction_log_to_parquet(*, jsonl_path: pathlib.Path, parquet_path: pathlib.Path) -> None:
+    """JsonFormatter で書き出した対話ログ(JSON Lines)を Parquet(zstd 圧縮)に変換する"""
+    rows = []
+    with jsonl_path.open(encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                rows.append(_to_row(json.loads(line)))
+
+    table = pa.Table.from_pylist(rows, schema=INTERACTION_LOG_SCHEMA)
+    pq.write_table(table, parquet_path, compression="zstd")
+
+
+def load_interaction_logs(parquet_paths: Iterable[pathlib.Path]) -> pd.DataFrame:
+    """Parquet に変換済みの対話ログをまとめて読み込む"""
+    tables = [pq.read_table(path) for path in parquet_paths]
+    if not tables:
+        return INTERACTION_LOG_SCHEMA.empty_table().to_pandas()
+    return pa.concat_tables(tables, promote_options="default").to_pandas()
+
+
+def latency_percentiles(logs: pd.DataFrame, quantiles: Iterable[float] = (0.5, 0.95, 0.99)) -> pd.DataFrame:
+    """ステージごと(と応答全体)の所要時間のパーセンタイルを求める
+
+    Returns:
+        行がステージ、列が count と各パーセンタイル(p50 など)の DataFrame
+    """
+    quantiles = list(quantiles)
+    columns = {stage: f"{stage}_seconds" for stage in LOGGED_STAGES} | {"total": "latency"}
+
+    rows = {}
+    for stage, column in columns.items():
+        values = logs[column].dropna() if column in logs else pd.Series(dtype="float64")
+        row = {"count": len(values)}
+        for q in quantiles:
+            row[f"p{q * 100:g}"] = values.quantile(q) if len(values) else float("nan")
+        rows[stage] = row
+    return pd.DataFrame.from_dict(rows, orient="index")
+
+
+def _to_row(entry: dict) -> dict:
+    metadata = entry.get("metadata") or {}
+    # 内訳の記録を始める前のログでは、内訳の列は null になる
+    stage_durations = entry.get("stage_durations") or {}
+    cache_hits = entry.get("cache_hits")
+    return {
+        **entry,
+        "timestamp": datetime.datetime.fromisoformat(entry["timestamp"]),
+        "metadata": json.dumps(metadata, ensure_ascii=False),
+        "image": metadata.get("image"),
+        **{f"{stage}_seconds": stage_durations.get(stage) for stage in LOGGED_STAGES},
+        "cache_hits": None if cache_hits is None else json.dumps(cache_hits, ensure_ascii=False),
+    }
@@ -0,0 +1,70 @@
+import collections
+import contextlib
+import time
+from collections.abc import Callable, Iterator
+from typing import Any
+
+import numpy as np
+
+
+class LatencyTracker:
+    """外部サービスごとに、直近 window_size 回の所要時間からパーセンタイルを求める
+
+    記録が min_samples 回に満たない場合は、パーセンタイルを求めない
+    """
+
+    def __init__(self, name: str, *, window_size: int = 100, min_samples: int = 5) -> None:
+        self.name = name
+        self._min_samples = min_samples
+        self._latencies: collections.deque[float] = collections.deque(maxlen=window_size)
+
+    def record(self, seconds: float) -> None:
+        """所要時間を記録する"""
+        self._latencies.append(seconds)
+
+    def percentile(self, q: float) -> float | None:
+        """所要時間の q パーセンタイル(記録が少ない場合は None)"""
+        if len(self._latencies) < self._min_samples:
+            return None
+        return float(np.percentile(self._latencies, q))
+
+    @contextlib.contextmanager
+    def time_to_first_chunk(self) -> Iterator[Callable[[], None]]:
+        """with ブロックの開始から、返した関数を最初に呼ぶまでの時間を記録する
+
+        呼ぶ前にキャンセルされた場合は、キャンセルまでの時間を記録する(遅くて打ち切られたものを除くとパーセンタイルが小さく偏るため)。
+        呼ぶ前に失敗した場合は記録しない
+        """
+        started_at = time.perf_counter()
+        marked = False
+
+        def mark() -> None:
+            nonlocal marked
+            if not marked:
+                marked = True
+                self.record(time.perf_counter() - started_at)
+
+        try:
+            yield mark
+        except Exception:
+            raise
+        except BaseException:
+            if not marked:
+                self.record(time.perf_counter() - started_at)
+            raise
+
+    def snapshot(self) -> dict[str, Any]:
+        """直近の所要時間のパーセンタイル(ステータス表示用)"""
+        return {
+            "samples": len(self._latencies),
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+        }
+
+
+# 音声合成で最初の音声が届くまでの時間
+elevenlabs_tts_latency = LatencyTracker("elevenlabs_tts")
+elevenlabs_sts_latency = LatencyTracker("elevenlabs_sts")
+azure_tts_latency = LatencyTracker("azure_tts")
+
+LATENCY_TRACKERS = [elevenlabs_tts_latency, elevenlabs_sts_latency, azure_tts_latency]
@@ -0,0 +1,168 @@
+import concurrent.futures
+import datetime
+import json
+import logging
+import pathlib
+import shutil
+import threading
+from collections.abc import Callable
+from typing import Any
+
+import tenacity
+
+from src.config import settings
+from src.google_drive import GoogleDrive
+
+LOGGER = logging.getLogger(__name__)
+
+MIME_TYPES = {
+    ".csv": "text/csv",
+    ".json": "application/json",
+    ".parquet": "application/vnd.apache.parquet",
+}
+# コピー中のファイルの拡張子(MIME_TYPES にないので、アップロードの対象にならない)
+PARTIAL_SUFFIX = ".part"
+
+
+def copy_for_upload(source: pathlib.Path, dest: pathlib.Path) -> None:
+    """アップロード用のディレクトリにファイルをコピーする
+
+    書き込み途中のファイルをアップロードしないように、PARTIAL_SUFFIX を付けてコピーしてから名前を変える
+    """
+    partial_path = dest.with_name(dest.name + PARTIAL_SUFFIX)
+    shutil.copy(source, partial_path)
+    partial_path.replace(dest)
+
+
+class LogUploader:
+    """ローテートしたログを Google Drive にアップロードするバックグラウンドワーカー
+
+    upload_dir 以下のファイルを並列にアップロードし、完了したら削除する(書き込み途中のファイルは copy_for_upload で除く)。
+    アップロード待ちのファイルは manifest_path に記録しておき、再起動後に再開する。
+    """
+
+    def __init__(
+        self,
+        *,
+        upload_dir: pathlib.Path,
+        manifest_path: pathlib.Path,
+        folder_id: str,
+        max_workers: int = 4,
+        drive_factory: Callable[[], GoogleDrive] = GoogleDrive,
+    ) -> None:
+        self._upload_dir = upload_dir
+        self._manifest_path = manifest_path
+        self._folder_id = folder_id
+        self._max_workers = max_workers
+        self._drive_factory = drive_factory
+
+        self._lock = threading.Lock()
+        self._drive: GoogleDrive | None = None
+        self._executor: concurrent.futures.ThreadPoolExecutor | None = None
+        self._manifest: dict[str, dict[str, Any]] = {}
+        self._in_flight: set[str] = set()
+
+    def start(self) -> None:
+        """前回の起動時から残っているファイルのアップロードを再開する"""
+        with self._lock:
+            self._manifest = self._load_manifest()
+        self.enqueue_pending()
+
+    def stop(self, *, cancel_pending: bool = True) -> None:
+        """実行中のアップロードの完了を待って停止する
+
+        Args:
+            cancel_pending: 未着手のアップロードを取り消すか(取り消したものは次回の起動時に再開する)
+        """
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=cancel_pending)
+
+    def enqueue_pending(self) -> None:
+        """upload_dir 以下の未アップロードのファイルをアップロード待ちにする"""
+        with self._lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self._max_workers, thread_name_prefix="log-uploader")
+
+            file_paths = sorted(path for path in self._upload_dir.glob("*") if path.suffix in MIME_TYPES)
+            for file_path in file_paths:
+                if file_path.name in self._in_flight:
+                    continue
+                self._manifest.setdefault(file_path.name, {"attempts": 0, "last_error": None})
+                self._in_flight.add(file_path.name)
+                self._executor.submit(self._upload, file_path)
+
+            # 既に存在しないファイルは manifest から除く
+            self._manifest = {name: entry for name, entry in self._manifest.items() if (self._upload_dir / name).exists()}
+            self._save_manifest()
+
+    def pending(self) -> dict[str, dict[str, Any]]:
+        """アップロード待ちのファイル(ステータス表示用)"""
+        with self._lock:
+            return {name: dict(entry) for name, entry in self._manifest.items()}
+
+    def _upload(self, file_path: pathlib.Path) -> None:
+        try:
+            self._upload_with_retry(file_path)
+        except Exception as e:
+            LOGGER.exception("Failed to upload %s. It will be retried at the next rotation.", file_path)
+            with self._lock:
+                self._record_error(file_path.name, e)
+        else:
+            file_path.unlink(missing_ok=True)
+            with self._lock:
+                self._manifest.pop(file_path.name, None)
+                self._save_manifest()
+        finally:
+            with self._lock:
+                self._in_flight.discard(file_path.name)
+
+    @tenacity.retry(
+        wait=tenacity.wait_exponential(multiplier=2, max=60),
+        stop=tenacity.stop_after_attempt(5),
+        reraise=True,
+    )
+    def _upload_with_retry(self, file_path: pathlib.Path) -> None:
+        with self._lock:
+            self._record_attempt(file_path.name)
+        self._get_drive().upload(file_path=file_path, folder_id=self._folder_id, mime_type=MIME_TYPES[file_path.suffix])
+
+    def _get_drive(self) -> GoogleDrive:
+        # 認証情報の読み込みや discovery の構築は初回のみ行い、以降は使い回す
+        with self._lock:
+            if self._drive is None:
+                self._drive = self._drive_factory()
+            return self._drive
+
+    def _record_attempt(self, name: str) -> None:
+        entry = self._manifest.setdefault(name, {"attempts": 0, "last_error": None})
+        entry["attempts"] += 1
+        entry["last_attempted_at"] = datetime.datetime.now(tz=settings.LOCAL_TZ).isoformat()
+        self._save_manifest()
+
+    def _record_error(self, name: str, error: Exception) -> None:
+        entry = self._manifest.setdefault(name, {"attempts": 0, "last_error": None})
+        entry["last_error"] = repr(error)
+        self._save_manifest()
+
+    def _load_manifest(self) -> dict[str, dict[str, Any]]:
+        if not self._manifest_path.exists():
+            return {}
+        try:
+            return json.loads(self._manifest_path.read_text(encoding="utf-8"))
+        except json.JSONDecodeError:
+            LOGGER.warning("The upload manifest is broken, so rebuild it from %s", self._upload_dir)
+            return {}
+
+    def _save_manifest(self) -> None:
+        tmp_path = self._manifest_path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(self._manifest, ensure_ascii=False, indent=2), encoding="utf-8")
+        tmp_path.replace(self._manifest_path)
+
+
+log_uploader = LogUploader(
+    upload_dir=settings.PYTHON_SERVER_ROOT / "log" / "files_to_upload",
+    manifest_path=settings.PYTHON_SERVER_ROOT / "log" / "upload_manifest.json",
+    folder_id=settings.GOOGLE_DRIVE_FOLDER_ID,
+)
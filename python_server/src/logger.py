@@ -1,16 +1,22 @@
+import atexit
 import csv
 import datetime
 import io
 import json
 import logging
 import pathlib
+import queue
 import shutil
-import subprocess
 import sys
-from logging.handlers import TimedRotatingFileHandler
+import threading
+import time
+from logging.handlers import QueueHandler, TimedRotatingFileHandler
 
 import structlog
 
+from src.interaction_log_parquet import export_interaction_log_to_parquet
+from src.log_uploader import copy_for_upload, log_uploader
+
 
 class JsonFormatter(logging.Formatter):
     """GPTLogRecord を JSON で出力するための Formatter"""
@@ -26,6 +32,11 @@ class JsonFormatter(logging.Formatter):
             "question": record.question,
             "response": record.response,
             "latency": record.latency,
+            "stage_durations": record.stage_durations,
+            "prompt_tokens": record.prompt_tokens,
+            "response_tokens": record.response_tokens,
+            "cache_hits": record.cache_hits,
+            "trace_id": record.trace_id,
         }
         return json.dumps(log_entry, ensure_ascii=False)
 
@@ -47,6 +58,11 @@ class CsvFormatter(logging.Formatter):
             record.question,
             record.response,
             record.latency,
+            record.stage_durations,
+            record.prompt_tokens,
+            record.response_tokens,
+            record.cache_hits,
+            record.trace_id,
         ]
 
         csv_writer.writerow(log_entry)
@@ -64,6 +80,11 @@ class GPTLogRecord(logging.LogRecord):
     question: str
     response: str
     latency: float
+    stage_durations: dict[str, float]
+    prompt_tokens: int
+    response_tokens: int
+    cache_hits: dict[str, bool]
+    trace_id: str
 
 
 class BaseGPTLogRecordTimedRotatingFileHandler(TimedRotatingFileHandler):
@@ -74,26 +95,31 @@ class BaseGPTLogRecordTimedRotatingFileHandler(TimedRotatingFileHandler):
         self.namer = self._custom_namer
         self.rotator = self.custom_rotator
 
+    def emit_batch(self, records: list[logging.LogRecord]) -> None:
+        """複数の LogRecord をまとめて書き込み、最後に1度だけ flush する
+
+        書き込みに失敗した LogRecord は emit と同じく handleError に渡し、残りの LogRecord は書き込む
+        """
+        with self.lock:
+            for record in records:
+                try:
+                    if self.shouldRollover(record):
+                        self.doRollover()
+                    if self.stream is None:
+                        self.stream = self._open()
+                    self.stream.write(self.format(record) + self.terminator)
+                except Exception:
+                    self.handleError(record)
+            try:
+                self.flush()
+            except Exception:
+                self.handleError(records[-1])
+
     def doRollover(self) -> None:
         """ファイルをローテーションするときの動作(override)"""
         super().doRollover()
-        self._upload_files()
-
-    def _upload_files(self) -> None:
-        """未アップロードのファイルを Google Drive にアップロードする"""
-        command = ["poetry", "run", "python", "-m", "src.cli.upload_logs_to_google_drive"]
-
-        try:
-            result = subprocess.run(command, check=True, capture_output=True, text=True)  # noqa: S603
-
-            print("Command Output:\n", result.stdout)
-
-            if result.stderr:
-                print("Command Error Output:\n", result.stderr)
-
-        except subprocess.CalledProcessError as e:
-            print(f"Error occurred: {e}")
-            print("Command Error Output:\n", e.stderr)
+        # アップロードはバックグラウンドで行うので、ここでは待たない
+        log_uploader.enqueue_pending()
 
     def custom_rotator(self, source: str, dest: str) -> None:
         """files_to_upload/ 以下にファイルを移動しつつ、ローテーションを行う"""
@@ -101,12 +127,18 @@ class BaseGPTLogRecordTimedRotatingFileHandler(TimedRotatingFileHandler):
 
         # アップロード用のコピー
         print(f"Copying {source} to {copy_to}")
-        shutil.copy(source, copy_to)
+        copy_for_upload(pathlib.Path(source), copy_to)
+
+        # 分析用の Parquet
+        self._export_parquet(source=pathlib.Path(source), dest=pathlib.Path(dest))
 
         # ローテーション
         print(f"Rotating {source} to {dest}")
         shutil.move(source, dest)
 
+    def _export_parquet(self, *, source: pathlib.Path, dest: pathlib.Path) -> None:
+        """ローテーションしたファイルを Parquet に変換する(変換できるハンドラのみ)"""
+
     def _custom_namer(self, default_name: str) -> str:
         original_csv_filename, date_part = default_name.rsplit(".", 1)
         base, ext = original_csv_filename.rsplit(".", 1)
@@ -116,13 +148,27 @@ class BaseGPTLogRecordTimedRotatingFileHandler(TimedRotatingFileHandler):
 
 
 class GPTLogRecordJsonTimedRotatingFileHandler(BaseGPTLogRecordTimedRotatingFileHandler):
-    """GPTLogRecord を JSON で出力するための TimedRotatingFileHandler"""
+    """GPTLogRecord を JSON で出力するための TimedRotatingFileHandler
+
+    ローテーション時に、分析用の Parquet ファイルも作成する
+    """
+
+    def _export_parquet(self, *, source: pathlib.Path, dest: pathlib.Path) -> None:
+        parquet_path = dest.with_suffix(".parquet")
+        try:
+            export_interaction_log_to_parquet(jsonl_path=source, parquet_path=parquet_path)
+        except Exception as e:
+            print(f"Failed to export {source} to parquet: {e}")
+            return
+
+        print(f"Exported {source} to {parquet_path}")
+        copy_for_upload(parquet_path, parquet_path.parent / "files_to_upload" / parquet_path.name)
 
 
 class GPTLogRecordCSVTimedRotatingFileHandler(BaseGPTLogRecordTimedRotatingFileHandler):
     """GPTLogRecord を CSV で出力するための TimedRotatingFileHandler
 
-    ファイルに書き出し後、ヘッダーを追加する
+    新しいファイルを開いたときに、先頭にヘッダーを書き込む
     """
 
     headers = [
@@ -134,26 +180,91 @@ class GPTLogRecordCSVTimedRotatingFileHandler(BaseGPTLogRecordTimedRotatingFileH
         "question",
         "response",
         "latency",
+        "stage_durations",
+        "prompt_tokens",
+        "response_tokens",
+        "cache_hits",
+        "trace_id",
     ]
 
-    def custom_rotator(self, source: str, dest: str) -> None:
-        """files_to_upload/ 以下にファイルを移動しつつ、ローテーションを行う"""
-        self._add_header_to_csv(file_path=pathlib.Path(source))
-        super().custom_rotator(source, dest)
+    def _open(self):
+        stream = super()._open()
+        if stream.tell() == 0:
+            self._write_header(stream)
+        return stream
 
-    def _add_header_to_csv(self, *, file_path: pathlib.Path) -> None:
-        """CSV ファイルにヘッダーを追加する(with BOM)"""
+    def _write_header(self, stream) -> None:
+        """CSV ファイルにヘッダーを書き込む(with BOM)"""
         bom = "\ufeff"
 
-        header_line = bom + ",".join(self.headers) + "\n"
+        stream.write(bom + ",".join(self.headers) + "\n")
 
-        if file_path.exists():
-            with file_path.open("r") as file:
-                content = file.read()
 
-            with file_path.open("w") as file:
-                file.seek(0)
-                file.write(header_line + content)
+class BatchingQueueListener:
+    """Queue に積まれた LogRecord を、バックグラウンドのスレッドでまとめてハンドラに書き出す
+
+    batch_size 件溜まるか、最初の LogRecord を受け取ってから flush_interval 秒経過した時点で書き出す。
+    """
+
+    _sentinel = None
+
+    def __init__(self, queue: queue.Queue, *handlers: logging.Handler, batch_size: int = 100, flush_interval: float = 1.0) -> None:
+        self.queue = queue
+        self.handlers = handlers
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._thread: threading.Thread | None = None
+
+    def start(self) -> None:
+        """書き出し用のスレッドを開始する"""
+        self._thread = threading.Thread(target=self._monitor, name="interaction-log-writer", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """溜まっている LogRecord を書き出してからスレッドを停止する"""
+        if self._thread is None:
+            return
+        self.queue.put_nowait(self._sentinel)
+        self._thread.join()
+        self._thread = None
+
+    def _monitor(self) -> None:
+        batch: list[logging.LogRecord] = []
+        deadline = 0.0
+        while True:
+            try:
+                if batch:
+                    record = self.queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                else:
+                    record = self.queue.get()
+            except queue.Empty:
+                self._flush(batch)
+                batch = []
+                continue
+
+            if record is self._sentinel:
+                self._flush(batch)
+                return
+
+            if not batch:
+                deadline = time.monotonic() + self._flush_interval
+            batch.append(record)
+            if len(batch) >= self._batch_size:
+                self._flush(batch)
+                batch = []
+
+    def _flush(self, batch: list[logging.LogRecord]) -> None:
+        if not batch:
+            return
+        for handler in self.handlers:
+            records = [record for record in batch if record.levelno >= handler.level and handler.filter(record)]
+            if not records:
+                continue
+            if isinstance(handler, BaseGPTLogRecordTimedRotatingFileHandler):
+                handler.emit_batch(records)
+            else:
+                for record in records:
+                    handler.handle(record)
 
 
 def _gpt_log_record_factory(name, *args, **kwargs):
@@ -209,19 +320,29 @@ def _setup_stdlib_handlers():
     logging.root.handlers = [handler]
 
     # 対話ログ部分
+    # リクエストの処理中は Queue に積むだけにして、ファイルへの書き込みはバックグラウンドのスレッドでまとめて行う
     interaction_logger = logging.getLogger("interaction_logger")
     interaction_logger.setLevel(log_level)
+    for old_handler in interaction_logger.handlers:
+        if isinstance(old_handler, QueueHandler) and old_handler.listener is not None:
+            old_handler.listener.stop()
 
     # JSON ハンドラの設定
     json_handler = GPTLogRecordJsonTimedRotatingFileHandler("log/interaction_log.json", when="H", interval=1, backupCount=24 * 14)
     json_handler.setLevel(log_level)
     json_handler.setFormatter(JsonFormatter())
-    interaction_logger.addHandler(json_handler)
 
     # CSV ハンドラの設定
     csv_handler = GPTLogRecordCSVTimedRotatingFileHandler("log/interaction_log.csv", when="H", interval=1, backupCount=24 * 14)
     csv_handler.setLevel(log_level)
     csv_handler.setFormatter(CsvFormatter())
-    interaction_logger.addHandler(csv_handler)
+
+    log_queue: queue.Queue = queue.Queue(-1)
+    queue_handler = QueueHandler(log_queue)
+    queue_handler.listener = BatchingQueueListener(log_queue, json_handler, csv_handler)
+    queue_handler.listener.start()
+    atexit.register(queue_handler.listener.stop)
+
+    interaction_logger.handlers = [queue_handler]
 
     logging.setLogRecordFactory(_gpt_log_record_factory)
@@ -0,0 +1,264 @@
+import abc
+import bisect
+import contextlib
+import contextvars
+import dataclasses
+import math
+import threading
+import time
+from collections.abc import Iterator, Sequence
+
+from src.tracing import tracer
+
+# リクエスト単位のラベル(ミドルウェアや generate_response で設定する)
+endpoint_var: contextvars.ContextVar[str] = contextvars.ContextVar("endpoint", default="none")
+doc_retrieval_type_var: contextvars.ContextVar[str] = contextvars.ContextVar("doc_retrieval_type", default="none")
+
+# 対話ログに記録するステージと、それに含まれる計測ステージ
+LOGGED_STAGES = {
+    "ng_check": ("ng_check",),
+    "retrieval": ("faiss_load", "embedding", "faiss", "bm25"),
+    "rerank": ("rerank",),
+    "generation": ("generation",),
+    "hallucination_check": ("hallucination_check",),
+}
+
+
+@dataclasses.dataclass
+class InteractionStats:
+    """1回の応答生成(またはリクエスト)の間に計測した情報
+
+    対話ログやフライトレコーダーに記録する。入れ子にした場合は親にも同じ値を記録する。
+    """
+
+    stage_durations: dict[str, float] = dataclasses.field(default_factory=dict)
+    prompt_tokens: int = 0
+    response_tokens: int = 0
+    cache_hits: dict[str, bool] = dataclasses.field(default_factory=dict)
+    question: str | None = None
+    llm_calls: list[dict] = dataclasses.field(default_factory=list)
+    retrieval_candidates: dict[str, list[dict]] = dataclasses.field(default_factory=dict)
+    parent: "InteractionStats | None" = dataclasses.field(default=None, repr=False)
+
+    def breakdown(self) -> dict[str, float]:
+        """LOGGED_STAGES ごとの所要時間(秒)"""
+        return {name: sum(self.stage_durations.get(stage, 0.0) for stage in stages) for name, stages in LOGGED_STAGES.items()}
+
+
+interaction_stats_var: contextvars.ContextVar[InteractionStats | None] = contextvars.ContextVar("interaction_stats", default=None)
+
+# /metrics で出力するメトリクス(作成時に登録する)
+REGISTRY: list["_Metric"] = []
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0)
+
+
+class _Metric(abc.ABC):
+    """Prometheus のテキスト形式で出力できるメトリクスの基底クラス
+
+    作成すると registry(省略した場合は REGISTRY)に登録する。registry=None の場合は登録しない
+    """
+
+    type_name = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str], *, registry: list["_Metric"] | None = REGISTRY) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        if registry is not None:
+            if any(metric.name == name for metric in registry):
+                raise ValueError(f"Duplicated metric name: {name}")
+            registry.append(self)
+
+    def render(self) -> list[str]:
+        """Prometheus のテキスト形式の行を返す"""
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}", *self._render_samples()]
+
+    @abc.abstractmethod
+    def _render_samples(self) -> list[str]:
+        """メトリクスの値の行(メトリクスの種類ごとに実装する)"""
+
+    def _label_values(self, labels: dict[str, str]) -> tuple[str, ...]:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _format_labels(self, values: tuple[str, ...], extra: dict[str, str] | None = None) -> str:
+        pairs = list(zip(self.labelnames, values, strict=True)) + list((extra or {}).items())
+        if not pairs:
+            return ""
+        escaped = (f'{name}="{_escape(value)}"' for name, value in pairs)
+        return "{" + ",".join(escaped) + "}"
+
+
+class Counter(_Metric):
+    """単調増加するカウンタ"""
+
+    type_name = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), *, registry: list[_Metric] | None = REGISTRY) -> None:
+        super().__init__(name, documentation, labelnames, registry=registry)
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        """カウンタを増やす"""
+        key = self._label_values(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels: str) -> float:
+        """現在の値"""
+        with self._lock:
+            return self._values.get(self._label_values(labels), 0.0)
+
+    def _render_samples(self) -> list[str]:
+        with self._lock:
+            return [f"{self.name}{self._format_labels(key)} {_format_value(value)}" for key, value in sorted(self._values.items())]
+
+
+class Histogram(_Metric):
+    """所要時間などの分布を記録するヒストグラム"""
+
+    type_name = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+        *,
+        registry: list[_Metric] | None = REGISTRY,
+    ) -> None:
+        super().__init__(name, documentation, labelnames, registry=registry)
+        self._buckets = tuple(sorted(buckets))
+        # ラベルごとに [各バケットの件数..., +Inf の件数], 合計値
+        self._counts: dict[tuple[str, ...], list[int]] = {}
+        self._sums: dict[tuple[str, ...], float] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        """値を記録する"""
+        key = self._label_values(labels)
+        index = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            counts = self._counts.setdefault(key, [0] * (len(self._buckets) + 1))
+            counts[index] += 1
+            self._sums[key] = self._sums.get(key, 0.0) + value
+
+    def _render_samples(self) -> list[str]:
+        lines = []
+        with self._lock:
+            for key, counts in sorted(self._counts.items()):
+                cumulative = 0
+                for bound, count in zip((*self._buckets, math.inf), counts, strict=True):
+                    cumulative += count
+                    le = "+Inf" if bound == math.inf else _format_value(bound)
+                    lines.append(f"{self.name}_bucket{self._format_labels(key, {'le': le})} {cumulative}")
+                lines.append(f"{self.name}_sum{self._format_labels(key)} {_format_value(self._sums[key])}")
+                lines.append(f"{self.name}_count{self._format_labels(key)} {cumulative}")
+        return lines
+
+
+STAGE_DURATION = Histogram(
+    "aituber_stage_duration_seconds",
+    "Duration of each processing stage",
+    ["stage", "endpoint", "doc_retrieval_type"],
+)
+STAGE_ERRORS = Counter(
+    "aituber_stage_errors_total",
+    "Number of processing stages that raised an exception",
+    ["stage", "endpoint", "doc_retrieval_type"],
+)
+HTTP_REQUEST_DURATION = Histogram(
+    "aituber_http_request_duration_seconds",
+    "Duration of HTTP requests",
+    ["endpoint", "method"],
+)
+HTTP_REQUESTS = Counter(
+    "aituber_http_requests_total",
+    "Number of HTTP requests",
+    ["endpoint", "method", "status"],
+)
+
+
+@contextlib.contextmanager
+def observe_stage(stage: str) -> Iterator[None]:
+    """処理ステージの所要時間を記録する(トレースの Span も作る)
+
+    ラベルの endpoint と doc_retrieval_type は contextvars から取得する
+    """
+    labels = {"stage": stage, "endpoint": endpoint_var.get(), "doc_retrieval_type": doc_retrieval_type_var.get()}
+    started_at = time.perf_counter()
+    try:
+        with tracer.start_span(stage):
+            yield
+    except Exception:
+        STAGE_ERRORS.inc(**labels)
+        raise
+    finally:
+        elapsed = time.perf_counter() - started_at
+        STAGE_DURATION.observe(elapsed, **labels)
+        for stats in _active_interaction_stats():
+            stats.stage_durations[stage] = stats.stage_durations.get(stage, 0.0) + elapsed
+
+
+@contextlib.contextmanager
+def collect_interaction_stats() -> Iterator[InteractionStats]:
+    """with ブロック内の処理で計測した情報を InteractionStats に集める
+
+    既に InteractionStats がある場合(リクエスト全体など)は、その子にする
+    """
+    stats = InteractionStats(parent=interaction_stats_var.get())
+    token = interaction_stats_var.set(stats)
+    try:
+        yield stats
+    finally:
+        interaction_stats_var.reset(token)
+
+
+def record_question(question: str) -> None:
+    """質問文を記録する"""
+    for stats in _active_interaction_stats():
+        stats.question = question
+
+
+def record_llm_call(*, lane: str, prompt_chars: int, prompt_tokens: int, response_tokens: int) -> None:
+    """LLM の呼び出しとトークン数を記録する"""
+    for stats in _active_interaction_stats():
+        stats.prompt_tokens += prompt_tokens
+        stats.response_tokens += response_tokens
+        stats.llm_calls.append({"lane": lane, "prompt_chars": prompt_chars, "prompt_tokens": prompt_tokens, "response_tokens": response_tokens})
+
+
+def record_cache_hit(name: str, hit: bool) -> None:
+    """キャッシュにヒットしたかを記録する"""
+    for stats in _active_interaction_stats():
+        stats.cache_hits[name] = hit
+
+
+def record_retrieval_candidates(name: str, candidates: list[dict]) -> None:
+    """検索で得た候補を記録する"""
+    for stats in _active_interaction_stats():
+        stats.retrieval_candidates[name] = candidates
+
+
+def _active_interaction_stats() -> Iterator[InteractionStats]:
+    stats = interaction_stats_var.get()
+    while stats is not None:
+        yield stats
+        stats = stats.parent
+
+
+def render_metrics() -> str:
+    """全メトリクスを Prometheus のテキスト形式で返す"""
+    lines = [line for metric in REGISTRY for line in metric.render()]
+    return "\n".join(lines) + "\n"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == int(value):
+        return f"{int(value)}.0"
+    return repr(value)
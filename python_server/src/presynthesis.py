@@ -0,0 +1,84 @@
+import asyncio
+import logging
+from collections.abc import Callable
+
+from src.config import settings
+from src.gpt import DEFAULT_NG_MESSAGE
+from src.templates import TEMPLATE_MESSAGES, TEMPLATE_QUESTIONS
+from src.text_to_speech import TextToSpeech
+from src.tts_cache import audio_cache_key
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Presynthesizer:
+    """決まった文言の音声を、サーバーの起動後にバックグラウンドで合成しておく
+
+    合成した音声は TTS のキャッシュに保存されるので、次回以降の起動ではキャッシュから読むだけで済む。
+    文言と声の組ごとに音声 ID を振り、GET /voice/presynthesized/{audio_id} で音声を取得できるようにする
+    """
+
+    def __init__(self, texts: list[str], voices: list[str], *, concurrency: int = 2, text_to_speech_factory: Callable[[], TextToSpeech] = TextToSpeech) -> None:
+        self._voices = voices
+        self._concurrency = concurrency
+        self._text_to_speech_factory = text_to_speech_factory
+        # 音声 ID -> (声, 文言)
+        self._entries = {self.audio_id(voice, text): (voice, text) for text in dict.fromkeys(text for text in texts if text) for voice in voices}
+        # 合成が終わった音声 ID
+        self._ready: set[str] = set()
+        self._task: asyncio.Task | None = None
+
+    @staticmethod
+    def audio_id(voice: str, text: str) -> str:
+        """文言と声から作る音声 ID"""
+        return audio_cache_key(text, presynthesized_voice=voice)
+
+    def start(self) -> None:
+        """バックグラウンドで合成を始める(イベントループの中で呼ぶ)"""
+        if self._task is None and self._entries:
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        """合成の途中でも止める"""
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+    async def run(self) -> None:
+        """まだ合成していない音声を、最大 concurrency 件ずつ合成する"""
+        semaphore = asyncio.Semaphore(self._concurrency)
+
+        async def synthesize(audio_id: str) -> None:
+            async with semaphore:
+                voice, text = self._entries[audio_id]
+                text_to_speech = self._text_to_speech_factory()
+                try:
+                    await text_to_speech.voice_wav(voice, text)
+                except Exception as e:
+                    LOGGER.warning("Failed to presynthesize %r with voice %s: %r", text, voice, e)
+                    return
+                self._ready.add(audio_id)
+
+        await asyncio.gather(*(synthesize(audio_id) for audio_id in self._entries if audio_id not in self._ready))
+        LOGGER.info("Presynthesized %d/%d voices", len(self._ready), len(self._entries))
+
+    def lookup(self, audio_id: str) -> tuple[str, str] | None:
+        """音声 ID の (声, 文言)。知らない ID の場合は None"""
+        return self._entries.get(audio_id)
+
+    def audio_ids(self, text: str) -> dict[str, str]:
+        """文言の合成済みの音声 ID(声 -> 音声 ID)"""
+        audio_ids = {voice: self.audio_id(voice, text) for voice in self._voices}
+        return {voice: audio_id for voice, audio_id in audio_ids.items() if audio_id in self._ready}
+
+    def snapshot(self) -> dict[str, int]:
+        """合成の進み具合"""
+        return {"ready": len(self._ready), "total": len(self._entries)}
+
+
+presynthesizer = Presynthesizer(
+    [*TEMPLATE_MESSAGES, *TEMPLATE_QUESTIONS, DEFAULT_NG_MESSAGE],
+    settings.PRESYNTHESIS_VOICES,
+    concurrency=settings.PRESYNTHESIS_CONCURRENCY,
+)
@@ -0,0 +1,110 @@
+import asyncio
+import collections
+import sys
+import threading
+import types
+
+# 1回のプロファイリングで許可する最長の時間(秒)
+MAX_PROFILE_SECONDS = 60.0
+
+
+class SamplingProfiler:
+    """スレッドのスタックを一定間隔でサンプリングするプロファイラ
+
+    結果は flamegraph.pl や speedscope で読める collapsed stack 形式で出力する。
+    asyncio の待機中のコルーチンはスタックに現れないため、イベントループのスレッドで CPU を使っている箇所を見るのに使う。
+
+    Args:
+        thread_ids: サンプリングするスレッド(省略した場合は全スレッド)
+    """
+
+    def __init__(self, *, interval: float = 0.005, thread_ids: set[int] | None = None) -> None:
+        self._interval = interval
+        self._thread_ids = thread_ids
+        self._stacks: collections.Counter[str] = collections.Counter()
+        self._stop_event = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    @property
+    def samples(self) -> int:
+        """取得したサンプル数"""
+        return sum(self._stacks.values())
+
+    def start(self) -> None:
+        """サンプリングを開始する"""
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """サンプリングを終了する"""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def collapsed(self) -> str:
+        """collapsed stack 形式("frame;frame;frame count" の行)で返す"""
+        return "".join(f"{stack} {count}\n" for stack, count in sorted(self._stacks.items()))
+
+    def _run(self) -> None:
+        own_thread_id = threading.get_ident()
+        while not self._stop_event.wait(self._interval):
+            thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_thread_id or (self._thread_ids is not None and thread_id not in self._thread_ids):
+                    continue
+                stack = [thread_names.get(thread_id, str(thread_id)), *_frame_labels(frame)]
+                self._stacks[";".join(stack)] += 1
+
+
+async def profile_for(seconds: float, *, interval: float = 0.005) -> SamplingProfiler:
+    """指定した秒数だけプロファイリングする"""
+    profiler = SamplingProfiler(interval=interval)
+    profiler.start()
+    try:
+        await asyncio.sleep(min(seconds, MAX_PROFILE_SECONDS))
+    finally:
+        profiler.stop()
+    return profiler
+
+
+class ProfileStore:
+    """リクエスト単位で取得したプロファイルを trace ID ごとに直近 max_profiles 件保持する"""
+
+    def __init__(self, max_profiles: int = 50) -> None:
+        self._max_profiles = max_profiles
+        self._profiles: collections.OrderedDict[str, str] = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def put(self, trace_id: str, collapsed: str) -> None:
+        """プロファイルを保存する"""
+        with self._lock:
+            self._profiles[trace_id] = collapsed
+            while len(self._profiles) > self._max_profiles:
+                self._profiles.popitem(last=False)
+
+    def get(self, trace_id: str) -> str | None:
+        """プロファイルを取得する"""
+        with self._lock:
+            return self._profiles.get(trace_id)
+
+
+def _frame_labels(frame: types.FrameType | None) -> list[str]:
+    """呼び出し元から順にフレームのラベルを返す"""
+    labels = []
+    while frame is not None:
+        code = frame.f_code
+        labels.append(f"{code.co_name} ({_short_path(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    labels.reverse()
+    return labels
+
+
+def _short_path(filename: str) -> str:
+    # site-packages 以下はパッケージからの相対パスにする
+    _, sep, rest = filename.rpartition("site-packages/")
+    return rest if sep else filename
+
+
+profile_store = ProfileStore()
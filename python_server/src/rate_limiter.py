@@ -0,0 +1,151 @@
+import asyncio
+import collections
+import contextlib
+import time
+from collections.abc import AsyncIterator
+from enum import IntEnum
+from typing import Any
+
+
+class GeminiLane(IntEnum):
+    """Gemini 呼び出しの優先レーン(値が小さいほど優先度が高い)"""
+
+    # 視聴者への回答生成
+    reply = 0
+    # リランク・ハルシネーションチェック
+    verification = 1
+    # コメントフィルタリング・評価
+    background = 2
+
+
+class RateLimitExceeded(Exception):
+    """レートリミッタの待ち行列から溢れたリクエストが破棄された"""
+
+    def __init__(self, lane: GeminiLane) -> None:
+        super().__init__(f"Request in the '{lane.name}' lane was shed by the rate limiter")
+        self.lane = lane
+
+
+class PriorityRateLimiter:
+    """優先レーン付きのトークンバケット
+
+    トークンが不足している間、リクエストはレーンごとの待ち行列に積まれ、優先度の高いレーンから順にトークンを受け取る。
+    待ち行列の合計が max_queue_depth を超えた場合は、最も優先度の低いレーンの最後尾から破棄する。
+    最優先レーン(reply)は破棄しない。
+    """
+
+    def __init__(self, *, rate_per_sec: float, burst: int, max_queue_depth: int) -> None:
+        if rate_per_sec <= 0:
+            raise ValueError("rate_per_sec must be positive")
+        if burst < 1:
+            raise ValueError("burst must be at least 1")
+
+        self._rate_per_sec = rate_per_sec
+        self._burst = burst
+        self._max_queue_depth = max_queue_depth
+
+        self._tokens = float(burst)
+        self._updated_at = time.monotonic()
+        self._waiters: dict[GeminiLane, collections.deque[asyncio.Future[None]]] = {lane: collections.deque() for lane in GeminiLane}
+        self._shed_counts: dict[GeminiLane, int] = dict.fromkeys(GeminiLane, 0)
+        self._dispatcher: asyncio.Task[None] | None = None
+
+    @contextlib.asynccontextmanager
+    async def acquire(self, lane: GeminiLane) -> AsyncIterator[None]:
+        """トークンを1つ取得するまで待つ
+
+        Raises:
+            RateLimitExceeded: 待ち行列から破棄された場合
+        """
+        await self._acquire(lane)
+        yield
+
+    def queue_depth(self) -> dict[str, int]:
+        """レーンごとの待ち行列の長さ"""
+        return {lane.name: sum(1 for waiter in waiters if not waiter.done()) for lane, waiters in self._waiters.items()}
+
+    def snapshot(self) -> dict[str, Any]:
+        """現在の状態を返す(ステータス表示用)"""
+        self._refill()
+        return {
+            "tokens": round(self._tokens, 3),
+            "rate_per_sec": self._rate_per_sec,
+            "burst": self._burst,
+            "max_queue_depth": self._max_queue_depth,
+            "queue_depth": self.queue_depth(),
+            "shed": {lane.name: count for lane, count in self._shed_counts.items()},
+        }
+
+    async def _acquire(self, lane: GeminiLane) -> None:
+        self._refill()
+        if self._tokens >= 1 and not self._has_waiters():
+            self._tokens -= 1
+            return
+
+        waiter: asyncio.Future[None] = asyncio.get_running_loop().create_future()
+        self._waiters[lane].append(waiter)
+        self._shed_if_overflowed()
+        self._ensure_dispatcher()
+
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled() and waiter.exception() is None:
+                # トークンを受け取った直後にキャンセルされた場合は返却する
+                self._tokens = min(self._tokens + 1, self._burst)
+            raise
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self._burst, self._tokens + (now - self._updated_at) * self._rate_per_sec)
+        self._updated_at = now
+
+    def _has_waiters(self) -> bool:
+        return any(not waiter.done() for waiters in self._waiters.values() for waiter in waiters)
+
+    def _next_waiter(self) -> asyncio.Future[None] | None:
+        for lane in GeminiLane:
+            waiters = self._waiters[lane]
+            while waiters:
+                waiter = waiters.popleft()
+                if not waiter.done():
+                    return waiter
+        return None
+
+    def _shed_if_overflowed(self) -> None:
+        while sum(self.queue_depth().values()) > self._max_queue_depth:
+            shed = False
+            for lane in sorted(GeminiLane, reverse=True):
+                if lane == GeminiLane.reply:
+                    break
+                waiters = self._waiters[lane]
+                while waiters:
+                    waiter = waiters.pop()
+                    if not waiter.done():
+                        waiter.set_exception(RateLimitExceeded(lane))
+                        self._shed_counts[lane] += 1
+                        shed = True
+                        break
+                if shed:
+                    break
+            if not shed:
+                # reply レーンしか残っていない
+                return
+
+    def _ensure_dispatcher(self) -> None:
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.get_running_loop().create_task(self._dispatch())
+
+    async def _dispatch(self) -> None:
+        """トークンが補充され次第、優先度の高いレーンから待機中のリクエストを起こす"""
+        while self._has_waiters():
+            self._refill()
+            if self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self._rate_per_sec)
+                continue
+
+            waiter = self._next_waiter()
+            if waiter is None:
+                return
+            self._tokens -= 1
+            waiter.set_result(None)
@@ -0,0 +1,48 @@
+import functools
+import re
+
+import jaconv
+from janome.tokenizer import Tokenizer
+
+# 読みを固定する語(形態素解析で読みを誤りやすい固有名詞など)
+PRONUNCIATION_OVERRIDES = {
+    "安野": "あんの",
+}
+
+# 長い語を優先して一致させる
+_OVERRIDE_PATTERN = re.compile("|".join(re.escape(word) for word in sorted(PRONUNCIATION_OVERRIDES, key=len, reverse=True)))
+
+
+@functools.cache
+def get_tokenizer() -> Tokenizer:
+    """janome の Tokenizer(辞書の読み込みに時間がかかるので、プロセス内で1つだけ作る)"""
+    return Tokenizer()
+
+
+@functools.lru_cache(maxsize=1024)
+def convert_kanji_to_hiragana(text: str) -> str:
+    """テキストの漢字をひらがなにする(同じテキストの変換結果はキャッシュする)"""
+    parts = []
+    position = 0
+    for match in _OVERRIDE_PATTERN.finditer(text):
+        parts.extend(_tokenize_to_hiragana(text[position : match.start()]))
+        parts.append(PRONUNCIATION_OVERRIDES[match.group()])
+        position = match.end()
+    parts.extend(_tokenize_to_hiragana(text[position:]))
+    return "".join(parts)
+
+
+def _tokenize_to_hiragana(text: str) -> list[str]:
+    if not text:
+        return []
+    return [_token_to_hiragana(token.surface, token.reading) for token in get_tokenizer().tokenize(text)]
+
+
+@functools.lru_cache(maxsize=8192)
+def _token_to_hiragana(surface: str, reading: str) -> str:
+    if reading == "*":
+        # 記号や数字等の読みが取得できない場合はsurfaceをそのまま使う
+        return surface
+    if reading in (jaconv.kata2hira(surface), jaconv.hira2kata(surface)):
+        return surface
+    return jaconv.kata2hira(reading)
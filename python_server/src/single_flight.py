@@ -0,0 +1,188 @@
+import asyncio
+import collections
+import time
+from collections.abc import AsyncIterator, Awaitable, Callable
+from typing import Any, TypeVar
+
+from src.config import settings
+from src.metrics import Counter
+
+T = TypeVar("T")
+
+SINGLE_FLIGHT_REQUESTS = Counter(
+    "aituber_single_flight_requests_total",
+    "Number of requests that ran the computation (leader) or shared an in-flight one (follower)",
+    ["name", "role"],
+)
+SINGLE_FLIGHT_SAVED_SECONDS = Counter(
+    "aituber_single_flight_saved_seconds_total",
+    "Seconds of computation saved by sharing in-flight results",
+    ["name"],
+)
+
+
+class SharedStream:
+    """1つのバイト列のストリームを複数の読み手で共有する(読み手はそれぞれ最初から読む)
+
+    ストリームは読み手とは別のタスクで最後まで読むので、読み手が途中でいなくなっても止めない。
+    後から来た読み手のためにチャンクを保持するのは、読み終わるか max_replay_bytes を超えるまでで、
+    それ以降は新しい読み手を受け付けず(joinable が False になる)、全ての読み手が読んだチャンクから捨てる
+    """
+
+    def __init__(self, chunks: AsyncIterator[bytes], *, context: Any = None, max_replay_bytes: int) -> None:
+        # 読み手に渡す付加情報(ストリームを作った側の TextToSpeech など)
+        self.context = context
+        self._max_replay_bytes = max_replay_bytes
+        self._chunks: collections.deque[bytes] = collections.deque()
+        # _chunks の先頭のチャンクの番号(捨てたチャンクの数)
+        self._offset = 0
+        self._received_bytes = 0
+        # 読み手ごとの次に読むチャンクの番号
+        self._positions: dict[object, int] = {}
+        self._error: BaseException | None = None
+        self._done = False
+        self._changed = asyncio.Event()
+        self._task = asyncio.create_task(self._pump(chunks))
+
+    @property
+    def joinable(self) -> bool:
+        """新しい読み手が最初から読めるか"""
+        return not self._done and self._received_bytes <= self._max_replay_bytes
+
+    def subscribe(self) -> AsyncIterator[bytes]:
+        """届いたチャンクを最初から順に返す
+
+        読み手は呼んだ時点で登録するので、返したイテレーターはすぐに読み始める(読み始めずに捨てると、ストリームが終わるまでチャンクを捨てられない)
+
+        Raises:
+            RuntimeError: 新しい読み手を受け付けなくなった後に呼んだ場合
+        """
+        if not self.joinable:
+            raise RuntimeError("The shared stream no longer keeps its first chunks")
+        # 読み始める前に捨てられないように、呼んだ時点で読み手として登録する
+        reader = object()
+        self._positions[reader] = 0
+        return self._read(reader)
+
+    async def _read(self, reader: object) -> AsyncIterator[bytes]:
+        try:
+            while True:
+                while self._positions[reader] < self._offset + len(self._chunks):
+                    chunk = self._chunks[self._positions[reader] - self._offset]
+                    self._positions[reader] += 1
+                    self._trim()
+                    yield chunk
+                if self._done:
+                    if self._error is not None:
+                        raise self._error
+                    return
+                await self._changed.wait()
+        finally:
+            del self._positions[reader]
+            self._trim()
+
+    async def _pump(self, chunks: AsyncIterator[bytes]) -> None:
+        try:
+            async for chunk in chunks:
+                self._chunks.append(chunk)
+                self._received_bytes += len(chunk)
+                self._trim()
+                self._notify()
+        except asyncio.CancelledError:
+            # 読み手には途中で途切れたことを伝える(読み手自身がキャンセルされたのではないので CancelledError にはしない)
+            self._error = RuntimeError("The shared stream was cancelled")
+            raise
+        except Exception as e:
+            self._error = e
+        finally:
+            self._done = True
+            self._trim()
+            self._notify()
+
+    def _trim(self) -> None:
+        """新しい読み手を受け付けなくなったら、全ての読み手が読んだチャンクを捨てる"""
+        if self.joinable:
+            return
+        read_until = min(self._positions.values(), default=self._offset + len(self._chunks))
+        while self._offset < read_until:
+            self._chunks.popleft()
+            self._offset += 1
+
+    def _notify(self) -> None:
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+
+class SingleFlight:
+    """同じキーの処理が実行中の場合は、新しく実行せずに実行中の処理の結果を共有する
+
+    リトライや複数の画面からの同じリクエストで、外部 API を重ねて呼ばないようにする。
+    処理は呼び出し元とは別のタスクで実行するので、最初の呼び出し元がキャンセルされても他の呼び出し元には影響しない
+    """
+
+    def __init__(self, name: str, *, max_replay_bytes: int = settings.SINGLE_FLIGHT_MAX_REPLAY_BYTES) -> None:
+        self.name = name
+        self._max_replay_bytes = max_replay_bytes
+        self._in_flight: dict[str, asyncio.Task | SharedStream] = {}
+        # 実行中の処理ごとの、結果を共有した呼び出し元の数
+        self._followers: dict[asyncio.Task | SharedStream, int] = {}
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[T]]) -> T:
+        """fn() の結果を返す(同じキーの処理が実行中の場合はその結果を返す。例外も共有する)"""
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._start(key, task, task)
+        else:
+            self._follow(task)
+        return await asyncio.shield(task)
+
+    def stream(self, key: str, open_stream: Callable[[], AsyncIterator[bytes]], *, context: Any = None) -> SharedStream:
+        """open_stream で開いたストリームを共有する
+
+        同じキーのストリームを読んでいる途中で、まだ最初から読める場合は、新しく開かずにそれを返す
+        """
+        shared = self._in_flight.get(key)
+        if shared is None or not shared.joinable:
+            shared = SharedStream(open_stream(), context=context, max_replay_bytes=self._max_replay_bytes)
+            self._start(key, shared, shared._task)
+        else:
+            self._follow(shared)
+        return shared
+
+    def snapshot(self) -> dict[str, Any]:
+        """実行中の処理の数と、これまでに共有した回数・省けた時間(ステータス表示用)"""
+        return {
+            "in_flight": len(self._in_flight),
+            "leaders": int(SINGLE_FLIGHT_REQUESTS.value(name=self.name, role="leader")),
+            "followers": int(SINGLE_FLIGHT_REQUESTS.value(name=self.name, role="follower")),
+            "saved_seconds": SINGLE_FLIGHT_SAVED_SECONDS.value(name=self.name),
+        }
+
+    def _start(self, key: str, entry: asyncio.Task | SharedStream, task: asyncio.Future) -> None:
+        SINGLE_FLIGHT_REQUESTS.inc(name=self.name, role="leader")
+        started_at = time.perf_counter()
+        self._in_flight[key] = entry
+        self._followers[entry] = 0
+
+        def finish(_: asyncio.Future) -> None:
+            # 呼び出し元が全てキャンセルされた場合に、例外が取り出されなかったという警告を出さないようにする
+            if not task.cancelled():
+                task.exception()
+            # 途中から同じキーで新しく始めた処理は残す
+            if self._in_flight.get(key) is entry:
+                del self._in_flight[key]
+            followers = self._followers.pop(entry)
+            if followers:
+                # 共有した呼び出し元は、それぞれ同じ時間の処理を省けたとみなす
+                SINGLE_FLIGHT_SAVED_SECONDS.inc((time.perf_counter() - started_at) * followers, name=self.name)
+
+        task.add_done_callback(finish)
+
+    def _follow(self, entry: asyncio.Task | SharedStream) -> None:
+        SINGLE_FLIGHT_REQUESTS.inc(name=self.name, role="follower")
+        self._followers[entry] += 1
+
+
+reply_flight = SingleFlight("reply")
+voice_flight = SingleFlight("voice")
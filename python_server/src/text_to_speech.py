@@ -1,33 +1,214 @@
+import asyncio
+import collections
+import functools
 import json
-from collections.abc import AsyncIterator
+import logging
+import re
+from collections.abc import AsyncIterator, Awaitable, Callable
 
-import jaconv
+import numpy as np
 from elevenlabs import VoiceSettings
 from elevenlabs.client import AsyncElevenLabs
-from janome.tokenizer import Tokenizer
 
-from src.azure_speech_synthesizer import AzureSpeechSynthesizer, add_wav_header
+from src.azure_speech_synthesizer import WAV_HEADER_SIZE, WavBuffer, add_wav_header, azure_synthesizer_pool, wav_header
+from src.circuit_breaker import azure_breaker, elevenlabs_breaker
 from src.config import settings
+from src.latency_tracker import LatencyTracker, azure_tts_latency, elevenlabs_sts_latency, elevenlabs_tts_latency
+from src.metrics import Counter, observe_stage
+from src.reading import convert_kanji_to_hiragana
+from src.tts_cache import audio_cache_key, tts_cache
+
+LOGGER = logging.getLogger(__name__)
+
+TTS_PROVIDER_SELECTIONS = Counter(
+    "aituber_tts_provider_selections_total",
+    "Number of times each TTS provider was used in the provider chain",
+    ["provider", "hedged"],
+)
+
+# ElevenLabs が使えない場合に代わりに使う Azure の音声
+FALLBACK_AZURE_VOICE_NAME = "ja-JP-KeitaNeural"
+
+ELEVENLABS_TTS_MODEL_ID = "eleven_multilingual_v2"
+ELEVENLABS_TTS_VOICE_SETTINGS = {
+    "stability": 0.7,
+    "similarity_boost": 1.0,
+    "style": 0.0,
+    "use_speaker_boost": True,
+}
+
+# Azure TTS -> ElevenLabs STS で、元の音声の合成に使う Azure の声
+STS_SOURCE_AZURE_VOICE = {"voice_name": "ja-JP-KeitaNeural", "pitch": "+10%", "rate": "-5%"}
+ELEVENLABS_STS_MODEL_ID = "eleven_multilingual_sts_v2"
+ELEVENLABS_STS_VOICE_SETTINGS = {
+    "stability": 0.9,
+    "similarity_boost": 1.0,
+    "style": 0.0,
+    "use_speaker_boost": True,
+}
+
+# 各エンドポイントで使う Azure の声(起動時に AzureSpeechSynthesizer を作っておく)
+AZURE_VOICES = [
+    {"voice_name": "ja-JP-NanamiNeural", "pitch": "+10%", "rate": "+10%"},
+    {"voice_name": FALLBACK_AZURE_VOICE_NAME, "pitch": "+10%", "rate": "+10%"},
+    STS_SOURCE_AZURE_VOICE,
+]
+
+# 文末(句点・感嘆符・疑問符と、その後に続く閉じ括弧)までを1文とする
+_SENTENCE_PATTERN = re.compile(r"[^。！？!?\n]*[。！？!?]+[」』）)]*|[^。！？!?\n]+")
 
 client = AsyncElevenLabs(
     api_key=settings.ELEVENLABS_API_KEY,
 )
 
 
+def split_sentences(text: str) -> list[str]:
+    """テキストを文に分割する(文末の記号は文に含める)"""
+    return [sentence for match in _SENTENCE_PATTERN.finditer(text) if (sentence := match.group().strip())]
+
+
+class StreamInterruptedError(Exception):
+    """ElevenLabs の音声を途中まで返した後で合成に失敗した(返した音声は取り消せない)"""
+
+
+class AudioPostProcessor:
+    """合成した音声(16bit, mono の PCM)の前後の無音を削り、音量をそろえる
+
+    チャンクを受け取った順に処理できるので、ストリーミング中にも使える。
+    - 無音: 10ms ごとの RMS が silence_threshold_dbfs 未満の区間。前後に pad_seconds 秒だけ残して削る
+    - 音量: 音声の始まりから gain_window_seconds 秒のうち、有音のフレームの RMS が target_rms_dbfs になるゲインを決め、以降は同じゲインをかける
+      (ゲインが決まるまでの音声は溜めておく。最大 max_gain_db まで、音割れしない範囲で増減する)
+    - 音割れ: 後から大きな音が来て、そのままのゲインでは音割れするフレームがあれば、そのフレームから音割れしないゲインに下げる
+    """
+
+    def __init__(
+        self,
+        *,
+        sample_rate: int,
+        enabled: bool = True,
+        silence_threshold_dbfs: float = -60.0,
+        pad_seconds: float = 0.05,
+        target_rms_dbfs: float = -20.0,
+        max_gain_db: float = 12.0,
+        gain_window_seconds: float = 0.3,
+    ) -> None:
+        self._enabled = enabled
+        # 10ms ごとのフレームで判定する
+        self._frame_size = sample_rate // 100
+        self._pad_frames = round(pad_seconds * 100)
+        self._silence_threshold = 32768 * 10 ** (silence_threshold_dbfs / 20)
+        self._target_rms = 32768 * 10 ** (target_rms_dbfs / 20)
+        self._max_gain = 10 ** (max_gain_db / 20)
+        self._gain_window_frames = round(gain_window_seconds * 100)
+
+        # フレームに満たない端数のバイト列
+        self._remainder = b""
+        self._started = False
+        # 音声が始まる前の無音(直前の pad 分だけ残す)
+        self._leading: collections.deque[np.ndarray] = collections.deque(maxlen=self._pad_frames)
+        # 最後の有音のフレームより後の無音(続きに有音があれば出力し、なければ pad 分だけ残す)
+        self._trailing: list[np.ndarray] = []
+        # ゲインが決まるまで溜めておくフレーム
+        self._held: list[np.ndarray] = []
+        self._gain: float | None = None
+
+    def process(self, chunk: bytes) -> bytes:
+        """チャンクを処理して、出力できる分の PCM を返す(溜めておく分は返さない)"""
+        if not self._enabled:
+            return chunk
+
+        data = self._remainder + chunk
+        usable_size = len(data) - len(data) % (self._frame_size * 2)
+        self._remainder = data[usable_size:]
+        if not usable_size:
+            return b""
+        # frombuffer はコピーせずにチャンクのバイト列をそのまま参照する
+        frames = np.frombuffer(data, dtype="<i2", count=usable_size // 2).reshape(-1, self._frame_size)
+        loud_indices = np.flatnonzero(self._frame_rms(frames) >= self._silence_threshold)
+
+        if not self._started:
+            if not len(loud_indices):
+                self._leading.extend(frames[-self._pad_frames :])
+                return b""
+            first = loud_indices[0]
+            self._started = True
+            leading = np.concatenate([np.array(self._leading, dtype="<i2").reshape(-1, self._frame_size), frames[:first]])
+            self._trailing = [leading[len(leading) - self._pad_frames :]]
+            frames = frames[first:]
+            loud_indices = loud_indices - first
+
+        if not len(loud_indices):
+            self._trailing.append(frames)
+            return b""
+        last = loud_indices[-1] + 1
+        voiced = [*self._trailing, frames[:last]]
+        self._trailing = [frames[last:]]
+        return self._apply_gain(voiced)
+
+    def flush(self) -> bytes:
+        """最後に呼び出して、溜めておいた PCM を返す(末尾の無音は pad 分だけ残す)"""
+        if not self._enabled or not self._started:
+            return b""
+        self._held.append(np.concatenate(self._trailing)[: self._pad_frames])
+        self._trailing = []
+        if self._gain is None:
+            self._gain = self._decide_gain(np.concatenate(self._held))
+        held, self._held = self._held, []
+        return self._to_bytes(held)
+
+    def _apply_gain(self, frames: list[np.ndarray]) -> bytes:
+        if self._gain is None:
+            self._held.extend(frames)
+            if sum(len(held) for held in self._held) < self._gain_window_frames:
+                return b""
+            # チャンクの区切り方によらないように、最初の gain_window_seconds 秒だけで決める
+            self._gain = self._decide_gain(np.concatenate(self._held)[: self._gain_window_frames])
+            frames, self._held = self._held, []
+        return self._to_bytes(frames)
+
+    def _decide_gain(self, frames: np.ndarray) -> float:
+        """有音のフレームの RMS を目標にそろえるゲイン(音割れしない範囲に収める)"""
+        loud = frames[self._frame_rms(frames) >= self._silence_threshold]
+        if not len(loud):
+            return 1.0
+        gain = self._target_rms / float(np.sqrt(np.mean(loud.astype(np.float32) ** 2)))
+        peak = max(int(np.abs(loud.astype(np.int32)).max()), 1)
+        return float(np.clip(gain, 1 / self._max_gain, min(self._max_gain, 32767 / peak)))
+
+    def _to_bytes(self, frames: list[np.ndarray]) -> bytes:
+        frames_array = np.concatenate(frames)
+        if self._gain == 1.0 or not len(frames_array):
+            return frames_array.tobytes()
+        if self._gain < 1.0:
+            return (frames_array * self._gain).astype("<i2").tobytes()
+        # ゲインは最初の gain_window_seconds 秒で決めるので、後から来た大きな音は音割れしうる。
+        # フレームごとに音割れしないゲインを求め、超えるフレームからは下げたゲインを使い続ける(フレーム単位なのでチャンクの区切り方によらない)
+        peaks = np.maximum(np.abs(frames_array.astype(np.int32)).max(axis=1), 1)
+        gains = np.minimum.accumulate(np.minimum(self._gain, 32767 / peaks))
+        self._gain = float(gains[-1])
+        return np.clip(frames_array * gains[:, None], -32768, 32767).astype("<i2").tobytes()
+
+    @staticmethod
+    def _frame_rms(frames: np.ndarray) -> np.ndarray:
+        return np.sqrt(np.mean(frames.astype(np.float32) ** 2, axis=1))
+
+
 class TextToSpeech:
     """TextToSpeech を行うクラス
 
     いくつか手法があるが、このクラスにまとめておく
     """
 
-    def __init__(self):
+    def __init__(self, sample_rate: int = 44100):
         self._client = AsyncElevenLabs(
             api_key=settings.ELEVENLABS_API_KEY,
         )
 
-        self._sample_rate = 44100
+        self._sample_rate = sample_rate
         # 学習済みモデルのID(あんのボイス)
         self._elevenlabs_voice_id = "tyMlTSDYc5JhCakLJuAX"
+        # hedged_pcm_chunks と voice_wav で使ったプロバイダー(合成した順)
+        self.providers: list[str] = []
 
     @property
     def output_format(self) -> str:
@@ -37,77 +218,388 @@ class TextToSpeech:
         """
         return f"pcm_{self._sample_rate}"
 
-    async def text_to_speech_stream(self, text: str) -> bytes:
-        """入力テキストを音声(WAV)に変換する"""
-        text = self._convert_kanji_to_hiragana(text)
-        stream = client.text_to_speech.convert_as_stream(
+    def voice_pcm_chunks(self, voice: str) -> Callable[[str], AsyncIterator[bytes]]:
+        """声(/voice, /voice/v2, /voice/azure, /voice/male に対応する v1, v2, azure, male と、/voice?hedge=1 の hedged)ごとの合成方法"""
+        voices: dict[str, Callable[[str], AsyncIterator[bytes]]] = {
+            "v1": self.text_to_speech_pcm_chunks,
+            "hedged": self.hedged_pcm_chunks,
+            "v2": self.text_to_speech_with_azure_tts_pcm_chunks,
+            "azure": self.azure_text_to_speech_pcm_chunks,
+            "male": functools.partial(self.azure_text_to_speech_pcm_chunks, voice_name="ja-JP-KeitaNeural"),
+        }
+        return voices[voice]
+
+    async def voice_wav(self, voice: str, text: str, pcm_chunks: AsyncIterator[bytes] | None = None) -> memoryview:
+        """声ごとの合成方法で音声(WAV)に変換する
+
+        ElevenLabs の音声が途中で途切れた場合は、途中までの音声を捨てて Azure TTS で最初から合成し直し、self.providers を azure にする
+        (返しながら合成する場合は、返した音声を取り消せないのでそこで打ち切るしかない)
+
+        Args:
+            pcm_chunks: 合成中の PCM(共有しているストリームなど)。省略した場合は voice の合成方法で合成する
+        """
+        if pcm_chunks is None:
+            pcm_chunks = self.voice_pcm_chunks(voice)(text)
+        try:
+            return await self.collect_wav(pcm_chunks)
+        except StreamInterruptedError as e:
+            LOGGER.warning("ElevenLabs stream was interrupted, so synthesize the whole text again with Azure TTS: %r", e.__cause__)
+            fallbacks: dict[str, Callable[[str], AsyncIterator[bytes]]] = {
+                "v1": functools.partial(self.azure_text_to_speech_pcm_chunks, voice_name=FALLBACK_AZURE_VOICE_NAME),
+                "hedged": functools.partial(self.azure_text_to_speech_pcm_chunks, voice_name=FALLBACK_AZURE_VOICE_NAME),
+                # STS に失敗した場合と同じく、STS に入力する Azure TTS の音声を返す
+                "v2": functools.partial(self.azure_text_to_speech_pcm_chunks, **STS_SOURCE_AZURE_VOICE),
+            }
+            if voice not in fallbacks:
+                raise
+            audio = await self.collect_wav(fallbacks[voice](text))
+            # 途中までの ElevenLabs の音声は捨てたので、返す音声は全て Azure TTS のもの
+            self.providers = ["azure"]
+            TTS_PROVIDER_SELECTIONS.inc(provider="azure", hedged="false")
+            return audio
+
+    async def text_to_speech_stream(self, text: str) -> memoryview:
+        """入力テキストを音声(WAV)に変換する
+
+        ElevenLabs が不調な場合は Azure TTS で代替する
+        """
+        return await self.voice_wav("v1", text)
+
+    async def text_to_speech_pcm_chunks(self, text: str, *, fallback: bool = True) -> AsyncIterator[bytes]:
+        """入力テキストを音声に変換し、PCM を届いた順に返す(text_to_speech_stream のストリーミング版)
+
+        Args:
+            fallback: ElevenLabs が不調な場合に Azure TTS で代替するか(しない場合は例外を送出する)
+        """
+        hiragana_text = self._convert_kanji_to_hiragana(text)
+        cache_key = audio_cache_key(
+            hiragana_text,
+            engine="elevenlabs_tts",
             voice_id=self._elevenlabs_voice_id,
+            model_id=ELEVENLABS_TTS_MODEL_ID,
+            voice_settings=ELEVENLABS_TTS_VOICE_SETTINGS,
             output_format=self.output_format,
-            text=text,
-            model_id="eleven_multilingual_v2",
-            voice_settings=VoiceSettings(
-                stability=0.7,
-                similarity_boost=1.0,
-                style=0.0,
-                use_speaker_boost=True,
+            postprocess=settings.TTS_POSTPROCESS,
+        )
+        if (audio := await tts_cache.aget(cache_key)) is not None:
+            yield memoryview(audio)[WAV_HEADER_SIZE:]
+            return
+
+        async def fall_back_to_azure(e: Exception) -> memoryview:
+            if not fallback:
+                raise e
+            LOGGER.warning("ElevenLabs TTS failed, so fall back to Azure TTS: %r", e)
+            return await self.azure_text_to_speech(text, voice_name=FALLBACK_AZURE_VOICE_NAME)
+
+        stream = self._stream_elevenlabs(
+            functools.partial(
+                client.text_to_speech.convert_as_stream,
+                voice_id=self._elevenlabs_voice_id,
+                output_format=self.output_format,
+                text=hiragana_text,
+                model_id=ELEVENLABS_TTS_MODEL_ID,
+                voice_settings=VoiceSettings(**ELEVENLABS_TTS_VOICE_SETTINGS),
             ),
+            stage="tts_elevenlabs",
+            latency=elevenlabs_tts_latency,
+            cache_key=cache_key,
+            fallback=fall_back_to_azure,
         )
+        async for chunk in stream:
+            yield chunk
 
-        return await self._stream_to_bytes(stream)
+    async def text_to_speech_with_azure_tts(self, text: str) -> memoryview:
+        """入力テキストを Azure TTS -> AsyncElevenLabs STSで音声(WAV)に変換する
 
-    async def text_to_speech_with_azure_tts(self, text: str) -> bytes:
-        """入力テキストを Azure TTS -> AsyncElevenLabs STSで音声(WAV)に変換する"""
-        speech_synthesizer = AzureSpeechSynthesizer()
-        tts_data = speech_synthesizer.speech_synthesis_to_audio_data_stream(text)
-        tts_data = add_wav_header(tts_data)
+        Azure が不調な場合は ElevenLabs TTS で、ElevenLabs が不調な場合は Azure TTS の結果をそのまま返す
+        """
+        return await self.voice_wav("v2", text)
 
-        stream = client.speech_to_speech.convert_as_stream(
+    async def text_to_speech_with_azure_tts_pcm_chunks(self, text: str) -> AsyncIterator[bytes]:
+        """入力テキストを Azure TTS -> AsyncElevenLabs STSで音声に変換し、PCM を届いた順に返す"""
+        cache_key = audio_cache_key(
+            text,
+            engine="azure_tts_elevenlabs_sts",
+            azure_voice=STS_SOURCE_AZURE_VOICE,
             voice_id=self._elevenlabs_voice_id,
-            audio=tts_data,
+            model_id=ELEVENLABS_STS_MODEL_ID,
+            voice_settings=ELEVENLABS_STS_VOICE_SETTINGS,
             output_format=self.output_format,
-            model_id="eleven_multilingual_sts_v2",
-            voice_settings=json.dumps(
-                {
-                    "stability": 0.9,
-                    "similarity_boost": 1.0,
-                    "style": 0.0,
-                    "use_speaker_boost": True,
-                }
+            postprocess=settings.TTS_POSTPROCESS,
+        )
+        if (audio := await tts_cache.aget(cache_key)) is not None:
+            yield memoryview(audio)[WAV_HEADER_SIZE:]
+            return
+
+        try:
+            tts_data = add_wav_header(await self._synthesize_with_azure(text, **STS_SOURCE_AZURE_VOICE), sample_rate=self._sample_rate)
+        except Exception as e:
+            LOGGER.warning("Azure TTS failed, so fall back to ElevenLabs TTS: %r", e)
+            async for chunk in self.text_to_speech_pcm_chunks(text):
+                yield chunk
+            return
+
+        async def return_azure_output(e: Exception) -> bytes:
+            LOGGER.warning("ElevenLabs STS failed, so return the Azure TTS output as it is: %r", e)
+            return tts_data
+
+        stream = self._stream_elevenlabs(
+            functools.partial(
+                client.speech_to_speech.convert_as_stream,
+                voice_id=self._elevenlabs_voice_id,
+                audio=tts_data,
+                output_format=self.output_format,
+                model_id=ELEVENLABS_STS_MODEL_ID,
+                voice_settings=json.dumps(ELEVENLABS_STS_VOICE_SETTINGS),
             ),
+            stage="sts_elevenlabs",
+            latency=elevenlabs_sts_latency,
+            cache_key=cache_key,
+            fallback=return_azure_output,
         )
+        async for chunk in stream:
+            yield chunk
+
+    async def sentence_parallel_pcm_chunks(
+        self,
+        text: str,
+        synthesize: Callable[[str], AsyncIterator[bytes]],
+        *,
+        concurrency: int = settings.TTS_SENTENCE_CONCURRENCY,
+        silence_seconds: float = settings.TTS_SENTENCE_SILENCE_SECONDS,
+    ) -> AsyncIterator[bytes]:
+        """テキストを文に分割して、最大 concurrency 文を並列に合成する
+
+        音声は文の順に、文の間に silence_seconds 秒の無音を挟んで返す。
+        先頭の文は合成できた分から返すので、後ろの文の合成を待たずに再生を始められる。
+        Azure TTS -> STS の場合は、1文目の STS と2文目の Azure TTS が並行して進む
+
+        Args:
+            synthesize: 1文を合成して PCM を返す関数(text_to_speech_pcm_chunks など)
+        """
+        sentences = split_sentences(text)
+        if len(sentences) <= 1:
+            async for chunk in synthesize(text):
+                yield chunk
+            return
+
+        semaphore = asyncio.Semaphore(concurrency)
+        queues: list[asyncio.Queue[bytes | None]] = [asyncio.Queue() for _ in sentences]
+
+        async def synthesize_sentence(sentence: str, queue: asyncio.Queue[bytes | None]) -> None:
+            async with semaphore:
+                try:
+                    async for chunk in synthesize(sentence):
+                        queue.put_nowait(chunk)
+                finally:
+                    # 終わり(失敗を含む)の目印
+                    queue.put_nowait(None)
+
+        # Semaphore は待った順に通すので、先頭の文から順に合成が始まる
+        tasks = [asyncio.create_task(synthesize_sentence(sentence, queue)) for sentence, queue in zip(sentences, queues, strict=True)]
+        silence = bytes(int(self._sample_rate * silence_seconds) * 2)
+        try:
+            for i, (task, queue) in enumerate(zip(tasks, queues, strict=True)):
+                if i:
+                    yield silence
+                # 先頭の文は届いた分から返し、後ろの文は合成しながら溜めておく
+                while (chunk := await queue.get()) is not None:
+                    yield chunk
+                # 合成に失敗した場合は例外を送出する
+                await task
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def hedged_pcm_chunks(self, text: str) -> AsyncIterator[bytes]:
+        """ElevenLabs TTS -> Azure TTS の順にプロバイダーを試し、最初に音声が届いたプロバイダーの PCM を返す
 
-        return await self._stream_to_bytes(stream)
+        最初の音声が期限までに届かない場合は次のプロバイダーでも合成を始め(ヘッジ)、先に届いた方を使う。
+        最初の音声の前に失敗した場合は、期限を待たずに次のプロバイダーに切り替える。
+        期限はプロバイダーごとの最初の音声までの時間の直近のパーセンタイルから決める。
+        使ったプロバイダーは self.providers に記録する
+        """
+        chain: list[tuple[str, Callable[[str], AsyncIterator[bytes]], LatencyTracker]] = [
+            ("elevenlabs", functools.partial(self.text_to_speech_pcm_chunks, fallback=False), elevenlabs_tts_latency),
+            ("azure", functools.partial(self.azure_text_to_speech_pcm_chunks, voice_name=FALLBACK_AZURE_VOICE_NAME), azure_tts_latency),
+        ]
+        loop = asyncio.get_running_loop()
+        queues: list[asyncio.Queue[bytes | Exception | None]] = []
+        tasks: list[asyncio.Task] = []
+        # 最初のチャンクを待っているプロバイダー(Queue.get のタスク -> chain の位置)
+        waiting: dict[asyncio.Task, int] = {}
+        hedge_at = 0.0
+
+        async def synthesize(synthesize_chunks: Callable[[str], AsyncIterator[bytes]], queue: asyncio.Queue[bytes | Exception | None]) -> None:
+            try:
+                async for chunk in synthesize_chunks(text):
+                    queue.put_nowait(chunk)
+            except Exception as e:
+                queue.put_nowait(e)
+            # 終わりの目印
+            queue.put_nowait(None)
+
+        def start_next() -> None:
+            nonlocal hedge_at
+            _, synthesize_chunks, latency = chain[len(tasks)]
+            queue: asyncio.Queue[bytes | Exception | None] = asyncio.Queue()
+            queues.append(queue)
+            tasks.append(asyncio.create_task(synthesize(synthesize_chunks, queue)))
+            waiting[asyncio.create_task(queue.get())] = len(tasks) - 1
+            hedge_at = loop.time() + self._hedge_deadline(latency)
+
+        winner: int | None = None
+        error: Exception | None = None
+        try:
+            start_next()
+            while winner is None:
+                can_hedge = len(tasks) < len(chain)
+                if not waiting:
+                    # 始めたプロバイダーが全て失敗した
+                    if not can_hedge:
+                        raise error or RuntimeError("No TTS provider returned audio")
+                    start_next()
+                    continue
+                timeout = max(hedge_at - loop.time(), 0) if can_hedge else None
+                done, _ = await asyncio.wait(waiting, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    LOGGER.info("No audio from %s before the deadline, so hedge with %s", chain[len(tasks) - 1][0], chain[len(tasks)][0])
+                    start_next()
+                    continue
+                # 同時に届いた場合は chain の前の方を優先する
+                for getter in sorted(done, key=waiting.__getitem__):
+                    index = waiting.pop(getter)
+                    item = getter.result()
+                    if item is None or isinstance(item, Exception):
+                        error = item or RuntimeError(f"{chain[index][0]} returned no audio")
+                        LOGGER.warning("TTS provider %s failed: %r", chain[index][0], error)
+                        if index == len(tasks) - 1 and len(tasks) < len(chain):
+                            start_next()
+                    elif winner is None:
+                        winner, first_chunk = index, item
+
+            name = chain[winner][0]
+            self.providers.append(name)
+            TTS_PROVIDER_SELECTIONS.inc(provider=name, hedged=str(len(tasks) > 1).lower())
+            # 使わないプロバイダーの合成は止める
+            for index, task in enumerate(tasks):
+                if index != winner:
+                    task.cancel()
 
-    async def azure_text_to_speech(self, text: str, voice_name="ja-JP-NanamiNeural", rate="+10%") -> bytes:
+            yield first_chunk
+            while (item := await queues[winner].get()) is not None:
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            for task in [*waiting, *tasks]:
+                task.cancel()
+            await asyncio.gather(*waiting, *tasks, return_exceptions=True)
+
+    @staticmethod
+    def _hedge_deadline(latency: LatencyTracker) -> float:
+        """次のプロバイダーでも合成を始めるまでの秒数(最初の音声までの時間の直近のパーセンタイル。記録が少ない場合は最大値)"""
+        seconds = latency.percentile(settings.TTS_HEDGE_PERCENTILE)
+        if seconds is None:
+            return settings.TTS_HEDGE_MAX_SECONDS
+        return min(max(seconds, settings.TTS_HEDGE_MIN_SECONDS), settings.TTS_HEDGE_MAX_SECONDS)
+
+    async def azure_text_to_speech(self, text: str, voice_name="ja-JP-NanamiNeural", rate="+10%", pitch="+10%") -> memoryview:
         """入力テキストを Azure TTSで音声(WAV)に変換する"""
-        speech_synthesizer = AzureSpeechSynthesizer(voice_name=voice_name, rate=rate)
-        tts_data = speech_synthesizer.speech_synthesis_to_audio_data_stream(text)
-        tts_data = add_wav_header(tts_data)
+        return await self.collect_wav(self.azure_text_to_speech_pcm_chunks(text, voice_name=voice_name, rate=rate, pitch=pitch))
+
+    async def azure_text_to_speech_pcm_chunks(self, text: str, voice_name="ja-JP-NanamiNeural", rate="+10%", pitch="+10%") -> AsyncIterator[bytes]:
+        """入力テキストを Azure TTSで音声に変換し、合成できた PCM から順に返す(azure_text_to_speech のストリーミング版)"""
+        cache_key = audio_cache_key(text, engine="azure_tts", voice_name=voice_name, rate=rate, pitch=pitch, output_format=self.output_format, postprocess=settings.TTS_POSTPROCESS)
+        if (audio := await tts_cache.aget(cache_key)) is not None:
+            yield memoryview(audio)[WAV_HEADER_SIZE:]
+            return
+
+        post_processor = self._post_processor()
+        async with tts_cache.aopen_writer(cache_key, header_size=WAV_HEADER_SIZE) as cache_writer:
+            with (
+                azure_breaker.guard(),
+                observe_stage("tts_azure"),
+                azure_tts_latency.time_to_first_chunk() as mark_first_chunk,
+                azure_synthesizer_pool.acquire(voice_name=voice_name, pitch=pitch, rate=rate, sample_rate=self._sample_rate) as speech_synthesizer,
+            ):
+                pcm_chunks = speech_synthesizer.speech_synthesis_chunks(text)
+                # 次のチャンクが届くまでスレッドをブロックするので、別スレッドで待つ
+                while (chunk := await asyncio.to_thread(next, pcm_chunks, None)) is not None:
+                    mark_first_chunk()
+                    if processed := post_processor.process(chunk):
+                        await cache_writer.awrite(processed)
+                        yield processed
+            if processed := post_processor.flush():
+                await cache_writer.awrite(processed)
+                yield processed
+
+            await cache_writer.acommit(wav_header(cache_writer.data_size, sample_rate=self._sample_rate))
+
+    async def _synthesize_with_azure(self, text: str, *, voice_name: str, pitch: str, rate: str) -> bytes:
+        """Azure TTS で音声合成し、PCM のバイト列を返す
+
+        SDK の合成は完了までスレッドをブロックするので、イベントループを止めないように別スレッドで実行する
+        """
+        with (
+            azure_breaker.guard(),
+            observe_stage("tts_azure"),
+            azure_synthesizer_pool.acquire(voice_name=voice_name, pitch=pitch, rate=rate, sample_rate=self._sample_rate) as speech_synthesizer,
+        ):
+            tts_data = await asyncio.to_thread(speech_synthesizer.speech_synthesis_to_audio_data_stream, text)
+            if tts_data is None:
+                raise RuntimeError("Azure speech synthesis failed")
         return tts_data
 
-    async def _stream_to_bytes(self, stream: AsyncIterator[bytes]) -> bytes:
-        """ストリームをバイト列(WAV)に変換する"""
-        audio_data = []
-        async for chunk in stream:
-            audio_data.append(chunk)
+    async def _stream_elevenlabs(
+        self,
+        open_stream: Callable[[], AsyncIterator[bytes]],
+        *,
+        stage: str,
+        latency: LatencyTracker,
+        cache_key: str,
+        fallback: Callable[[Exception], Awaitable[bytes | memoryview]],
+    ) -> AsyncIterator[bytes]:
+        """ElevenLabs のストリームの PCM を届いた順に返し、最後まで受け取れたらキャッシュする
+
+        前後の無音を削り、音量をそろえてから返す。最初のチャンクが届くまでの時間を latency に記録する。
+        最初のチャンクを返す前に失敗した場合は fallback の音声(WAV)を返す。
+        途中で失敗した場合は、既に返した音声を取り消せないので StreamInterruptedError を送出する
+        (まとめて返す場合は voice_wav が最初から合成し直す)
+        """
+        post_processor = self._post_processor()
+        async with tts_cache.aopen_writer(cache_key, header_size=WAV_HEADER_SIZE) as cache_writer:
+            try:
+                with elevenlabs_breaker.guard(), observe_stage(stage), latency.time_to_first_chunk() as mark_first_chunk:
+                    async for chunk in open_stream():
+                        mark_first_chunk()
+                        if processed := post_processor.process(chunk):
+                            await cache_writer.awrite(processed)
+                            yield processed
+            except Exception as e:
+                if not cache_writer.data_size:
+                    audio = await fallback(e)
+                    yield memoryview(audio)[WAV_HEADER_SIZE:]
+                    return
+                LOGGER.warning("ElevenLabs stream was interrupted after %d bytes: %r", cache_writer.data_size, e)
+                raise StreamInterruptedError(f"ElevenLabs stream was interrupted after {cache_writer.data_size} bytes") from e
+            if processed := post_processor.flush():
+                await cache_writer.awrite(processed)
+                yield processed
+
+            await cache_writer.acommit(wav_header(cache_writer.data_size, sample_rate=self._sample_rate))
+
+    def _post_processor(self) -> AudioPostProcessor:
+        return AudioPostProcessor(sample_rate=self._sample_rate, enabled=settings.TTS_POSTPROCESS)
 
-        return add_wav_header(b"".join(audio_data))
+    async def collect_wav(self, pcm_chunks: AsyncIterator[bytes]) -> memoryview:
+        """PCM のチャンクを全て受け取って、WAV にする(チャンクを1つのバッファに追記するだけで、連結し直さない)"""
+        wav_buffer = WavBuffer(sample_rate=self._sample_rate)
+        async for chunk in pcm_chunks:
+            wav_buffer.append(chunk)
+        return wav_buffer.wav()
 
     def _convert_kanji_to_hiragana(self, text):
         """テキストをひらがなに変換する"""
-        t = Tokenizer()
-        tokens = t.tokenize(text)
-        result = ""
-        for token in tokens:
-            surface = token.surface
-            reading = token.reading
-            if reading == "*":
-                # 記号や数字等の読みが取得できない場合はsurfaceをそのまま使う
-                result += surface
-            elif reading == jaconv.kata2hira(surface):
-                result += surface
-            elif reading == jaconv.hira2kata(surface):
-                result += surface
-            else:
-                result += jaconv.kata2hira(reading)
-        return result
+        return convert_kanji_to_hiragana(text)
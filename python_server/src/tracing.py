@@ -0,0 +1,193 @@
+import atexit
+import collections
+import contextlib
+import contextvars
+import dataclasses
+import json
+import logging
+import pathlib
+import queue
+import secrets
+import threading
+import time
+from collections.abc import Iterator
+from typing import Any, Protocol
+
+from src.config import settings
+
+LOGGER = logging.getLogger(__name__)
+
+# レスポンスに trace ID を付けるヘッダー
+TRACE_ID_HEADER = "X-Trace-Id"
+
+
+@dataclasses.dataclass
+class Span:
+    """処理の1区間"""
+
+    name: str
+    trace_id: str
+    span_id: str
+    parent_id: str | None
+    start_time: float
+    duration: float | None = None
+    attributes: dict[str, Any] = dataclasses.field(default_factory=dict)
+    error: str | None = None
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        """属性を追加する"""
+        self.attributes[key] = value
+
+    def to_dict(self) -> dict[str, Any]:
+        """JSON で出力するための dict"""
+        return dataclasses.asdict(self)
+
+
+class SpanExporter(Protocol):
+    """終了した Span の出力先"""
+
+    def export(self, span: Span) -> None:
+        """Span を出力する"""
+        ...
+
+
+class InMemorySpanExporter:
+    """直近 max_traces 件のトレースをメモリに保持する"""
+
+    def __init__(self, max_traces: int = 1000) -> None:
+        self._max_traces = max_traces
+        self._traces: collections.OrderedDict[str, list[Span]] = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def export(self, span: Span) -> None:
+        """Span を保持する"""
+        with self._lock:
+            self._traces.setdefault(span.trace_id, []).append(span)
+            self._traces.move_to_end(span.trace_id)
+            while len(self._traces) > self._max_traces:
+                self._traces.popitem(last=False)
+
+    def get_trace(self, trace_id: str) -> list[Span]:
+        """トレースに含まれる Span を開始時刻順に返す"""
+        with self._lock:
+            spans = list(self._traces.get(trace_id, []))
+        return sorted(spans, key=lambda span: span.start_time)
+
+
+class JsonLinesFileSpanExporter:
+    """Span を1行ずつ JSON でファイルに追記する
+
+    リクエストの処理中は Queue に積むだけにして、ファイルへの書き込みはバックグラウンドのスレッドでまとめて行う
+    """
+
+    _sentinel = None
+
+    def __init__(self, path: pathlib.Path, *, batch_size: int = 100) -> None:
+        self._path = path
+        self._batch_size = batch_size
+        self._queue: queue.Queue[Span | None] = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread: threading.Thread | None = None
+
+    def export(self, span: Span) -> None:
+        """Span を書き込み待ちにする(書き込み用のスレッドは最初の呼び出しで開始する)"""
+        if self._thread is None:
+            self._start()
+        self._queue.put_nowait(span)
+
+    def stop(self) -> None:
+        """溜まっている Span を書き出してからスレッドを停止する"""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is None:
+            return
+        self._queue.put_nowait(self._sentinel)
+        thread.join()
+
+    def _start(self) -> None:
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._monitor, name="trace-writer", daemon=True)
+            self._thread.start()
+        atexit.register(self.stop)
+
+    def _monitor(self) -> None:
+        while True:
+            # 届いている Span をまとめて、1回のファイルのオープンで書き込む
+            batch = [self._queue.get()]
+            while len(batch) < self._batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            spans = [span for span in batch if span is not self._sentinel]
+            if spans:
+                self._write(spans)
+            if len(spans) < len(batch):
+                return
+
+    def _write(self, spans: list[Span]) -> None:
+        try:
+            lines = "".join(json.dumps(span.to_dict(), ensure_ascii=False, default=str) + "\n" for span in spans)
+            with self._path.open("a", encoding="utf-8") as f:
+                f.write(lines)
+        except Exception:
+            # トレースの出力に失敗しても、書き込み用のスレッドは止めない
+            LOGGER.exception("Failed to write %d spans to %s", len(spans), self._path)
+
+
+class Tracer:
+    """Span を作成して exporter に渡す"""
+
+    def __init__(self, exporter: SpanExporter | None = None) -> None:
+        self.exporter = exporter
+        self._current_span: contextvars.ContextVar[Span | None] = contextvars.ContextVar("current_span", default=None)
+
+    def current_span(self) -> Span | None:
+        """実行中の Span"""
+        return self._current_span.get()
+
+    @contextlib.contextmanager
+    def start_span(self, name: str, **attributes: Any) -> Iterator[Span]:
+        """Span を開始する
+
+        実行中の Span があればその子になり、なければ新しいトレースを開始する
+        """
+        parent = self._current_span.get()
+        span = Span(
+            name=name,
+            trace_id=parent.trace_id if parent else secrets.token_hex(16),
+            span_id=secrets.token_hex(8),
+            parent_id=parent.span_id if parent else None,
+            start_time=time.time(),
+            attributes=attributes,
+        )
+        token = self._current_span.set(span)
+        started_at = time.perf_counter()
+        try:
+            yield span
+        except Exception as e:
+            span.error = repr(e)
+            raise
+        finally:
+            span.duration = time.perf_counter() - started_at
+            self._current_span.reset(token)
+            self._export(span)
+
+    def _export(self, span: Span) -> None:
+        if self.exporter is None:
+            return
+        try:
+            self.exporter.export(span)
+        except Exception:
+            # トレースの出力に失敗しても、本来の処理は止めない
+            LOGGER.exception("Failed to export span %s", span.name)
+
+
+def _create_exporter(name: str) -> SpanExporter | None:
+    if name == "memory":
+        return InMemorySpanExporter()
+    if name == "file":
+        return JsonLinesFileSpanExporter(settings.PYTHON_SERVER_ROOT / "log" / "traces.jsonl")
+    return None
+
+
+tracer = Tracer(_create_exporter(settings.TRACE_EXPORTER))
@@ -0,0 +1,264 @@
+import asyncio
+import collections
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import re
+import tempfile
+import threading
+import unicodedata
+from collections.abc import AsyncIterator, Iterator
+from typing import IO
+
+from src.config import settings
+from src.metrics import Counter, record_cache_hit
+
+LOGGER = logging.getLogger(__name__)
+
+TTS_CACHE_REQUESTS = Counter(
+    "aituber_tts_cache_requests_total",
+    "Number of TTS audio cache lookups",
+    ["result"],
+)
+
+_WHITESPACE_PATTERN = re.compile(r"\s+")
+
+
+def normalize_text(text: str) -> str:
+    """キャッシュのキー用にテキストを正規化する(全角・半角の違いと前後・連続する空白を無視する)"""
+    return _WHITESPACE_PATTERN.sub(" ", unicodedata.normalize("NFKC", text)).strip()
+
+
+def audio_cache_key(text: str, **params: object) -> str:
+    """テキストと合成のパラメータ(声・モデル・声の設定・出力フォーマットなど)から作るキャッシュのキー"""
+    payload = json.dumps({"text": normalize_text(text), **params}, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def audio_etag(audio: bytes | memoryview) -> str:
+    """音声の内容から作る ETag"""
+    return f'"{hashlib.sha256(audio).hexdigest()[:32]}"'
+
+
+class AudioCache:
+    """合成した音声をディスクに保存するキャッシュ
+
+    合計サイズが max_bytes を超えたら、最後に使われたのが古いものから削除する。
+    使われた順序はファイルの更新時刻に記録するので、再起動後も引き継がれる。
+    max_bytes が 0 の場合はキャッシュしない。
+    イベントループからは、ファイルの読み書きを別スレッドで行う aget / aopen_writer を使う
+    """
+
+    def __init__(self, directory: pathlib.Path, *, max_bytes: int) -> None:
+        self._directory = directory
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # キー -> サイズ(古く使われた順)
+        self._entries: collections.OrderedDict[str, int] = collections.OrderedDict()
+        self._total_bytes = 0
+        self._loaded = False
+
+    @property
+    def total_bytes(self) -> int:
+        """キャッシュしている音声の合計サイズ"""
+        with self._lock:
+            self._load()
+            return self._total_bytes
+
+    def get(self, key: str) -> bytes | None:
+        """キャッシュした音声を返す(ない場合は None)"""
+        if not self._max_bytes:
+            return None
+        with self._lock:
+            self._load()
+            hit = key in self._entries
+            if hit:
+                self._entries.move_to_end(key)
+        audio = self._read(key) if hit else None
+        TTS_CACHE_REQUESTS.inc(result="hit" if audio is not None else "miss")
+        record_cache_hit("tts_audio", audio is not None)
+        return audio
+
+    async def aget(self, key: str) -> bytes | None:
+        """get を別スレッドで実行する(ファイルの読み込みや、初回のディスク上のキャッシュの読み込みでイベントループを止めない)"""
+        if not self._max_bytes:
+            return None
+        return await asyncio.to_thread(self.get, key)
+
+    def put(self, key: str, audio: bytes | memoryview) -> None:
+        """音声をキャッシュする"""
+        if not self._max_bytes or len(audio) > self._max_bytes:
+            return
+        try:
+            self._write(key, audio)
+        except OSError as e:
+            LOGGER.warning("Failed to write TTS cache %s: %r", key, e)
+            return
+        self._add_entry(key, len(audio))
+
+    @contextlib.contextmanager
+    def open_writer(self, key: str, *, header_size: int = 0) -> Iterator["AudioCacheWriter"]:
+        """音声を届いた分から一時ファイルに書き込み、commit したらキャッシュする
+
+        音声全体をメモリに溜めずにキャッシュできる。with ブロックを commit せずに抜けた場合は破棄する。
+        先頭の header_size バイトは commit 時に書き込むヘッダー用に空けておく
+        """
+        writer = AudioCacheWriter(self, key, self._open_temporary_file(key), header_size=header_size)
+        try:
+            yield writer
+        finally:
+            writer.discard()
+
+    @contextlib.asynccontextmanager
+    async def aopen_writer(self, key: str, *, header_size: int = 0) -> AsyncIterator["AudioCacheWriter"]:
+        """open_writer の非同期版(一時ファイルの作成・破棄を別スレッドで行う。書き込みには awrite / acommit を使う)"""
+        file = await asyncio.to_thread(self._open_temporary_file, key) if self._max_bytes else None
+        writer = AudioCacheWriter(self, key, file, header_size=header_size)
+        try:
+            yield writer
+        finally:
+            if writer.is_open:
+                await asyncio.to_thread(writer.discard)
+
+    def _add_entry(self, key: str, size: int) -> None:
+        with self._lock:
+            self._load()
+            self._total_bytes += size - self._entries.pop(key, 0)
+            self._entries[key] = size
+            self._evict()
+
+    def _open_temporary_file(self, key: str) -> IO[bytes] | None:
+        if not self._max_bytes:
+            return None
+        path = self._path(key)
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            return tempfile.NamedTemporaryFile(dir=path.parent, suffix=".tmp", delete=False)  # noqa: SIM115
+        except OSError as e:
+            LOGGER.warning("Failed to write TTS cache %s: %r", key, e)
+            return None
+
+    def _path(self, key: str) -> pathlib.Path:
+        return self._directory / key[:2] / f"{key}.wav"
+
+    def _read(self, key: str) -> bytes | None:
+        path = self._path(key)
+        try:
+            audio = path.read_bytes()
+            os.utime(path)
+        except OSError:
+            # 別のプロセスなどに削除された場合
+            with self._lock:
+                size = self._entries.pop(key, None)
+                if size is not None:
+                    self._total_bytes -= size
+            return None
+        return audio
+
+    def _write(self, key: str, audio: bytes | memoryview) -> None:
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # 書き込み途中のファイルを読まないように、一時ファイルに書いてから置き換える
+        with tempfile.NamedTemporaryFile(dir=path.parent, suffix=".tmp", delete=False) as f:
+            f.write(audio)
+        os.replace(f.name, path)
+
+    def _load(self) -> None:
+        """起動後最初の1回だけ、ディスク上のキャッシュを読み込む"""
+        if self._loaded:
+            return
+        self._loaded = True
+        if not self._directory.exists():
+            return
+        files = sorted((path.stat().st_mtime, path.stem, path.stat().st_size) for path in self._directory.glob("*/*.wav"))
+        for _, key, size in files:
+            self._entries[key] = size
+            self._total_bytes += size
+        self._evict()
+
+    def _evict(self) -> None:
+        while self._total_bytes > self._max_bytes and self._entries:
+            key, size = self._entries.popitem(last=False)
+            self._total_bytes -= size
+            self._path(key).unlink(missing_ok=True)
+
+
+class AudioCacheWriter:
+    """AudioCache に少しずつ書き込む音声(AudioCache.open_writer で作る)"""
+
+    def __init__(self, cache: AudioCache, key: str, file: IO[bytes] | None, *, header_size: int) -> None:
+        self._cache = cache
+        self._key = key
+        # キャッシュしない場合は None
+        self._file = file
+        self._header_size = header_size
+        # 書き込んだ音声の長さ(ヘッダーを除く。キャッシュしない場合も数える)
+        self.data_size = 0
+        self._write(bytes(header_size))
+
+    def write(self, data: bytes | memoryview) -> None:
+        """音声を追記する"""
+        self.data_size += len(data)
+        if self._header_size + self.data_size > self._cache._max_bytes:
+            # 入りきらないものは書き込みを続けない
+            self.discard()
+        self._write(data)
+
+    @property
+    def is_open(self) -> bool:
+        """書き込み途中の一時ファイルがあるか(commit または破棄した後は False)"""
+        return self._file is not None
+
+    async def awrite(self, data: bytes | memoryview) -> None:
+        """write を別スレッドで実行する"""
+        if self._file is None:
+            self.data_size += len(data)
+            return
+        await asyncio.to_thread(self.write, data)
+
+    async def acommit(self, header: bytes = b"") -> None:
+        """commit を別スレッドで実行する(ファイルの置き換えや、古いキャッシュの削除でイベントループを止めない)"""
+        if self._file is None:
+            return
+        await asyncio.to_thread(self.commit, header)
+
+    def commit(self, header: bytes = b"") -> None:
+        """先頭にヘッダーを書き込んで、キャッシュに加える"""
+        if self._file is None:
+            return
+        if len(header) != self._header_size:
+            raise ValueError(f"Header size must be {self._header_size}, but got {len(header)}")
+        file, self._file = self._file, None
+        try:
+            file.seek(0)
+            file.write(header)
+            file.close()
+            os.replace(file.name, self._cache._path(self._key))
+        except OSError as e:
+            LOGGER.warning("Failed to write TTS cache %s: %r", self._key, e)
+            pathlib.Path(file.name).unlink(missing_ok=True)
+            return
+        self._cache._add_entry(self._key, self._header_size + self.data_size)
+
+    def discard(self) -> None:
+        """書き込み途中の音声を破棄する(commit 後は何もしない)"""
+        if self._file is None:
+            return
+        file, self._file = self._file, None
+        file.close()
+        pathlib.Path(file.name).unlink(missing_ok=True)
+
+    def _write(self, data: bytes | memoryview) -> None:
+        if self._file is None:
+            return
+        try:
+            self._file.write(data)
+        except OSError as e:
+            LOGGER.warning("Failed to write TTS cache %s: %r", self._key, e)
+            self.discard()
+
+
+tts_cache = AudioCache(settings.TTS_CACHE_DIR, max_bytes=settings.TTS_CACHE_MAX_BYTES)
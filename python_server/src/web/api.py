@@ -1,25 +1,43 @@
+import contextlib
 import datetime
-import pathlib
 import random
-from collections.abc import Iterator
+import secrets
+import threading
+import time
+from collections.abc import AsyncIterator, Iterator
 
 import uvicorn
-from fastapi import Depends, FastAPI, Form, HTTPException, Query, Request
-from fastapi.responses import ORJSONResponse, Response
+from fastapi import Depends, FastAPI, Form, Header, HTTPException, Query, Request
+from fastapi.responses import ORJSONResponse, PlainTextResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
 from sqlalchemy.orm import Session
+from starlette.routing import Match
 
+from src.audio_format import AudioFormat
+from src.azure_speech_synthesizer import azure_synthesizer_pool
+from src.circuit_breaker import CIRCUIT_BREAKERS, CircuitOpenError
 from src.config import settings
 from src.databases.engine import session_scope
+from src.flight_recorder import RECORDED_ENDPOINT_PREFIXES, FlightRecord, flight_recorder
+from src.gemini import gemini_rate_limiter
 from src.get_faiss_vector import get_hybrid_knowledge, get_multiple_qa
 from src.gpt import DocumentRetrievalType, filter_inappropriate_comments, generate_hallucination_response, generate_response
+from src.latency_tracker import LATENCY_TRACKERS
+from src.log_uploader import log_uploader
 from src.logger import setup_logger
+from src.metrics import HTTP_REQUEST_DURATION, HTTP_REQUESTS, collect_interaction_stats, endpoint_var, render_metrics
+from src.presynthesis import presynthesizer
+from src.profiler import MAX_PROFILE_SECONDS, SamplingProfiler, profile_for, profile_store
+from src.reading import get_tokenizer
 from src.repository.chat_message import YoutubeChatMessageRepository
 from src.repository.chat_message_cursor import YoutubeChatMessageCursorRepository
 from src.schema.hallucination import HallucinationRequest, HallucinationResponse
+from src.single_flight import reply_flight, voice_flight
 from src.templates import TEMPLATE_MESSAGES, TEMPLATE_QUESTIONS
-from src.text_to_speech import TextToSpeech
+from src.text_to_speech import AZURE_VOICES, StreamInterruptedError, TextToSpeech
+from src.tracing import TRACE_ID_HEADER, InMemorySpanExporter, tracer
+from src.tts_cache import audio_cache_key, audio_etag, normalize_text
 from src.use_cases.find_youtube_chat_messages import FindYoutubeChatMessagesUseCase
 from src.use_cases.save_youtube_chat_message import SaveYoutubeChatMessageUseCase
 from src.web.schema.response_model.youtube import YouTubeChatMessageModel, YouTubeChatMessagesResponseModel
@@ -44,18 +62,136 @@ class YouTubeCommentPostRequest(BaseModel):
     live_id: str
 
 
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    """サーバーの起動・終了時の処理"""
+    # 前回の起動時にアップロードしきれなかったログを再開する
+    log_uploader.start()
+    # 最初の音声合成で辞書の読み込みを待たないように、先に読み込んでおく
+    get_tokenizer()
+    azure_synthesizer_pool.warm_up(AZURE_VOICES)
+    # テンプレートメッセージなどの決まった文言の音声を合成しておく
+    presynthesizer.start()
+    yield
+    await presynthesizer.stop()
+    log_uploader.stop()
+
+
 app = FastAPI(
     default_response_class=ORJSONResponse,
+    lifespan=lifespan,
 )
 app.mount("/proxy", StaticFiles(directory="./comment_proxy"), name="comment_proxy")
 
+ADMIN_TOKEN_HEADER = "X-Admin-Token"  # noqa: S105
+PROFILE_HEADER = "X-Profile"
+# 音声の合成に使ったプロバイダー(/voice?hedge=1 の場合。文ごとに合成した場合はカンマ区切り)
+TTS_PROVIDER_HEADER = "X-TTS-Provider"
+
+
+def _is_admin(token: str | None) -> bool:
+    return settings.ADMIN_TOKEN is not None and token is not None and secrets.compare_digest(token, settings.ADMIN_TOKEN)
+
+
+def require_admin(x_admin_token: str | None = Header(default=None)) -> None:
+    """管理用エンドポイントの認証"""
+    if not _is_admin(x_admin_token):
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+
+def _endpoint_label(request: Request) -> str:
+    """メトリクスのエンドポイントのラベル
+
+    パスパラメータを含むルートは /voice/presynthesized/{audio_id} のようにルートのパスにまとめ、未定義のパスは other にする(ラベルの種類が増えすぎないようにする)。
+    処理中のステージのメトリクスにも使うので、ルーティングの結果を待たずに、ルーターと同じ方法で先に照合する
+    """
+    for route in app.router.routes:
+        match, _ = route.matches(request.scope)
+        if match == Match.FULL:
+            return route.path
+    return "other"
+
+
+@app.middleware("http")
+async def record_metrics(request: Request, call_next):
+    """エンドポイントごとのリクエスト数と所要時間を記録する"""
+    endpoint = _endpoint_label(request)
+    token = endpoint_var.set(endpoint)
+    started_at = time.perf_counter()
+    status_code = 500
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+        return response
+    finally:
+        HTTP_REQUEST_DURATION.observe(time.perf_counter() - started_at, endpoint=endpoint, method=request.method)
+        HTTP_REQUESTS.inc(endpoint=endpoint, method=request.method, status=str(status_code))
+        endpoint_var.reset(token)
+
+
+@app.middleware("http")
+async def record_slow_requests(request: Request, call_next):
+    """遅かったリクエストの内訳をフライトレコーダーに記録する"""
+    if not request.url.path.startswith(RECORDED_ENDPOINT_PREFIXES):
+        return await call_next(request)
+
+    started_at = datetime.datetime.now(tz=settings.LOCAL_TZ)
+    started = time.perf_counter()
+    status_code = 500
+    with collect_interaction_stats() as stats:
+        try:
+            response = await call_next(request)
+            status_code = response.status_code
+            return response
+        finally:
+            span = tracer.current_span()
+            record = FlightRecord.from_stats(
+                stats,
+                endpoint=request.url.path,
+                method=request.method,
+                status_code=status_code,
+                trace_id=span.trace_id if span else None,
+                started_at=started_at,
+                duration=time.perf_counter() - started,
+            )
+            flight_recorder.record(record)
+
+
+@app.middleware("http")
+async def profile_request(request: Request, call_next):
+    """X-Profile ヘッダーが付いたリクエストをプロファイリングし、trace ID で取得できるようにする
+
+    サンプリングするのはイベントループのスレッドだけ(ログの書き込みやアップロードなどのスレッドは含めない)。
+    ただし同時に処理中の他のリクエストのコルーチンも同じスレッドで動くので、それらのスタックも混ざる
+    """
+    if request.headers.get(PROFILE_HEADER) != "1" or not _is_admin(request.headers.get(ADMIN_TOKEN_HEADER)):
+        return await call_next(request)
+
+    profiler = SamplingProfiler(thread_ids={threading.get_ident()})
+    profiler.start()
+    try:
+        return await call_next(request)
+    finally:
+        profiler.stop()
+        span = tracer.current_span()
+        if span is not None:
+            profile_store.put(span.trace_id, profiler.collapsed())
+
 
-# 現在の時刻を取得し、1時間ごとのファイル名を生成
-current_time = datetime.datetime.now(tz=settings.LOCAL_TZ)
+@app.middleware("http")
+async def trace_request(request: Request, call_next):
+    """リクエスト全体を1つのトレースにまとめ、trace ID をレスポンスヘッダーで返す"""
+    with tracer.start_span("http", method=request.method, path=request.url.path) as span:
+        response = await call_next(request)
+        span.set_attribute("status_code", response.status_code)
+    response.headers[TRACE_ID_HEADER] = span.trace_id
+    return response
 
-t_fmt = current_time.strftime("%Y%m%d_%H%M%S")
-log_filename_json = pathlib.Path(__file__).parent.parent.parent / "log" / f"log_{t_fmt}.json"
-log_filename_csv = pathlib.Path(__file__).parent.parent.parent / "log" / f"log_{t_fmt}.csv"
+
+@app.exception_handler(CircuitOpenError)
+async def circuit_open_error_handler(request: Request, exc: CircuitOpenError):
+    """依存先のサービスが不調な場合は待たずに 503 を返す"""
+    return ORJSONResponse(content={"error": str(exc)}, status_code=503)
 
 
 # chat_id をグローバルにキャッシュする
@@ -83,9 +219,8 @@ def get_session(request: Request) -> Iterator[Session]:
 @app.post("/reply")
 async def reply(inputtext: str = Form(...)):
     """GPT に問い合わせた回答結果を取得する"""
-    res1, res2 = await generate_response(
-        text=inputtext, log_filename_json=log_filename_json, log_filename_csv=log_filename_csv, doc_retrieval_type=DocumentRetrievalType.multi, check_hal=True
-    )
+    # リトライなどで同じ質問の回答を生成中の場合は、新しく生成せずにその結果を共有する
+    res1, res2 = await reply_flight.do(normalize_text(inputtext), lambda: generate_response(text=inputtext, doc_retrieval_type=DocumentRetrievalType.multi, check_hal=True))
 
     if isinstance(res1, bytes):
         res1 = res1.decode("utf-8")
@@ -173,17 +308,115 @@ async def chat_messages(
     )
 
 
+def _audio_format(request: Request) -> AudioFormat:
+    """返す音声のフォーマット
+
+    クエリパラメータ format(pcm_24000, mulaw_22050 など)で指定された場合はそれを、
+    ない場合は Accept ヘッダー(audio/wav; codec=mulaw; rate=22050 など)から選ぶ(どちらもない場合は pcm_44100)
+    """
+    if "format" in request.query_params:
+        try:
+            return AudioFormat.parse(request.query_params["format"])
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e)) from e
+    audio_format = AudioFormat.negotiate(request.headers.get("Accept", ""))
+    if audio_format is None:
+        raise HTTPException(status_code=406, detail="No acceptable audio format (supported: audio/wav with codec=pcm|mulaw and rate=16000|22050|24000|44100)")
+    return audio_format
+
+
+def _audio_response(request: Request, audio: bytes | memoryview, headers: dict[str, str] | None = None) -> Response:
+    """音声(WAV)のレスポンスを返す(If-None-Match が ETag と一致する場合は本文を省略して 304 を返す)"""
+    etag = audio_etag(audio)
+    if etag in (value.strip().removeprefix("W/") for value in request.headers.get("If-None-Match", "").split(",")):
+        return Response(status_code=304, headers={**(headers or {}), "ETag": etag})
+    # Starlette の Response は bytes しか受け付けないので、ここで一度だけコピーする
+    return Response(content=bytes(audio), media_type="audio/wav", headers={**(headers or {}), "ETag": etag})
+
+
+def _query_flag(request: Request, name: str, *, default: bool = False) -> bool:
+    if name not in request.query_params:
+        return default
+    return request.query_params[name].lower() in ("1", "true")
+
+
+def _streaming_audio_response(pcm_chunks: AsyncIterator[bytes], audio_format: AudioFormat, headers: dict[str, str] | None = None) -> StreamingResponse:
+    """音声を合成しながら返す(長さが分からないので、WAV ヘッダーの長さの欄には最大値を入れる)"""
+
+    async def wav_chunks() -> AsyncIterator[bytes]:
+        yield audio_format.streaming_wav_header()
+        try:
+            async for chunk in audio_format.encode_stream(pcm_chunks):
+                # キャッシュから読んだ音声は memoryview なので、StreamingResponse が受け付ける bytes にする
+                yield bytes(chunk)
+        except StreamInterruptedError:
+            # 返した音声は取り消せないので、そこまでの音声で終える
+            return
+
+    return StreamingResponse(wav_chunks(), media_type="audio/wav", headers=headers)
+
+
+def _tts_headers(text_to_speech: TextToSpeech) -> dict[str, str]:
+    # 返す音声のフォーマットは Accept ヘッダーでも変わる
+    headers = {"Vary": "Accept"}
+    if text_to_speech.providers:
+        headers[TTS_PROVIDER_HEADER] = ",".join(dict.fromkeys(text_to_speech.providers))
+    return headers
+
+
+async def _prepend(first_chunk: bytes, pcm_chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    yield first_chunk
+    async for chunk in pcm_chunks:
+        yield chunk
+
+
+async def _voice_response(
+    request: Request,
+    text: str,
+    audio_format: AudioFormat,
+    text_to_speech: TextToSpeech,
+    voice: str,
+    *,
+    split_by_default: bool = False,
+) -> Response:
+    """音声を合成して返す
+
+    クエリパラメータで合成・返し方を指定できる
+    - split=1: 文ごとに並列に合成する(指定がない場合は split_by_default に従う)
+    - stream=1: 合成しながら返す
+    - format=pcm_24000 など: 返す音声のフォーマット(サンプリングレートは合成時に指定し、符号化は返す直前に行う)
+
+    同じ声・テキスト・サンプリングレートの合成が実行中の場合は、新しく合成せずにその PCM を共有する
+    """
+    synthesize = text_to_speech.voice_pcm_chunks(voice)
+    split = _query_flag(request, "split", default=split_by_default)
+    shared = voice_flight.stream(
+        audio_cache_key(text, voice=voice, sample_rate=audio_format.sample_rate, split=split),
+        lambda: text_to_speech.sentence_parallel_pcm_chunks(text, synthesize) if split else synthesize(text),
+        context=text_to_speech,
+    )
+    pcm_chunks = shared.subscribe()
+    if _query_flag(request, "stream"):
+        # 合成に失敗した場合にエラーのステータスを返せるように、また使ったプロバイダーをヘッダーで返せるように、最初のチャンクが届くまで待つ
+        first_chunk = await anext(pcm_chunks, b"")
+        return _streaming_audio_response(_prepend(first_chunk, pcm_chunks), audio_format, _tts_headers(shared.context))
+    audio = audio_format.to_wav(await text_to_speech.voice_wav(voice, text, pcm_chunks))
+    # ElevenLabs の音声が途切れて Azure TTS で合成し直した場合は、共有したストリームではなく合成し直した方のプロバイダーを返す
+    return _audio_response(request, audio, _tts_headers(text_to_speech if text_to_speech.providers else shared.context))
+
+
 @app.api_route("/voice", methods=["POST"], response_class=Response)
 async def voice(request: Request):
     """テキストを音声に変換する"""
     # NOTE: クエリパラメータから受け取るのが気持ち悪いが、unity側での修正が必要なので一旦既存実装を踏襲する
     text = request.query_params["text"]
 
-    text_to_speech = TextToSpeech()
+    audio_format = _audio_format(request)
+    text_to_speech = TextToSpeech(sample_rate=audio_format.sample_rate)
+    # hedge=1: ElevenLabs の音声が遅い場合は Azure TTS でも合成して、先に届いた方を返す
+    voice = "hedged" if _query_flag(request, "hedge", default=settings.VOICE_HEDGE) else "v1"
 
-    audio = await text_to_speech.text_to_speech_stream(text)
-
-    return Response(content=audio, media_type="audio/wav")
+    return await _voice_response(request, text, audio_format, text_to_speech, voice)
 
 
 @app.api_route("/voice/v2", methods=["POST"], response_class=Response)
@@ -192,11 +425,10 @@ async def voice_v2(request: Request):
     # NOTE: クエリパラメータから受け取るのが気持ち悪いが、unity側での修正が必要なので一旦既存実装を踏襲する
     text = request.query_params["text"]
 
-    text_to_speech = TextToSpeech()
-
-    audio = await text_to_speech.text_to_speech_with_azure_tts(text)
+    audio_format = _audio_format(request)
+    text_to_speech = TextToSpeech(sample_rate=audio_format.sample_rate)
 
-    return Response(content=audio, media_type="audio/wav")
+    return await _voice_response(request, text, audio_format, text_to_speech, "v2", split_by_default=settings.VOICE_V2_SPLIT_SENTENCES)
 
 
 @app.api_route("/voice/azure", methods=["POST"], response_class=Response)
@@ -205,11 +437,10 @@ async def voice_azure(request: Request):
     # NOTE: クエリパラメータから受け取るのが気持ち悪いが、unity側での修正が必要なので一旦既存実装を踏襲する
     text = request.query_params["text"]
 
-    text_to_speech = TextToSpeech()
-
-    audio = await text_to_speech.azure_text_to_speech(text)
+    audio_format = _audio_format(request)
+    text_to_speech = TextToSpeech(sample_rate=audio_format.sample_rate)
 
-    return Response(content=audio, media_type="audio/wav")
+    return await _voice_response(request, text, audio_format, text_to_speech, "azure")
 
 
 @app.api_route("/voice/male", methods=["POST"], response_class=Response)
@@ -218,11 +449,24 @@ async def voice_male(request: Request):
     # NOTE: クエリパラメータから受け取るのが気持ち悪いが、unity側での修正が必要なので一旦既存実装を踏襲する
     text = request.query_params["text"]
 
-    text_to_speech = TextToSpeech()
+    audio_format = _audio_format(request)
+    text_to_speech = TextToSpeech(sample_rate=audio_format.sample_rate)
 
-    audio = await text_to_speech.azure_text_to_speech(text, voice_name="ja-JP-KeitaNeural")
+    return await _voice_response(request, text, audio_format, text_to_speech, "male")
 
-    return Response(content=audio, media_type="audio/wav")
+
+@app.api_route("/voice/presynthesized/{audio_id}", methods=["GET", "POST"], response_class=Response)
+async def voice_presynthesized(request: Request, audio_id: str):
+    """起動後に合成しておいた音声を返す(音声 ID は /template_message などが返す)"""
+    entry = presynthesizer.lookup(audio_id)
+    if entry is None:
+        raise HTTPException(status_code=404, detail="Unknown audio id")
+    voice, text = entry
+
+    audio_format = _audio_format(request)
+    text_to_speech = TextToSpeech(sample_rate=audio_format.sample_rate)
+
+    return await _voice_response(request, text, audio_format, text_to_speech, voice)
 
 
 @app.get("/get_info")
@@ -253,9 +497,10 @@ async def get_template_message():
     """テンプレートメッセージを取得する
 
     テンプレートメッセージ: youtube上でユーザーのコメントがないときに読み上げるメッセージ
+    audio_ids: 合成済みの音声の ID(声 -> 音声 ID。GET /voice/presynthesized/{audio_id} で取得できる)
     """
     message = random.choice(TEMPLATE_MESSAGES)  # noqa: S311
-    return ORJSONResponse(content={"message": message})
+    return ORJSONResponse(content={"message": message, "audio_ids": presynthesizer.audio_ids(message)})
 
 
 @app.get("/template_question")
@@ -263,9 +508,64 @@ async def get_template_question():
     """テンプレート質問を取得する
 
     テンプレート質問: youtube上でユーザーのコメントがないときに読み上げる質問
+    audio_ids: 合成済みの音声の ID(声 -> 音声 ID。GET /voice/presynthesized/{audio_id} で取得できる)
     """
     question = random.choice(TEMPLATE_QUESTIONS)  # noqa: S311
-    return ORJSONResponse(content={"question": question})
+    return ORJSONResponse(content={"question": question, "audio_ids": presynthesizer.audio_ids(question)})
+
+
+@app.get("/status")
+async def status():
+    """サーバー内部の状態を取得する"""
+    return ORJSONResponse(
+        content={
+            "gemini_rate_limiter": gemini_rate_limiter.snapshot(),
+            "circuit_breakers": {breaker.name: breaker.snapshot() for breaker in CIRCUIT_BREAKERS},
+            "log_uploader": {"pending": log_uploader.pending()},
+            "presynthesis": presynthesizer.snapshot(),
+            "tts_first_chunk_latency": {tracker.name: tracker.snapshot() for tracker in LATENCY_TRACKERS},
+            "single_flight": {flight.name: flight.snapshot() for flight in (reply_flight, voice_flight)},
+        }
+    )
+
+
+@app.get("/traces/{trace_id}", dependencies=[Depends(require_admin)])
+async def get_trace(trace_id: str):
+    """直近のトレースを取得する(TRACE_EXPORTER=memory の場合のみ)"""
+    if not isinstance(tracer.exporter, InMemorySpanExporter):
+        raise HTTPException(status_code=404, detail="Traces are not kept in memory")
+    spans = tracer.exporter.get_trace(trace_id)
+    if not spans:
+        raise HTTPException(status_code=404, detail="Trace not found")
+    return ORJSONResponse(content={"trace_id": trace_id, "spans": [span.to_dict() for span in spans]})
+
+
+@app.get("/flight_recorder", dependencies=[Depends(require_admin)])
+async def get_flight_recorder():
+    """直近の遅かったリクエストの内訳を遅い順に取得する"""
+    return ORJSONResponse(content={"requests": [record.to_dict() for record in flight_recorder.slowest()]})
+
+
+@app.get("/debug/profile", response_class=PlainTextResponse, dependencies=[Depends(require_admin)])
+async def profile(seconds: float = Query(10.0, gt=0, le=MAX_PROFILE_SECONDS), interval_ms: float = Query(5.0, ge=1)):
+    """稼働中のプロセスを指定秒数サンプリングし、collapsed stack 形式で返す(flamegraph.pl や speedscope で表示できる)"""
+    profiler = await profile_for(seconds, interval=interval_ms / 1000)
+    return PlainTextResponse(content=profiler.collapsed())
+
+
+@app.get("/debug/profile/{trace_id}", response_class=PlainTextResponse, dependencies=[Depends(require_admin)])
+async def get_request_profile(trace_id: str):
+    """X-Profile: 1 を付けたリクエストのプロファイルを collapsed stack 形式で返す"""
+    collapsed = profile_store.get(trace_id)
+    if collapsed is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return PlainTextResponse(content=collapsed)
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """Prometheus 形式のメトリクスを取得する"""
+    return PlainTextResponse(content=render_metrics(), media_type="text/plain; version=0.0.4")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,111 @@
+import asyncio
+import functools
+import os
+import pathlib
+import struct
+import sys
+import warnings
+from collections.abc import AsyncIterator
+from unittest import mock
+
+import numpy as np
+import pytest
+from fastapi.testclient import TestClient
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from src.audio_format import AudioEncoding, AudioFormat, pcm_to_mulaw
+from src.azure_speech_synthesizer import WAV_HEADER_SIZE, AzureSpeechSynthesizerPool, WavBuffer, add_wav_header
+from src.cli.benchmarks.fakes import FakeAzureSpeechSynthesizer, FakeServiceConfig
+from src.tts_cache import AudioCache
+from src.web.api import app
+
+FAST_SERVICES = FakeServiceConfig(azure_delay=0, seconds_per_char=0.01)
+
+
+def test_parse() -> None:
+    assert AudioFormat.parse("pcm_24000") == AudioFormat(encoding=AudioEncoding.pcm, sample_rate=24000)
+    assert AudioFormat.parse("mulaw_22050") == AudioFormat(encoding=AudioEncoding.mulaw, sample_rate=22050)
+    for value in ["mp3_44100", "pcm_8000", "pcm", "pcm_abc"]:
+        with pytest.raises(ValueError):
+            AudioFormat.parse(value)
+
+
+def test_pcm_to_mulaw_matches_g711() -> None:
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", DeprecationWarning)
+        import audioop
+
+    pcm = np.linspace(-32768, 32767, 5000).astype("<i2").tobytes()
+    assert pcm_to_mulaw(pcm) == audioop.lin2ulaw(pcm, 2)
+
+
+def test_encode_stream_handles_odd_chunks() -> None:
+    pcm = np.arange(-500, 500, dtype="<i2").tobytes()
+
+    async def chunks() -> AsyncIterator[bytes]:
+        for start in range(0, len(pcm), 7):
+            yield pcm[start : start + 7]
+
+    async def collect() -> bytes:
+        return b"".join([chunk async for chunk in AudioFormat(encoding=AudioEncoding.mulaw).encode_stream(chunks())])
+
+    assert asyncio.run(collect()) == pcm_to_mulaw(pcm)
+
+
+def test_to_wav() -> None:
+    wav = add_wav_header(b"\x00\x01" * 100, sample_rate=24000)
+    assert AudioFormat(sample_rate=24000).to_wav(wav) == wav
+
+    mulaw_wav = AudioFormat(encoding=AudioEncoding.mulaw, sample_rate=24000).to_wav(wav)
+    format_tag, _, sample_rate, byte_rate, _, bits_per_sample = struct.unpack("<HHIIHH", mulaw_wav[20:36])
+    assert (format_tag, sample_rate, byte_rate, bits_per_sample) == (7, 24000, 24000, 8)
+    assert len(mulaw_wav) == WAV_HEADER_SIZE + 100
+
+
+def test_wav_buffer() -> None:
+    wav_buffer = WavBuffer(sample_rate=24000)
+    wav_buffer.append(b"\x00\x01" * 50)
+    wav_buffer.append(memoryview(b"\x02\x03" * 50))
+    wav = wav_buffer.wav()
+    assert wav == add_wav_header(b"\x00\x01" * 50 + b"\x02\x03" * 50, sample_rate=24000)
+    # 追記したバッファをそのまま返す
+    assert isinstance(wav, memoryview)
+    assert wav_buffer.data_size == 200
+    with pytest.raises(BufferError):
+        wav_buffer.append(b"\x00\x00")
+
+
+def test_negotiate_audio_format() -> None:
+    assert AudioFormat.negotiate("") == AudioFormat()
+    assert AudioFormat.negotiate("*/*") == AudioFormat()
+    assert AudioFormat.negotiate("audio/wav; rate=24000") == AudioFormat(sample_rate=24000)
+    assert AudioFormat.negotiate('audio/wav; codec=pcm; rate=24000; q=0.5, audio/wav; codec="mulaw"; rate=22050') == AudioFormat(AudioEncoding.mulaw, 22050)
+    # 返せないフォーマットは飛ばし、q の大きい順に選ぶ
+    assert AudioFormat.negotiate("audio/mpeg, audio/wav; rate=8000, audio/x-wav; rate=16000; q=0.8, audio/*; q=0.1") == AudioFormat(sample_rate=16000)
+    assert AudioFormat.negotiate("audio/mpeg, audio/wav; q=0") is None
+
+
+def test_voice_format(tmp_path: pathlib.Path) -> None:
+    client = TestClient(app)
+    pool = AzureSpeechSynthesizerPool(factory=functools.partial(FakeAzureSpeechSynthesizer, FAST_SERVICES))
+    with mock.patch("src.text_to_speech.azure_synthesizer_pool", pool), mock.patch("src.text_to_speech.tts_cache", AudioCache(tmp_path, max_bytes=10**8)):
+        default = client.post("/voice/azure", params={"text": "こんにちは"})
+        pcm_24000 = client.post("/voice/azure", params={"text": "こんにちは", "format": "pcm_24000"})
+        mulaw_24000 = client.post("/voice/azure", params={"text": "こんにちは", "format": "mulaw_24000", "stream": "1"})
+        invalid = client.post("/voice/azure", params={"text": "こんにちは", "format": "mp3_44100"})
+        accept_24000 = client.post("/voice/azure", params={"text": "こんにちは"}, headers={"Accept": "audio/wav; codec=mulaw; rate=24000"})
+        not_acceptable = client.post("/voice/azure", params={"text": "こんにちは"}, headers={"Accept": "audio/mpeg"})
+
+    assert struct.unpack("<I", default.content[24:28])[0] == 44100
+    # 24kHz で合成する
+    assert struct.unpack("<I", pcm_24000.content[24:28])[0] == 24000
+    assert pool.idle_count(voice_name="ja-JP-NanamiNeural", rate="+10%", sample_rate=24000) == 1
+    assert len(pcm_24000.content) < len(default.content)
+    # μ-law は同じサンプリングレートの PCM の半分のサイズ
+    assert len(mulaw_24000.content) - WAV_HEADER_SIZE == (len(pcm_24000.content) - WAV_HEADER_SIZE) // 2
+    assert invalid.status_code == 400
+    # Accept ヘッダーでも指定できる(format の指定がある場合はそちらを優先する)
+    assert accept_24000.content[WAV_HEADER_SIZE:] == mulaw_24000.content[WAV_HEADER_SIZE:]
+    assert struct.unpack("<HHI", accept_24000.content[20:28]) == (7, 1, 24000)
+    assert accept_24000.headers["Vary"] == "Accept"
+    assert not_acceptable.status_code == 406
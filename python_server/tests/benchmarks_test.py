@@ -0,0 +1,77 @@
+import asyncio
+import logging
+import os
+import pathlib
+import sys
+
+import httpx
+import numpy as np
+import pytest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from src.cli.benchmarks.corpus import build_faiss_db, load_knowledge_documents, load_qa_documents
+from src.cli.benchmarks.fakes import FakeElevenLabs, FakeServiceConfig, HashingEmbeddings, offline_services
+from src.cli.benchmarks.load_test import run_load_test
+from src.cli.benchmarks.retrieval import RETRIEVERS, benchmark_retrieval
+from src.web.api import app
+
+
+def test_hashing_embeddings_are_deterministic() -> None:
+    embeddings = HashingEmbeddings(dimensions=64)
+
+    [a, b] = embeddings.embed_documents(["政策の5本柱を教えて", "政策の5本柱を教えて"])
+    c = embeddings.embed_query("好きな食べ物は？")
+
+    assert a == b
+    assert len(a) == 64
+    assert np.linalg.norm(a) == pytest.approx(1.0)
+    assert np.dot(a, embeddings.embed_query("政策の5本柱")) > np.dot(a, c)
+
+
+def test_fake_elevenlabs_streams_pcm() -> None:
+    client = FakeElevenLabs(FakeServiceConfig(elevenlabs_first_chunk_delay=0, elevenlabs_chunk_delay=0, seconds_per_char=0.01))
+
+    async def collect() -> bytes:
+        return b"".join([chunk async for chunk in client.text_to_speech.convert_as_stream(voice_id="x", text="こんにちは")])
+
+    pcm = asyncio.run(collect())
+    assert len(pcm) == int(44100 * 0.01 * 5) * 2
+
+
+def test_load_test_against_offline_services(tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(logging.getLogger("interaction_logger"), "disabled", True)
+    config = FakeServiceConfig(gemini_delay=0, embedding_delay=0, elevenlabs_first_chunk_delay=0, elevenlabs_chunk_delay=0, azure_delay=0, seconds_per_char=0.01)
+    qa_docs = load_qa_documents()[:50]
+    embeddings = HashingEmbeddings()
+    build_faiss_db(load_knowledge_documents()[:50], embeddings, tmp_path / "knowledge")
+    build_faiss_db(qa_docs, embeddings, tmp_path / "qa")
+
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://load-test") as client:
+            return await run_load_test(
+                client,
+                rate=20,
+                duration=0.5,
+                weights={"reply": 1.0, "voice": 1.0, "get_info": 1.0},
+                questions=[doc.metadata["question"] for doc in qa_docs],
+            )
+
+    with offline_services(config, faiss_knowledge_db_dir=tmp_path / "knowledge", faiss_qa_db_dir=tmp_path / "qa"):
+        report = asyncio.run(run())
+
+    summary = report.summary()
+    assert summary["requests"].sum() > 0
+    assert summary["errors"].sum() == 0
+    assert report.loop_lags
+
+
+def test_benchmark_retrieval() -> None:
+    knowledge_docs = load_knowledge_documents()[:20]
+    qa_docs = load_qa_documents()[:20]
+
+    results = benchmark_retrieval(knowledge_docs=knowledge_docs, qa_docs=qa_docs, sizes=[0, 40], queries=["政策を教えて", "好きな食べ物は？"])
+
+    assert results["size"].tolist() == [20, 20, 20, 40, 40, 40]
+    assert results["retriever"].tolist() == list(RETRIEVERS) * 2
+    assert (results["p50_ms"] > 0).all()
+    assert (results["index_mb"] > 0).all()
@@ -0,0 +1,73 @@
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from src.circuit_breaker import CircuitBreaker, CircuitOpenError, CircuitState
+
+
+def _fail(breaker: CircuitBreaker) -> None:
+    with pytest.raises(RuntimeError), breaker.guard():
+        raise RuntimeError("upstream error")
+
+
+def test_opens_on_error_rate() -> None:
+    breaker = CircuitBreaker("test", slow_call_seconds=10, min_calls=4, failure_rate_threshold=0.5)
+
+    with breaker.guard():
+        pass
+    with breaker.guard():
+        pass
+    _fail(breaker)
+    assert breaker.state == CircuitState.closed
+    _fail(breaker)
+
+    assert breaker.state == CircuitState.open
+    with pytest.raises(CircuitOpenError), breaker.guard():
+        pass
+
+
+def test_opens_on_slow_calls() -> None:
+    breaker = CircuitBreaker("test", slow_call_seconds=0.0, min_calls=2)
+
+    for _ in range(2):
+        with breaker.guard():
+            pass
+
+    assert breaker.degraded
+
+
+def test_half_open_allows_single_probe() -> None:
+    breaker = CircuitBreaker("test", slow_call_seconds=10, min_calls=1, open_seconds=0.01)
+    _fail(breaker)
+    assert breaker.state == CircuitState.open
+
+    time.sleep(0.02)
+    assert breaker.state == CircuitState.half_open
+    assert breaker.allow_request()
+    assert not breaker.allow_request()
+
+
+def test_successful_probe_closes() -> None:
+    breaker = CircuitBreaker("test", slow_call_seconds=10, min_calls=1, open_seconds=0.01)
+    _fail(breaker)
+    time.sleep(0.02)
+
+    with breaker.guard():
+        pass
+
+    assert breaker.state == CircuitState.closed
+
+
+def test_cancelled_probe_releases_slot() -> None:
+    breaker = CircuitBreaker("test", slow_call_seconds=10, min_calls=1, open_seconds=0.01)
+    _fail(breaker)
+    time.sleep(0.02)
+
+    with pytest.raises(GeneratorExit), breaker.guard():
+        raise GeneratorExit
+
+    assert breaker.state == CircuitState.half_open
+    assert breaker.allow_request()
@@ -0,0 +1,94 @@
+import datetime
+import os
+import sys
+from unittest import mock
+
+from fastapi.testclient import TestClient
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from src.flight_recorder import FlightRecord, FlightRecorder
+from src.metrics import collect_interaction_stats, observe_stage, record_question
+from src.web.api import app
+
+
+def _make_record(duration: float) -> FlightRecord:
+    return FlightRecord(
+        endpoint="/reply",
+        method="POST",
+        status_code=200,
+        trace_id=None,
+        started_at=datetime.datetime(2024, 7, 1, tzinfo=datetime.UTC),
+        duration=duration,
+        question=None,
+        stage_durations={},
+        llm_calls=[],
+        retrieval_candidates={},
+        cache_hits={},
+    )
+
+
+def test_keeps_slowest_requests() -> None:
+    recorder = FlightRecorder(capacity=3, window_seconds=60)
+
+    for duration in (1.0, 5.0, 2.0, 0.5, 30.0, 3.0):
+        recorder.record(_make_record(duration))
+
+    assert [record.duration for record in recorder.slowest()] == [30.0, 5.0, 3.0]
+
+
+def test_expires_old_requests() -> None:
+    recorder = FlightRecorder(capacity=3, window_seconds=60)
+
+    with mock.patch("time.monotonic", return_value=1000.0):
+        recorder.record(_make_record(30.0))
+    with mock.patch("time.monotonic", return_value=1030.0):
+        recorder.record(_make_record(1.0))
+
+    with mock.patch("time.monotonic", return_value=1070.0):
+        assert [record.duration for record in recorder.slowest()] == [1.0]
+
+
+def test_keeps_slower_requests_seen_while_window_was_full() -> None:
+    recorder = FlightRecorder(capacity=2, window_seconds=60)
+
+    with mock.patch("time.monotonic", return_value=1000.0):
+        for duration in (30.0, 20.0):
+            recorder.record(_make_record(duration))
+    # 上位が埋まっている間に記録した、それより速いリクエスト
+    with mock.patch("time.monotonic", return_value=1030.0):
+        for duration in (5.0, 1.0, 3.0):
+            recorder.record(_make_record(duration))
+
+    # 遅いリクエストが窓から外れた後は、その間に記録したリクエストから選ぶ
+    with mock.patch("time.monotonic", return_value=1070.0):
+        assert [record.duration for record in recorder.slowest()] == [5.0, 3.0]
+
+
+def test_record_from_stats() -> None:
+    with collect_interaction_stats() as stats:
+        record_question("質問")
+        with observe_stage("generation"):
+            pass
+
+    record = FlightRecord.from_stats(
+        stats,
+        endpoint="/reply",
+        method="POST",
+        status_code=200,
+        trace_id="abc",
+        started_at=datetime.datetime(2024, 7, 1, tzinfo=datetime.UTC),
+        duration=1.5,
+    )
+
+    assert record.question == "質問"
+    assert set(record.stage_durations) == {"generation"}
+    assert record.to_dict()["started_at"] == "2024-07-01T00:00:00+00:00"
+
+
+def test_flight_recorder_requires_admin_token() -> None:
+    client = TestClient(app)
+    with mock.patch("src.web.api.settings.ADMIN_TOKEN", "secret"):
+        assert client.get("/flight_recorder").status_code == 403
+        assert client.get("/flight_recorder", headers={"X-Admin-Token": "wrong"}).status_code == 403
+        assert client.get("/traces/0123", headers={"X-Admin-Token": "wrong"}).status_code == 403
+        assert client.get("/flight_recorder", headers={"X-Admin-Token": "secret"}).status_code == 200
@@ -1,15 +1,10 @@
 import asyncio
-import datetime
 import os
 import sys
-from zoneinfo import ZoneInfo
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
-from src.config import settings
 from src.gpt import filter_inappropriate_comments, generate_response
 
-tz = ZoneInfo("Asia/Tokyo")
-
 
 async def test_single_question() -> None:
     # このテストはUnitテストというよりはIntegrationテストに近いため、
@@ -79,10 +74,5 @@ async def test_filter_inappropriate_comments() -> None:
 
 
 async def _request_gpt(text: str) -> str:
-    current_time = datetime.datetime.now(tz=tz)
-    t_fmt = current_time.strftime("%Y%m%d_%H%M%S")
-
-    log_filename_json = settings.PYTHON_SERVER_ROOT / "log" / f"log_{t_fmt}.json"
-    log_filename_csv = settings.PYTHON_SERVER_ROOT / "log" / f"log_{t_fmt}.csv"
-    message, _ = await generate_response(text, log_filename_csv, log_filename_json)
+    message, _ = await generate_response(text)
     return message
@@ -0,0 +1,50 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from src.latency_tracker import LatencyTracker
+
+
+def test_percentile() -> None:
+    tracker = LatencyTracker("test", window_size=10, min_samples=3)
+    tracker.record(1.0)
+    tracker.record(2.0)
+    # 記録が少ない場合は求めない
+    assert tracker.percentile(50) is None
+
+    for seconds in range(3, 13):
+        tracker.record(float(seconds))
+    # 直近 window_size 回だけを使う
+    assert tracker.percentile(0) == 3.0
+    assert tracker.percentile(100) == 12.0
+
+
+def test_time_to_first_chunk() -> None:
+    tracker = LatencyTracker("test", min_samples=1)
+    with tracker.time_to_first_chunk() as mark:
+        mark()
+        mark()
+    assert tracker.snapshot()["samples"] == 1
+
+    # 失敗した場合は記録しない
+    with pytest.raises(RuntimeError), tracker.time_to_first_chunk():
+        raise RuntimeError("failed")
+    assert tracker.snapshot()["samples"] == 1
+
+    # 打ち切られた場合は、そこまでの時間を記録する
+    async def cancelled() -> None:
+        with tracker.time_to_first_chunk():
+            await asyncio.sleep(10)
+
+    async def cancel() -> None:
+        task = asyncio.create_task(cancelled())
+        await asyncio.sleep(0.05)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    asyncio.run(cancel())
+    assert tracker.snapshot()["samples"] == 2
+    assert tracker.percentile(100) >= 0.05
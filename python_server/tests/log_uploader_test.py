@@ -0,0 +1,123 @@
+import json
+import os
+import pathlib
+import sys
+import threading
+from unittest import mock
+
+import pytest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from src.log_uploader import PARTIAL_SUFFIX, LogUploader, copy_for_upload
+
+
+class FakeDrive:
+    """指定した回数だけ失敗してから成功する Google Drive"""
+
+    def __init__(self, failures: int = 0) -> None:
+        self.failures = failures
+        self.uploaded: list[str] = []
+        self._lock = threading.Lock()
+
+    def upload(self, *, file_path: pathlib.Path, folder_id: str, mime_type: str) -> None:
+        with self._lock:
+            if self.failures:
+                self.failures -= 1
+                raise ConnectionError("Drive is down")
+            self.uploaded.append(file_path.name)
+
+
+@pytest.fixture()
+def sleeps() -> list[float]:
+    # バックオフの待ち時間を記録し、実際には待たない
+    sleeps: list[float] = []
+    with mock.patch.object(LogUploader._upload_with_retry.retry, "sleep", sleeps.append):
+        yield sleeps
+
+
+def _make_uploader(tmp_path: pathlib.Path, drive: FakeDrive) -> LogUploader:
+    upload_dir = tmp_path / "files_to_upload"
+    upload_dir.mkdir(exist_ok=True)
+    return LogUploader(upload_dir=upload_dir, manifest_path=tmp_path / "upload_manifest.json", folder_id="folder", max_workers=2, drive_factory=lambda: drive)
+
+
+def test_uploads_and_deletes_files(tmp_path: pathlib.Path, sleeps: list[float]) -> None:
+    drive = FakeDrive()
+    uploader = _make_uploader(tmp_path, drive)
+    for name in ("interaction_log-2024-07-01_00.json", "interaction_log-2024-07-01_00.parquet", "ignored.txt"):
+        (tmp_path / "files_to_upload" / name).write_text("log", encoding="utf-8")
+
+    uploader.start()
+    uploader.stop(cancel_pending=False)
+
+    assert sorted(drive.uploaded) == ["interaction_log-2024-07-01_00.json", "interaction_log-2024-07-01_00.parquet"]
+    assert sorted(path.name for path in (tmp_path / "files_to_upload").iterdir()) == ["ignored.txt"]
+    assert uploader.pending() == {}
+    assert json.loads((tmp_path / "upload_manifest.json").read_text(encoding="utf-8")) == {}
+    assert sleeps == []
+
+
+def test_retries_with_exponential_backoff(tmp_path: pathlib.Path, sleeps: list[float]) -> None:
+    drive = FakeDrive(failures=2)
+    uploader = _make_uploader(tmp_path, drive)
+    (tmp_path / "files_to_upload" / "interaction_log-2024-07-01_00.json").write_text("log", encoding="utf-8")
+
+    uploader.start()
+    uploader.stop(cancel_pending=False)
+
+    assert drive.uploaded == ["interaction_log-2024-07-01_00.json"]
+    assert sleeps == [2, 4]
+    assert not (tmp_path / "files_to_upload" / "interaction_log-2024-07-01_00.json").exists()
+
+
+def test_failed_upload_is_resumed_after_restart(tmp_path: pathlib.Path, sleeps: list[float]) -> None:
+    file_path = tmp_path / "files_to_upload" / "interaction_log-2024-07-01_00.json"
+    drive = FakeDrive(failures=5)
+    uploader = _make_uploader(tmp_path, drive)
+    file_path.write_text("log", encoding="utf-8")
+
+    uploader.start()
+    uploader.stop(cancel_pending=False)
+
+    # リトライし尽くしても消さずに残し、manifest に記録する
+    assert file_path.exists()
+    manifest = json.loads((tmp_path / "upload_manifest.json").read_text(encoding="utf-8"))
+    assert manifest[file_path.name]["attempts"] == 5
+    assert "Drive is down" in manifest[file_path.name]["last_error"]
+
+    # 再起動後は manifest を引き継いで再開する
+    restarted = _make_uploader(tmp_path, FakeDrive(failures=5))
+    restarted.start()
+    restarted.stop(cancel_pending=False)
+    assert restarted.pending()[file_path.name]["attempts"] == 10
+
+    drive = FakeDrive()
+    restarted = _make_uploader(tmp_path, drive)
+    restarted.start()
+    restarted.stop(cancel_pending=False)
+    assert drive.uploaded == [file_path.name]
+    assert not file_path.exists()
+    assert restarted.pending() == {}
+
+
+def test_skips_files_being_copied(tmp_path: pathlib.Path, sleeps: list[float]) -> None:
+    drive = FakeDrive()
+    uploader = _make_uploader(tmp_path, drive)
+    source = tmp_path / "interaction_log.json"
+    source.write_text("log", encoding="utf-8")
+    dest = tmp_path / "files_to_upload" / "interaction_log-2024-07-01_00.json"
+
+    # コピーの途中で enqueue_pending が呼ばれても、書き込み途中のファイルはアップロードしない
+    def copy_and_enqueue(src: pathlib.Path, dst: pathlib.Path) -> None:
+        pathlib.Path(dst).write_text("lo", encoding="utf-8")
+        uploader.enqueue_pending()
+
+    with mock.patch("src.log_uploader.shutil.copy", copy_and_enqueue):
+        copy_for_upload(source, dest)
+    uploader.stop(cancel_pending=False)
+    assert drive.uploaded == []
+    assert not dest.with_name(dest.name + PARTIAL_SUFFIX).exists()
+
+    uploader.enqueue_pending()
+    uploader.stop(cancel_pending=False)
+    assert drive.uploaded == [dest.name]
@@ -0,0 +1,152 @@
+import datetime
+import json
+import logging
+import os
+import pathlib
+import queue
+import sys
+from unittest import mock
+
+import pandas as pd
+import pytest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from src.interaction_log_parquet import export_interaction_log_to_parquet, latency_percentiles, load_interaction_logs
+from src.logger import (
+    BatchingQueueListener,
+    CsvFormatter,
+    GPTLogRecord,
+    GPTLogRecordCSVTimedRotatingFileHandler,
+    GPTLogRecordJsonTimedRotatingFileHandler,
+    JsonFormatter,
+    _setup_stdlib_handlers,
+)
+
+
+def _make_record(question: str) -> GPTLogRecord:
+    record = GPTLogRecord("interaction_logger", logging.INFO, __file__, 0, "log interaction log", None, None)
+    record.timestamp_ = datetime.datetime(2024, 7, 1, tzinfo=datetime.UTC)
+    record.doc_retrieval_type = "multi"
+    record.rag_qa = ""
+    record.rag_knowledge = ""
+    record.metadata_ = {"row": 1, "image": "slide_1.png"}
+    record.question = question
+    record.response = "回答"
+    record.latency = 0.1
+    record.stage_durations = {"ng_check": 0.0, "retrieval": 0.02, "rerank": 0.0, "generation": 0.07, "hallucination_check": 0.01}
+    record.prompt_tokens = 1200
+    record.response_tokens = 80
+    record.cache_hits = {"bm25_index": True}
+    record.trace_id = "0af7651916cd43dd8448eb211c80319c"
+    return record
+
+
+def test_batching_queue_listener_writes_all_records(tmp_path: pathlib.Path) -> None:
+    handler = GPTLogRecordJsonTimedRotatingFileHandler(tmp_path / "interaction_log.json", when="H", interval=1)
+    handler.setFormatter(JsonFormatter())
+    log_queue: queue.Queue = queue.Queue()
+    listener = BatchingQueueListener(log_queue, handler, batch_size=2, flush_interval=10)
+
+    listener.start()
+    for i in range(3):
+        log_queue.put_nowait(_make_record(f"質問{i}"))
+    listener.stop()
+    handler.close()
+
+    lines = (tmp_path / "interaction_log.json").read_text(encoding="utf-8").splitlines()
+    assert [json.loads(line)["question"] for line in lines] == ["質問0", "質問1", "質問2"]
+
+
+def test_emit_batch_keeps_writing_after_a_broken_record(tmp_path: pathlib.Path) -> None:
+    handler = GPTLogRecordJsonTimedRotatingFileHandler(tmp_path / "interaction_log.json", when="H", interval=1)
+    handler.setFormatter(JsonFormatter())
+    broken = _make_record("壊れた記録")
+    del broken.question
+    failed: list[logging.LogRecord] = []
+
+    with mock.patch.object(handler, "handleError", failed.append):
+        handler.emit_batch([_make_record("質問0"), broken, _make_record("質問1")])
+    handler.close()
+
+    lines = (tmp_path / "interaction_log.json").read_text(encoding="utf-8").splitlines()
+    assert [json.loads(line)["question"] for line in lines] == ["質問0", "質問1"]
+    assert failed == [broken]
+
+
+def test_interaction_logs_still_reach_console(tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "log").mkdir()
+    interaction_logger = logging.getLogger("interaction_logger")
+    root_handlers, interaction_handlers = logging.root.handlers, interaction_logger.handlers
+    record_factory = logging.getLogRecordFactory()
+    records: list[logging.LogRecord] = []
+
+    class CapturingHandler(logging.Handler):
+        def emit(self, record: logging.LogRecord) -> None:
+            records.append(record)
+
+    try:
+        _setup_stdlib_handlers()
+        logging.root.addHandler(CapturingHandler())
+        interaction_logger.info("log interaction log")
+        interaction_logger.handlers[0].listener.stop()
+    finally:
+        logging.root.handlers, interaction_logger.handlers = root_handlers, interaction_handlers
+        logging.setLogRecordFactory(record_factory)
+
+    # ファイルへの書き込みをバックグラウンドに移しても、標準出力にも出す
+    assert [record.getMessage() for record in records] == ["log interaction log"]
+
+
+def test_csv_header_is_written_once_when_opening_a_new_file(tmp_path: pathlib.Path) -> None:
+    for _ in range(2):
+        handler = GPTLogRecordCSVTimedRotatingFileHandler(tmp_path / "interaction_log.csv", when="H", interval=1)
+        handler.setFormatter(CsvFormatter())
+        handler.emit_batch([_make_record("質問")])
+        handler.close()
+
+    lines = (tmp_path / "interaction_log.csv").read_text(encoding="utf-8").splitlines()
+    assert lines[0] == "\ufeff" + ",".join(GPTLogRecordCSVTimedRotatingFileHandler.headers)
+    assert len(lines) == 3
+
+
+def test_export_interaction_log_to_parquet(tmp_path: pathlib.Path) -> None:
+    jsonl_path = tmp_path / "interaction_log.json"
+    jsonl_path.write_text("\n".join(JsonFormatter().format(_make_record(f"質問{i}")) for i in range(2)) + "\n", encoding="utf-8")
+
+    export_interaction_log_to_parquet(jsonl_path=jsonl_path, parquet_path=tmp_path / "interaction_log.parquet")
+    logs = load_interaction_logs([tmp_path / "interaction_log.parquet"])
+
+    assert logs["question"].tolist() == ["質問0", "質問1"]
+    assert logs["image"].tolist() == ["slide_1.png", "slide_1.png"]
+    assert str(logs["timestamp"].dt.tz) == "UTC"
+    assert logs["latency"].dtype == "float64"
+    assert logs["generation_seconds"].tolist() == [0.07, 0.07]
+    assert logs["prompt_tokens"].tolist() == [1200, 1200]
+    assert json.loads(logs["cache_hits"][0]) == {"bm25_index": True}
+
+
+def test_export_interaction_log_without_breakdown(tmp_path: pathlib.Path) -> None:
+    entry = json.loads(JsonFormatter().format(_make_record("質問")))
+    for key in ("stage_durations", "prompt_tokens", "response_tokens", "cache_hits", "trace_id"):
+        del entry[key]
+    jsonl_path = tmp_path / "interaction_log.json"
+    jsonl_path.write_text(json.dumps(entry, ensure_ascii=False) + "\n", encoding="utf-8")
+
+    export_interaction_log_to_parquet(jsonl_path=jsonl_path, parquet_path=tmp_path / "interaction_log.parquet")
+    logs = load_interaction_logs([tmp_path / "interaction_log.parquet"])
+
+    assert logs["generation_seconds"].isna().all()
+    assert logs["cache_hits"].isna().all()
+
+
+def test_latency_percentiles() -> None:
+    logs = pd.DataFrame({"generation_seconds": [float(i) for i in range(1, 101)], "latency": [2.0] * 100})
+
+    percentiles = latency_percentiles(logs)
+
+    assert percentiles.loc["generation", "count"] == 100
+    assert percentiles.loc["generation", "p50"] == pytest.approx(50.5)
+    assert percentiles.loc["generation", "p99"] == pytest.approx(99.01)
+    assert percentiles.loc["total", "p95"] == 2.0
+    assert percentiles.loc["rerank", "count"] == 0
@@ -0,0 +1,108 @@
+import os
+import sys
+
+import pytest
+from fastapi.testclient import TestClient
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from src.metrics import (
+    HTTP_REQUESTS,
+    STAGE_DURATION,
+    STAGE_ERRORS,
+    Counter,
+    Histogram,
+    collect_interaction_stats,
+    doc_retrieval_type_var,
+    endpoint_var,
+    observe_stage,
+    record_cache_hit,
+    record_llm_call,
+)
+from src.web.api import app
+
+
+def test_histogram_renders_cumulative_buckets() -> None:
+    histogram = Histogram("test_seconds", "test", ["stage"], buckets=[0.1, 1.0], registry=None)
+
+    for value in (0.05, 0.1, 0.5, 3.0):
+        histogram.observe(value, stage="generation")
+
+    assert histogram.render() == [
+        "# HELP test_seconds test",
+        "# TYPE test_seconds histogram",
+        'test_seconds_bucket{stage="generation",le="0.1"} 2',
+        'test_seconds_bucket{stage="generation",le="1.0"} 3',
+        'test_seconds_bucket{stage="generation",le="+Inf"} 4',
+        'test_seconds_sum{stage="generation"} 3.65',
+        'test_seconds_count{stage="generation"} 4',
+    ]
+
+
+def test_counter_escapes_label_values() -> None:
+    counter = Counter("test_total", "test", ["endpoint"], registry=None)
+
+    counter.inc(endpoint='/a"b')
+
+    assert counter.render()[-1] == 'test_total{endpoint="/a\\"b"} 1.0'
+
+
+def test_metrics_are_registered_on_creation() -> None:
+    registry: list = []
+    counter = Counter("test_registered_total", "test", registry=registry)
+
+    assert registry == [counter]
+    with pytest.raises(ValueError, match="Duplicated"):
+        Counter("test_registered_total", "test", registry=registry)
+
+
+def test_observe_stage_uses_context_labels() -> None:
+    endpoint_var.set("/metrics_test")
+    doc_retrieval_type_var.set("multi")
+
+    with pytest.raises(RuntimeError), observe_stage("rerank"):
+        raise RuntimeError("upstream error")
+
+    assert STAGE_ERRORS.value(stage="rerank", endpoint="/metrics_test", doc_retrieval_type="multi") == 1
+    assert any(line.startswith('aituber_stage_duration_seconds_count{stage="rerank",endpoint="/metrics_test",doc_retrieval_type="multi"} 1') for line in STAGE_DURATION.render())
+
+
+def test_interaction_stats_collects_breakdown() -> None:
+    with collect_interaction_stats() as stats:
+        for stage in ("embedding", "faiss", "generation"):
+            with observe_stage(stage):
+                pass
+        record_llm_call(lane="reply", prompt_chars=400, prompt_tokens=100, response_tokens=20)
+        record_llm_call(lane="verification", prompt_chars=200, prompt_tokens=50, response_tokens=5)
+        record_cache_hit("bm25_index", True)
+
+    breakdown = stats.breakdown()
+    assert breakdown["retrieval"] == stats.stage_durations["embedding"] + stats.stage_durations["faiss"]
+    assert breakdown["generation"] == stats.stage_durations["generation"]
+    assert breakdown["rerank"] == 0.0
+    assert (stats.prompt_tokens, stats.response_tokens) == (150, 25)
+    assert stats.cache_hits == {"bm25_index": True}
+
+
+def test_nested_interaction_stats_are_recorded_to_parent() -> None:
+    with collect_interaction_stats() as request_stats, collect_interaction_stats() as interaction_stats:
+        with observe_stage("generation"):
+            pass
+        record_llm_call(lane="reply", prompt_chars=400, prompt_tokens=100, response_tokens=20)
+
+    assert interaction_stats.parent is request_stats
+    assert request_stats.parent is None
+    assert request_stats.stage_durations == interaction_stats.stage_durations
+    assert request_stats.llm_calls == [{"lane": "reply", "prompt_chars": 400, "prompt_tokens": 100, "response_tokens": 20}]
+
+
+def test_http_requests_are_labelled_by_route() -> None:
+    client = TestClient(app)
+    before_route = HTTP_REQUESTS.value(endpoint="/voice/presynthesized/{audio_id}", method="GET", status="404")
+    before_other = HTTP_REQUESTS.value(endpoint="other", method="GET", status="404")
+
+    client.get(f"/voice/presynthesized/{'0' * 64}")
+    client.get("/no_such_path")
+
+    # パスパラメータを含むルートはルートのパスでまとめ、未定義のパスは other にする
+    assert HTTP_REQUESTS.value(endpoint="/voice/presynthesized/{audio_id}", method="GET", status="404") == before_route + 1
+    assert HTTP_REQUESTS.value(endpoint="other", method="GET", status="404") == before_other + 1
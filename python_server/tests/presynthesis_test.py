@@ -0,0 +1,72 @@
+import asyncio
+import functools
+import os
+import pathlib
+import sys
+from collections.abc import Iterator
+from unittest import mock
+
+import pytest
+from fastapi.testclient import TestClient
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from src.azure_speech_synthesizer import WAV_HEADER_SIZE, AzureSpeechSynthesizerPool
+from src.cli.benchmarks.fakes import FakeAzureSpeechSynthesizer, FakeServiceConfig
+from src.presynthesis import Presynthesizer
+from src.tts_cache import AudioCache
+from src.web.api import app
+
+FAST_SERVICES = FakeServiceConfig(azure_delay=0, seconds_per_char=0.05)
+
+
+@pytest.fixture()
+def factory(tmp_path: pathlib.Path) -> Iterator[mock.Mock]:
+    factory = mock.Mock(wraps=functools.partial(FakeAzureSpeechSynthesizer, FAST_SERVICES))
+    with (
+        mock.patch("src.text_to_speech.tts_cache", AudioCache(tmp_path, max_bytes=10**8)),
+        mock.patch("src.text_to_speech.azure_synthesizer_pool", AzureSpeechSynthesizerPool(factory=factory, max_idle_per_voice=0)),
+    ):
+        yield factory
+
+
+def test_presynthesizes_each_text_and_voice(factory: mock.Mock) -> None:
+    presynthesizer = Presynthesizer(["こんにちは", "こんにちは", "", "さようなら"], ["male", "azure"])
+    asyncio.run(presynthesizer.run())
+
+    assert presynthesizer.snapshot() == {"ready": 4, "total": 4}
+    assert factory.call_count == 4
+    assert presynthesizer.audio_ids("こんにちは") == {"male": Presynthesizer.audio_id("male", "こんにちは"), "azure": Presynthesizer.audio_id("azure", "こんにちは")}
+    assert presynthesizer.lookup(Presynthesizer.audio_id("male", "さようなら")) == ("male", "さようなら")
+
+    # 次回の起動ではキャッシュから読むので合成しない
+    restarted = Presynthesizer(["こんにちは", "さようなら"], ["male", "azure"])
+    asyncio.run(restarted.run())
+    assert restarted.snapshot() == {"ready": 4, "total": 4}
+    assert factory.call_count == 4
+
+
+def test_failed_synthesis_is_not_ready(factory: mock.Mock) -> None:
+    factory.side_effect = RuntimeError("Azure is down")
+    presynthesizer = Presynthesizer(["こんにちは"], ["male"])
+    asyncio.run(presynthesizer.run())
+
+    assert presynthesizer.snapshot() == {"ready": 0, "total": 1}
+    assert presynthesizer.audio_ids("こんにちは") == {}
+
+
+def test_template_message_returns_audio_id(factory: mock.Mock) -> None:
+    presynthesizer = Presynthesizer(["テンプレートです"], ["male"])
+    asyncio.run(presynthesizer.run())
+    client = TestClient(app)
+    with mock.patch("src.web.api.presynthesizer", presynthesizer), mock.patch("src.web.api.TEMPLATE_MESSAGES", ["テンプレートです"]):
+        message = client.get("/template_message").json()
+        audio = client.get(f"/voice/presynthesized/{message['audio_ids']['male']}")
+        unknown = client.get(f"/voice/presynthesized/{'0' * 64}")
+
+    assert message["message"] == "テンプレートです"
+    assert audio.status_code == 200
+    assert audio.content[:4] == b"RIFF"
+    assert len(audio.content) > WAV_HEADER_SIZE
+    # 合成済みの音声を返す
+    assert factory.call_count == 1
+    assert unknown.status_code == 404
@@ -0,0 +1,67 @@
+import os
+import sys
+import threading
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from src.profiler import ProfileStore, SamplingProfiler
+
+
+def _busy_loop(stop_event: threading.Event) -> None:
+    while not stop_event.is_set():
+        sum(range(1000))
+
+
+def test_sampling_profiler_outputs_collapsed_stacks() -> None:
+    stop_event = threading.Event()
+    worker = threading.Thread(target=_busy_loop, args=(stop_event,), name="busy-worker")
+    worker.start()
+
+    profiler = SamplingProfiler(interval=0.001)
+    profiler.start()
+    time.sleep(0.1)
+    profiler.stop()
+    stop_event.set()
+    worker.join()
+
+    lines = profiler.collapsed().splitlines()
+    assert profiler.samples > 0
+    busy_lines = [line for line in lines if line.startswith("busy-worker;")]
+    assert busy_lines
+    stack, count = busy_lines[0].rsplit(" ", 1)
+    assert "_busy_loop (" in stack.split(";")[-1]
+    assert int(count) > 0
+    assert not any("sampling-profiler" in line for line in lines)
+
+
+def test_sampling_profiler_samples_only_given_threads() -> None:
+    stop_event = threading.Event()
+    worker = threading.Thread(target=_busy_loop, args=(stop_event,), name="busy-worker")
+    worker.start()
+
+    profiler = SamplingProfiler(interval=0.001, thread_ids={threading.get_ident()})
+    profiler.start()
+    _busy_loop_for(0.1)
+    profiler.stop()
+    stop_event.set()
+    worker.join()
+
+    lines = profiler.collapsed().splitlines()
+    assert lines
+    assert all(line.startswith("MainThread;") for line in lines)
+
+
+def _busy_loop_for(seconds: float) -> None:
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        sum(range(1000))
+
+
+def test_profile_store_keeps_recent_profiles() -> None:
+    store = ProfileStore(max_profiles=2)
+
+    for trace_id in ("a", "b", "c"):
+        store.put(trace_id, f"{trace_id} 1\n")
+
+    assert store.get("a") is None
+    assert store.get("c") == "c 1\n"
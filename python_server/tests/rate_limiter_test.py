@@ -0,0 +1,71 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from src.rate_limiter import GeminiLane, PriorityRateLimiter, RateLimitExceeded
+
+
+async def test_acquire_within_burst_does_not_wait() -> None:
+    limiter = PriorityRateLimiter(rate_per_sec=0.001, burst=3, max_queue_depth=10)
+
+    for _ in range(3):
+        async with limiter.acquire(GeminiLane.background):
+            pass
+
+    assert limiter.queue_depth() == {"reply": 0, "verification": 0, "background": 0}
+
+
+async def test_higher_lane_is_served_first() -> None:
+    limiter = PriorityRateLimiter(rate_per_sec=50, burst=1, max_queue_depth=10)
+    order: list[str] = []
+
+    async def call(lane: GeminiLane) -> None:
+        async with limiter.acquire(lane):
+            order.append(lane.name)
+
+    # バーストを使い切ってから待ち行列を作る
+    async with limiter.acquire(GeminiLane.reply):
+        pass
+    tasks = [asyncio.create_task(call(lane)) for lane in (GeminiLane.background, GeminiLane.verification, GeminiLane.reply)]
+    await asyncio.sleep(0)
+    assert limiter.queue_depth() == {"reply": 1, "verification": 1, "background": 1}
+
+    await asyncio.gather(*tasks)
+
+    assert order == ["reply", "verification", "background"]
+
+
+async def test_lowest_lane_is_shed_first() -> None:
+    limiter = PriorityRateLimiter(rate_per_sec=50, burst=1, max_queue_depth=2)
+
+    async def call(lane: GeminiLane) -> None:
+        async with limiter.acquire(lane):
+            pass
+
+    async with limiter.acquire(GeminiLane.reply):
+        pass
+    background = asyncio.create_task(call(GeminiLane.background))
+    await asyncio.sleep(0)
+    verification = asyncio.create_task(call(GeminiLane.verification))
+    reply = asyncio.create_task(call(GeminiLane.reply))
+
+    with pytest.raises(RateLimitExceeded):
+        await background
+    await asyncio.gather(verification, reply)
+
+    assert limiter.snapshot()["shed"] == {"reply": 0, "verification": 0, "background": 1}
+
+
+async def test_reply_lane_is_never_shed() -> None:
+    limiter = PriorityRateLimiter(rate_per_sec=100, burst=1, max_queue_depth=0)
+
+    async def call() -> None:
+        async with limiter.acquire(GeminiLane.reply):
+            pass
+
+    await asyncio.gather(*(call() for _ in range(3)))
+
+    assert limiter.snapshot()["shed"]["reply"] == 0
@@ -0,0 +1,22 @@
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from src.reading import convert_kanji_to_hiragana, get_tokenizer
+
+
+def test_convert_kanji_to_hiragana() -> None:
+    assert convert_kanji_to_hiragana("東京都の政策") == "とうきょうとのせいさく"
+
+
+def test_keeps_kana_and_symbols() -> None:
+    assert convert_kanji_to_hiragana("テストです！123") == "テストです！123"
+
+
+def test_pronunciation_overrides() -> None:
+    assert convert_kanji_to_hiragana("安野たかひろです") == "あんのたかひろです"
+    assert convert_kanji_to_hiragana("私は安野です。安野の政策") == "わたしはあんのです。あんののせいさく"
+
+
+def test_tokenizer_is_shared() -> None:
+    assert get_tokenizer() is get_tokenizer()
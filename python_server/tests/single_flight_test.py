@@ -0,0 +1,193 @@
+import asyncio
+import functools
+import os
+import pathlib
+import sys
+from collections.abc import AsyncIterator
+from unittest import mock
+
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from src.azure_speech_synthesizer import WAV_HEADER_SIZE, AzureSpeechSynthesizerPool
+from src.cli.benchmarks.fakes import FakeAzureSpeechSynthesizer, FakeServiceConfig
+from src.single_flight import SINGLE_FLIGHT_REQUESTS, SharedStream, SingleFlight
+from src.tts_cache import AudioCache
+from src.web.api import app
+
+
+def test_do_shares_in_flight_call() -> None:
+    flight = SingleFlight("test_do")
+    calls = 0
+
+    async def compute() -> str:
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.05)
+        return "result"
+
+    async def run():
+        results = await asyncio.gather(*(flight.do("key", compute) for _ in range(3)))
+        # 終わった後は新しく実行する
+        results.append(await flight.do("key", compute))
+        return results
+
+    assert asyncio.run(run()) == ["result"] * 4
+    assert calls == 2
+    assert SINGLE_FLIGHT_REQUESTS.value(name="test_do", role="leader") == 2
+    assert SINGLE_FLIGHT_REQUESTS.value(name="test_do", role="follower") == 2
+    snapshot = flight.snapshot()
+    assert (snapshot["in_flight"], snapshot["leaders"], snapshot["followers"]) == (0, 2, 2)
+    assert snapshot["saved_seconds"] > 0
+
+
+def test_single_flight_counters_are_exported() -> None:
+    flight = SingleFlight("test_metrics")
+
+    async def compute() -> str:
+        await asyncio.sleep(0.01)
+        return "result"
+
+    async def run():
+        return await asyncio.gather(flight.do("key", compute), flight.do("key", compute))
+
+    asyncio.run(run())
+    metrics = TestClient(app).get("/metrics").text.splitlines()
+
+    assert 'aituber_single_flight_requests_total{name="test_metrics",role="leader"} 1.0' in metrics
+    assert 'aituber_single_flight_requests_total{name="test_metrics",role="follower"} 1.0' in metrics
+    assert any(line.startswith('aituber_single_flight_saved_seconds_total{name="test_metrics"} ') for line in metrics)
+
+
+def test_do_shares_exception() -> None:
+    flight = SingleFlight("test_error")
+
+    async def compute() -> str:
+        await asyncio.sleep(0.01)
+        raise RuntimeError("upstream failed")
+
+    async def run():
+        return await asyncio.gather(flight.do("key", compute), flight.do("key", compute), return_exceptions=True)
+
+    results = asyncio.run(run())
+    assert [type(result) for result in results] == [RuntimeError, RuntimeError]
+
+
+def test_cancelled_leader_does_not_cancel_followers() -> None:
+    flight = SingleFlight("test_cancel")
+
+    async def compute() -> str:
+        await asyncio.sleep(0.05)
+        return "result"
+
+    async def run():
+        leader = asyncio.create_task(flight.do("key", compute))
+        await asyncio.sleep(0)
+        follower = asyncio.create_task(flight.do("key", compute))
+        await asyncio.sleep(0)
+        leader.cancel()
+        return await follower
+
+    assert asyncio.run(run()) == "result"
+
+
+def test_stream_replays_chunks_to_late_subscriber() -> None:
+    flight = SingleFlight("test_stream")
+    opened = 0
+
+    async def chunks() -> AsyncIterator[bytes]:
+        nonlocal opened
+        opened += 1
+        for chunk in (b"a", b"b", b"c"):
+            await asyncio.sleep(0.01)
+            yield chunk
+
+    async def collect(key: str) -> bytes:
+        return b"".join([chunk async for chunk in flight.stream(key, chunks).subscribe()])
+
+    async def run():
+        first = asyncio.create_task(collect("key"))
+        # 途中から読み始めても最初から返す
+        await asyncio.sleep(0.015)
+        return await asyncio.gather(first, collect("key"))
+
+    assert asyncio.run(run()) == [b"abc", b"abc"]
+    assert opened == 1
+
+
+def test_cancelled_stream_is_not_cut_off_silently() -> None:
+    async def chunks() -> AsyncIterator[bytes]:
+        yield b"a"
+        await asyncio.sleep(10)
+        yield b"b"
+
+    async def run():
+        shared = SharedStream(chunks(), max_replay_bytes=100)
+        subscriber = shared.subscribe()
+        assert await anext(subscriber) == b"a"
+        shared._task.cancel()
+        await anext(subscriber)
+
+    with pytest.raises(RuntimeError, match="cancelled"):
+        asyncio.run(run())
+
+
+def test_stream_keeps_chunks_only_while_joinable() -> None:
+    flight = SingleFlight("test_replay_limit", max_replay_bytes=20)
+    opened = 0
+
+    async def run():
+        proceed = asyncio.Event()
+
+        async def chunks() -> AsyncIterator[bytes]:
+            nonlocal opened
+            opened += 1
+            yield b"x" * 10
+            await proceed.wait()
+            for _ in range(5):
+                yield b"x" * 10
+
+        first = flight.stream("key", chunks)
+        subscriber = first.subscribe()
+        assert await anext(subscriber) == b"x" * 10
+        # 上限までは後から来ても共有する
+        assert flight.stream("key", chunks) is first
+        late = first.subscribe()
+        proceed.set()
+        await asyncio.sleep(0.01)
+        # 上限を超えた後に来たリクエストは新しく開き、全ての読み手が読んだチャンクは捨てる
+        assert not first.joinable
+        assert flight.stream("key", chunks) is not first
+        assert await anext(late) == b"x" * 10
+        await late.aclose()
+        assert len(first._chunks) == 5
+        return [chunk async for chunk in subscriber]
+
+    assert asyncio.run(run()) == [b"x" * 10] * 5
+    assert opened == 2
+
+
+def test_concurrent_voice_requests_synthesize_once(tmp_path: pathlib.Path) -> None:
+    factory = mock.Mock(wraps=functools.partial(FakeAzureSpeechSynthesizer, FakeServiceConfig(azure_delay=0.05, seconds_per_char=0.05)))
+
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+            return await asyncio.gather(
+                client.post("/voice/azure", params={"text": "こんにちは"}),
+                client.post("/voice/azure", params={"text": "こんにちは", "stream": "1"}),
+                # 正規化すると同じテキスト
+                client.post("/voice/azure", params={"text": "こんにちは "}),
+            )
+
+    with (
+        mock.patch("src.text_to_speech.tts_cache", AudioCache(tmp_path, max_bytes=10**8)),
+        mock.patch("src.text_to_speech.azure_synthesizer_pool", AzureSpeechSynthesizerPool(factory=factory, max_idle_per_voice=0)),
+    ):
+        responses = asyncio.run(run())
+
+    assert [response.status_code for response in responses] == [200, 200, 200]
+    assert len(responses[0].content) > WAV_HEADER_SIZE
+    assert responses[0].content[WAV_HEADER_SIZE:] == responses[2].content[WAV_HEADER_SIZE:]
+    assert factory.call_count == 1
@@ -0,0 +1,365 @@
+import asyncio
+import functools
+import os
+import pathlib
+import struct
+import sys
+import time
+from collections.abc import AsyncIterator, Iterator
+from unittest import mock
+
+import numpy as np
+import pytest
+from fastapi.testclient import TestClient
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from src.azure_speech_synthesizer import WAV_HEADER_SIZE, AzureSpeechSynthesizerPool
+from src.circuit_breaker import CircuitBreaker
+from src.cli.benchmarks.fakes import FakeAzureSpeechSynthesizer, FakeElevenLabs, FakeServiceConfig
+from src.config import settings
+from src.text_to_speech import AudioPostProcessor, StreamInterruptedError, TextToSpeech, split_sentences
+from src.tts_cache import AudioCache
+from src.web.api import app
+
+FAST_SERVICES = FakeServiceConfig(elevenlabs_first_chunk_delay=0, elevenlabs_chunk_delay=0, azure_delay=0, seconds_per_char=0.05)
+# 0.5秒の 440Hz の正弦波
+TONE = (np.sin(np.arange(22050) * 2 * np.pi * 440 / 44100) * 3000).astype("<i2").tobytes()
+
+
+@pytest.fixture()
+def cache(tmp_path: pathlib.Path) -> Iterator[AudioCache]:
+    cache = AudioCache(tmp_path, max_bytes=10**8)
+    with (
+        mock.patch("src.text_to_speech.tts_cache", cache),
+        mock.patch("src.text_to_speech.client", FakeElevenLabs(FAST_SERVICES)),
+        mock.patch("src.text_to_speech.azure_synthesizer_pool", AzureSpeechSynthesizerPool(factory=functools.partial(FakeAzureSpeechSynthesizer, FAST_SERVICES))),
+        # 失敗させるテストで、後のテストのブレーカーが開かないようにする
+        mock.patch("src.text_to_speech.elevenlabs_breaker", CircuitBreaker("elevenlabs", slow_call_seconds=10.0)),
+    ):
+        yield cache
+
+
+async def _collect(chunks: AsyncIterator[bytes]) -> list[bytes]:
+    return [chunk async for chunk in chunks]
+
+
+def test_streaming_response(cache: AudioCache) -> None:
+    client = TestClient(app)
+    buffered = client.post("/voice", params={"text": "こんにちは"}).content
+    streamed = client.post("/voice", params={"text": "こんにちは", "stream": "1"}).content
+
+    assert streamed[:4] == b"RIFF"
+    # 長さが分からないので、長さの欄は最大値にする
+    assert struct.unpack("<I", streamed[4:8])[0] == 0xFFFFFFFF
+    assert streamed[WAV_HEADER_SIZE:] == buffered[WAV_HEADER_SIZE:]
+
+
+def test_pcm_chunks_arrive_incrementally(cache: AudioCache) -> None:
+    chunks = asyncio.run(_collect(TextToSpeech().text_to_speech_pcm_chunks("ストリーミングのテストです")))
+    assert len(chunks) > 1
+
+    # 最後まで受け取れた音声はキャッシュされる
+    cached = asyncio.run(_collect(TextToSpeech().text_to_speech_pcm_chunks("ストリーミングのテストです")))
+    assert cached == [b"".join(chunks)]
+
+
+def test_falls_back_before_first_chunk(cache: AudioCache) -> None:
+    broken_client = mock.Mock()
+    broken_client.text_to_speech.convert_as_stream.side_effect = RuntimeError("ElevenLabs is down")
+    with mock.patch("src.text_to_speech.client", broken_client):
+        chunks = asyncio.run(_collect(TextToSpeech().text_to_speech_pcm_chunks("こんにちは")))
+
+    assert b"".join(chunks) == asyncio.run(TextToSpeech().azure_text_to_speech("こんにちは", voice_name="ja-JP-KeitaNeural"))[WAV_HEADER_SIZE:]
+
+
+def _interrupted_client() -> mock.Mock:
+    async def interrupted_stream(**kwargs) -> AsyncIterator[bytes]:
+        yield TONE
+        raise RuntimeError("connection reset")
+
+    broken_client = mock.Mock()
+    broken_client.text_to_speech.convert_as_stream = interrupted_stream
+    return broken_client
+
+
+def test_interrupted_stream_is_not_cached(cache: AudioCache, tmp_path: pathlib.Path) -> None:
+    chunks = []
+
+    async def collect() -> None:
+        async for chunk in TextToSpeech().text_to_speech_pcm_chunks("こんにちは"):
+            chunks.append(chunk)
+
+    with mock.patch("src.text_to_speech.client", _interrupted_client()), pytest.raises(StreamInterruptedError):
+        asyncio.run(collect())
+
+    # 返した分はそのままにして打ち切る(Azure の音声を続けない)
+    assert 0 < len(b"".join(chunks)) <= len(TONE)
+    assert not list(tmp_path.glob("*/*.wav"))
+
+
+def test_interrupted_stream_falls_back_when_buffered(cache: AudioCache) -> None:
+    client = TestClient(app)
+    with mock.patch("src.text_to_speech.client", _interrupted_client()):
+        buffered = client.post("/voice", params={"text": "こんにちは"})
+        streamed = client.post("/voice", params={"text": "こんにちは", "stream": "1"})
+        hedged = client.post("/voice", params={"text": "こんにちは", "hedge": "1"})
+
+    # まとめて返す場合は、途中までの音声を捨てて Azure TTS で最初から合成し直す
+    azure = asyncio.run(TextToSpeech().azure_text_to_speech("こんにちは", voice_name="ja-JP-KeitaNeural"))
+    assert buffered.status_code == 200
+    assert buffered.content[WAV_HEADER_SIZE:] == azure[WAV_HEADER_SIZE:]
+    assert buffered.headers["X-TTS-Provider"] == "azure"
+    # ヘッジで ElevenLabs が選ばれた後に途切れた場合も、合成し直した Azure TTS を返す
+    assert hedged.content[WAV_HEADER_SIZE:] == azure[WAV_HEADER_SIZE:]
+    assert hedged.headers["X-TTS-Provider"] == "azure"
+    assert any(line.startswith('aituber_tts_provider_selections_total{provider="azure",hedged="false"} ') for line in client.get("/metrics").text.splitlines())
+    # 返しながら合成する場合は、返した音声までで終える
+    assert streamed.status_code == 200
+    assert 0 < len(streamed.content) - WAV_HEADER_SIZE <= len(TONE)
+
+
+def test_split_sentences() -> None:
+    assert split_sentences("こんにちは。元気ですか？「はい！」と答えた\n最後") == ["こんにちは。", "元気ですか？", "「はい！」", "と答えた", "最後"]
+    assert split_sentences("句点なし") == ["句点なし"]
+    assert split_sentences("") == []
+
+
+def test_sentence_parallel_keeps_order() -> None:
+    running = 0
+    max_running = 0
+    started = []
+
+    async def synthesize(sentence: str) -> AsyncIterator[bytes]:
+        nonlocal running, max_running
+        started.append(sentence)
+        running += 1
+        max_running = max(max_running, running)
+        # 後ろの文ほど早く終わるようにする
+        await asyncio.sleep(0.05 / len(started))
+        running -= 1
+        yield sentence.encode()
+
+    text_to_speech = TextToSpeech()
+    chunks = asyncio.run(_collect(text_to_speech.sentence_parallel_pcm_chunks("一。二。三。四。", synthesize, concurrency=2, silence_seconds=0.001)))
+
+    silence = bytes(int(44100 * 0.001) * 2)
+    assert chunks == ["一。".encode(), silence, "二。".encode(), silence, "三。".encode(), silence, "四。".encode()]
+    assert started == ["一。", "二。", "三。", "四。"]
+    assert max_running == 2
+
+
+def test_voice_split_sentences(cache: AudioCache) -> None:
+    client = TestClient(app)
+    response = client.post("/voice/azure", params={"text": "一つ目の文です。二つ目の文です。", "split": "1"})
+    whole = asyncio.run(TextToSpeech().azure_text_to_speech("一つ目の文です。"))
+
+    assert response.status_code == 200
+    assert response.content[WAV_HEADER_SIZE:].startswith(whole[WAV_HEADER_SIZE:])
+    # 2文と、その間の無音
+    assert len(response.content) > 2 * len(whole)
+
+
+def test_synthesizer_pool_reuses_synthesizers() -> None:
+    pool = AzureSpeechSynthesizerPool(factory=functools.partial(FakeAzureSpeechSynthesizer, FAST_SERVICES))
+    with pool.acquire(voice_name="ja-JP-NanamiNeural") as first, pool.acquire(voice_name="ja-JP-NanamiNeural") as second:
+        # 貸し出し中のものは他に貸さない
+        assert first is not second
+    assert pool.idle_count(voice_name="ja-JP-NanamiNeural") == 2
+
+    with pool.acquire(voice_name="ja-JP-NanamiNeural") as third:
+        assert third in (first, second)
+
+    # 例外で返されたものは捨てる
+    with pytest.raises(RuntimeError), pool.acquire(voice_name="ja-JP-NanamiNeural"):
+        raise RuntimeError("synthesis failed")
+    assert pool.idle_count(voice_name="ja-JP-NanamiNeural") == 1
+
+
+def test_azure_synthesis_does_not_block_event_loop() -> None:
+    config = FakeServiceConfig(azure_delay=0.2, seconds_per_char=0.01)
+    pool = AzureSpeechSynthesizerPool(factory=functools.partial(FakeAzureSpeechSynthesizer, config))
+
+    async def synthesize_concurrently() -> float:
+        text_to_speech = TextToSpeech()
+        started_at = time.perf_counter()
+        await asyncio.gather(*(text_to_speech.azure_text_to_speech(f"並列{i}") for i in range(3)))
+        return time.perf_counter() - started_at
+
+    with mock.patch("src.text_to_speech.azure_synthesizer_pool", pool), mock.patch("src.text_to_speech.tts_cache", AudioCache(pathlib.Path(), max_bytes=0)):
+        elapsed = asyncio.run(synthesize_concurrently())
+
+    assert elapsed < 0.5
+
+
+def test_azure_pcm_chunks_arrive_incrementally(cache: AudioCache) -> None:
+    chunks = asyncio.run(_collect(TextToSpeech().azure_text_to_speech_pcm_chunks("Azure のストリーミングのテストです")))
+    assert len(chunks) > 1
+
+    cached = asyncio.run(_collect(TextToSpeech().azure_text_to_speech_pcm_chunks("Azure のストリーミングのテストです")))
+    assert cached == [b"".join(chunks)]
+
+
+def test_azure_canceled_synthesis_is_not_cached(tmp_path: pathlib.Path) -> None:
+    class CanceledSynthesizer(FakeAzureSpeechSynthesizer):
+        def speech_synthesis_chunks(self, text: str, *, chunk_size: int = 4096) -> Iterator[bytes]:
+            yield b"\x01\x00" * 10
+            raise RuntimeError("Speech synthesis canceled")
+
+    pool = AzureSpeechSynthesizerPool(factory=functools.partial(CanceledSynthesizer, FAST_SERVICES))
+    with mock.patch("src.text_to_speech.azure_synthesizer_pool", pool), mock.patch("src.text_to_speech.tts_cache", AudioCache(tmp_path, max_bytes=10**8)):
+        with pytest.raises(RuntimeError):
+            asyncio.run(TextToSpeech().azure_text_to_speech("こんにちは"))
+
+    assert not list(tmp_path.glob("*/*.wav"))
+    assert pool.idle_count(voice_name="ja-JP-NanamiNeural", rate="+10%") == 0
+
+
+def test_pipelined_azure_to_sts() -> None:
+    config = FakeServiceConfig(azure_delay=0.2, elevenlabs_first_chunk_delay=0.2, elevenlabs_chunk_delay=0, seconds_per_char=0.01)
+    pool = AzureSpeechSynthesizerPool(factory=functools.partial(FakeAzureSpeechSynthesizer, config))
+
+    async def first_chunk_and_total() -> tuple[float, float]:
+        text_to_speech = TextToSpeech()
+        started_at = time.perf_counter()
+        first_chunk_at = None
+        chunks = text_to_speech.sentence_parallel_pcm_chunks("一つ目。二つ目。三つ目。", text_to_speech.text_to_speech_with_azure_tts_pcm_chunks, concurrency=3)
+        async for _ in chunks:
+            first_chunk_at = first_chunk_at or time.perf_counter()
+        return first_chunk_at - started_at, time.perf_counter() - started_at
+
+    with (
+        mock.patch("src.text_to_speech.azure_synthesizer_pool", pool),
+        mock.patch("src.text_to_speech.client", FakeElevenLabs(config)),
+        mock.patch("src.text_to_speech.tts_cache", AudioCache(pathlib.Path(), max_bytes=0)),
+    ):
+        first_chunk, total = asyncio.run(first_chunk_and_total())
+
+    # 1文あたり Azure TTS 0.2秒 + STS 0.2秒。文を順に処理すると 1.2秒かかる
+    assert first_chunk < 0.6
+    assert total < 0.8
+
+
+def _post_process(pcm: bytes, chunk_size: int, **kwargs) -> bytes:
+    processor = AudioPostProcessor(sample_rate=44100, **kwargs)
+    output = [processor.process(pcm[start : start + chunk_size]) for start in range(0, len(pcm), chunk_size)]
+    return b"".join([*output, processor.flush()])
+
+
+def _rms_dbfs(pcm: bytes) -> float:
+    samples = np.frombuffer(pcm, dtype="<i2").astype(np.float64)
+    return 20 * np.log10(np.sqrt(np.mean(samples**2)) / 32768)
+
+
+def test_post_processor_trims_silence() -> None:
+    silence = bytes(44100 * 2)
+    output = _post_process(silence + TONE + silence, 4096, target_rms_dbfs=-20.0)
+
+    # 前後に 50ms ずつの無音を残す
+    assert len(output) == len(TONE) + 2 * 2205 * 2
+    assert not any(output[: 2205 * 2])
+    assert not any(output[-2205 * 2 :])
+
+
+def test_post_processor_is_independent_of_chunk_boundaries() -> None:
+    pcm = bytes(10000) + TONE + bytes(30000) + TONE + bytes(20000)
+    expected = _post_process(pcm, len(pcm))
+    for chunk_size in [1, 999, 4096, 88200]:
+        assert _post_process(pcm, chunk_size) == expected
+
+
+def test_post_processor_normalizes_loudness() -> None:
+    tone = np.frombuffer(TONE, dtype="<i2")
+    quiet = (tone // 2).astype("<i2").tobytes()
+    loud = (tone * 4).astype("<i2").tobytes()
+
+    assert abs(_rms_dbfs(_post_process(quiet, 4096)) - -20.0) < 0.5
+    assert abs(_rms_dbfs(_post_process(loud, 4096)) - -20.0) < 0.5
+
+
+def test_post_processor_does_not_clip() -> None:
+    # ピークが大きく RMS が小さい音は、音割れしない範囲までしか上げない
+    pcm = np.zeros(44100, dtype="<i2")
+    pcm[::441] = 20000
+    pcm[1::2] += 200
+    output = np.frombuffer(_post_process(pcm.tobytes(), 4096), dtype="<i2")
+    assert np.abs(output.astype(np.int32)).max() <= 32767
+    assert np.abs(output.astype(np.int32)).max() >= 20000
+
+
+def test_post_processor_lowers_gain_for_later_peak() -> None:
+    # 最初の 0.3秒は小さな声なのでゲインを上げるが、後から来た大きな声は音割れしないように下げる
+    tone = np.frombuffer(TONE, dtype="<i2").astype(np.int32)
+    pcm = np.concatenate([tone // 3, tone * 6]).astype("<i2")
+    output = np.frombuffer(_post_process(pcm.tobytes(), 4096), dtype="<i2").astype(np.float64)
+
+    loud_input = pcm[len(tone) :].astype(np.float64)
+    loud_output = output[len(tone) :]
+    assert len(output) == len(pcm)
+    # 波形の形を保ったまま(クリップせずに)音量だけ変わる
+    mask = np.abs(loud_input) > 1000
+    ratios = loud_output[mask] / loud_input[mask]
+    assert ratios.max() - ratios.min() < 0.01
+    assert np.abs(loud_output).max() <= 32767
+    assert _post_process(pcm.tobytes(), 999) == _post_process(pcm.tobytes(), len(pcm) * 2)
+
+
+def test_post_processor_disabled() -> None:
+    pcm = bytes(1000) + TONE
+    assert _post_process(pcm, 777, enabled=False) == pcm
+    assert _post_process(bytes(10000), 4096) == b""
+
+
+@pytest.fixture()
+def _hedge_after_100ms() -> Iterator[None]:
+    with mock.patch.object(settings, "TTS_HEDGE_MIN_SECONDS", 0.1), mock.patch.object(settings, "TTS_HEDGE_MAX_SECONDS", 0.1):
+        yield
+
+
+@pytest.mark.usefixtures("_hedge_after_100ms")
+def test_hedge_uses_faster_provider(cache: AudioCache) -> None:
+    slow_elevenlabs = FakeElevenLabs(FakeServiceConfig(elevenlabs_first_chunk_delay=1.0, elevenlabs_chunk_delay=0, seconds_per_char=0.05))
+    text_to_speech = TextToSpeech()
+    started_at = time.perf_counter()
+    with mock.patch("src.text_to_speech.client", slow_elevenlabs):
+        chunks = asyncio.run(_collect(text_to_speech.hedged_pcm_chunks("ヘッジのテストです")))
+
+    assert time.perf_counter() - started_at < 1.0
+    assert text_to_speech.providers == ["azure"]
+    assert b"".join(chunks) == asyncio.run(TextToSpeech().azure_text_to_speech("ヘッジのテストです", voice_name="ja-JP-KeitaNeural"))[WAV_HEADER_SIZE:]
+
+
+@pytest.mark.usefixtures("_hedge_after_100ms")
+def test_hedge_keeps_fast_primary(cache: AudioCache) -> None:
+    factory = mock.Mock(wraps=functools.partial(FakeAzureSpeechSynthesizer, FAST_SERVICES))
+    text_to_speech = TextToSpeech()
+    with mock.patch("src.text_to_speech.azure_synthesizer_pool", AzureSpeechSynthesizerPool(factory=factory)):
+        chunks = asyncio.run(_collect(text_to_speech.hedged_pcm_chunks("ヘッジのテストです")))
+
+    assert chunks
+    assert text_to_speech.providers == ["elevenlabs"]
+    factory.assert_not_called()
+
+
+def test_hedge_fails_over_without_waiting(cache: AudioCache) -> None:
+    broken_client = mock.Mock()
+    broken_client.text_to_speech.convert_as_stream.side_effect = RuntimeError("ElevenLabs is down")
+    text_to_speech = TextToSpeech()
+    started_at = time.perf_counter()
+    with mock.patch("src.text_to_speech.client", broken_client), mock.patch.object(settings, "TTS_HEDGE_MIN_SECONDS", 10), mock.patch.object(settings, "TTS_HEDGE_MAX_SECONDS", 10):
+        chunks = asyncio.run(_collect(text_to_speech.hedged_pcm_chunks("こんにちは")))
+
+    assert chunks
+    assert time.perf_counter() - started_at < 5
+    assert text_to_speech.providers == ["azure"]
+
+
+def test_voice_returns_provider_header(cache: AudioCache) -> None:
+    client = TestClient(app)
+    buffered = client.post("/voice", params={"text": "こんにちは", "hedge": "1"})
+    streamed = client.post("/voice", params={"text": "こんにちは", "hedge": "1", "stream": "1"})
+    plain = client.post("/voice", params={"text": "こんにちは"})
+
+    assert buffered.headers["X-TTS-Provider"] == "elevenlabs"
+    assert streamed.headers["X-TTS-Provider"] == "elevenlabs"
+    assert streamed.content[WAV_HEADER_SIZE:] == buffered.content[WAV_HEADER_SIZE:]
+    assert "X-TTS-Provider" not in plain.headers
@@ -0,0 +1,83 @@
+import asyncio
+import json
+import os
+import pathlib
+import sys
+import threading
+from unittest import mock
+
+import pytest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from src.tracing import InMemorySpanExporter, JsonLinesFileSpanExporter, Tracer
+
+
+def test_spans_are_nested_within_a_trace() -> None:
+    exporter = InMemorySpanExporter()
+    tracer = Tracer(exporter)
+
+    async def retrieve(name: str) -> None:
+        with tracer.start_span(name):
+            await asyncio.sleep(0)
+
+    async def handle() -> str:
+        with tracer.start_span("http") as root:
+            await asyncio.gather(retrieve("faiss"), retrieve("bm25"))
+        return root.trace_id
+
+    trace_id = asyncio.run(handle())
+
+    spans = {span.name: span for span in exporter.get_trace(trace_id)}
+    assert set(spans) == {"http", "faiss", "bm25"}
+    assert spans["http"].parent_id is None
+    assert spans["faiss"].parent_id == spans["http"].span_id
+    assert spans["bm25"].parent_id == spans["http"].span_id
+    assert tracer.current_span() is None
+
+
+def test_span_records_error() -> None:
+    exporter = InMemorySpanExporter()
+    tracer = Tracer(exporter)
+
+    with pytest.raises(ValueError), tracer.start_span("generation") as span:
+        raise ValueError("boom")
+
+    [exported] = exporter.get_trace(span.trace_id)
+    assert exported.error == "ValueError('boom')"
+    assert exported.duration is not None
+
+
+def test_in_memory_exporter_keeps_recent_traces() -> None:
+    exporter = InMemorySpanExporter(max_traces=2)
+    tracer = Tracer(exporter)
+
+    trace_ids = []
+    for _ in range(3):
+        with tracer.start_span("http") as span:
+            trace_ids.append(span.trace_id)
+
+    assert exporter.get_trace(trace_ids[0]) == []
+    assert len(exporter.get_trace(trace_ids[2])) == 1
+
+
+def test_json_lines_file_exporter(tmp_path: pathlib.Path) -> None:
+    exporter = JsonLinesFileSpanExporter(tmp_path / "traces.jsonl")
+    tracer = Tracer(exporter)
+    write = exporter._write
+    writer_threads = []
+
+    def record_writer_thread(spans: list) -> None:
+        writer_threads.append(threading.current_thread().name)
+        write(spans)
+
+    with mock.patch.object(exporter, "_write", record_writer_thread):
+        with tracer.start_span("http", path="/reply"), tracer.start_span("generation"):
+            pass
+        exporter.stop()
+
+    # リクエストを処理するスレッドではなく、書き込み用のスレッドで書き込む
+    assert writer_threads
+    assert set(writer_threads) == {"trace-writer"}
+    lines = [json.loads(line) for line in (tmp_path / "traces.jsonl").read_text(encoding="utf-8").splitlines()]
+    assert [line["name"] for line in lines] == ["generation", "http"]
+    assert lines[1]["attributes"] == {"path": "/reply"}
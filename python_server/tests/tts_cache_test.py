@@ -0,0 +1,171 @@
+import asyncio
+import functools
+import os
+import pathlib
+import sys
+import threading
+from unittest import mock
+
+from fastapi.testclient import TestClient
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from src.azure_speech_synthesizer import AzureSpeechSynthesizerPool
+from src.cli.benchmarks.fakes import FakeAzureSpeechSynthesizer, FakeElevenLabs, FakeServiceConfig
+from src.text_to_speech import TextToSpeech
+from src.tts_cache import AudioCache, audio_cache_key
+from src.web.api import app
+
+FAST_SERVICES = FakeServiceConfig(elevenlabs_first_chunk_delay=0, elevenlabs_chunk_delay=0, azure_delay=0, seconds_per_char=0.01)
+
+
+def test_audio_cache_key() -> None:
+    assert audio_cache_key("こんにちは 世界", voice="a") == audio_cache_key(" こんにちは　　世界\n", voice="a")
+    assert audio_cache_key("ＡＢＣ", voice="a") == audio_cache_key("ABC", voice="a")
+    assert audio_cache_key("こんにちは", voice="a") != audio_cache_key("こんにちは", voice="b")
+    assert audio_cache_key("こんにちは", voice="a") != audio_cache_key("こんばんは", voice="a")
+
+
+def test_get_and_put(tmp_path: pathlib.Path) -> None:
+    cache = AudioCache(tmp_path, max_bytes=100)
+    assert cache.get("a" * 64) is None
+    cache.put("a" * 64, b"audio")
+    assert cache.get("a" * 64) == b"audio"
+
+    # 再起動後もディスクから読める
+    assert AudioCache(tmp_path, max_bytes=100).get("a" * 64) == b"audio"
+
+
+def test_cache_requests_are_exported(tmp_path: pathlib.Path) -> None:
+    def requests(metrics: str, result: str) -> float:
+        prefix = f'aituber_tts_cache_requests_total{{result="{result}"}} '
+        return next((float(line.removeprefix(prefix)) for line in metrics.splitlines() if line.startswith(prefix)), 0.0)
+
+    client = TestClient(app)
+    before = client.get("/metrics").text
+    cache = AudioCache(tmp_path, max_bytes=100)
+    cache.get("a" * 64)
+    cache.put("a" * 64, b"audio")
+    cache.get("a" * 64)
+    after = client.get("/metrics").text
+
+    assert requests(after, "hit") == requests(before, "hit") + 1
+    assert requests(after, "miss") == requests(before, "miss") + 1
+
+
+def test_evicts_least_recently_used(tmp_path: pathlib.Path) -> None:
+    cache = AudioCache(tmp_path, max_bytes=25)
+    cache.put("a" * 64, b"0" * 10)
+    cache.put("b" * 64, b"1" * 10)
+    cache.get("a" * 64)
+    cache.put("c" * 64, b"2" * 10)
+
+    assert cache.total_bytes == 20
+    assert cache.get("b" * 64) is None
+    assert cache.get("a" * 64) is not None
+    assert cache.get("c" * 64) is not None
+    assert len(list(tmp_path.glob("*/*.wav"))) == 2
+
+
+def test_disabled(tmp_path: pathlib.Path) -> None:
+    cache = AudioCache(tmp_path, max_bytes=0)
+    cache.put("a" * 64, b"audio")
+    assert cache.get("a" * 64) is None
+    assert not list(tmp_path.iterdir())
+
+
+def test_open_writer(tmp_path: pathlib.Path) -> None:
+    cache = AudioCache(tmp_path, max_bytes=100)
+    with cache.open_writer("a" * 64, header_size=4) as writer:
+        writer.write(b"au")
+        writer.write(memoryview(b"dio"))
+        writer.commit(b"HEAD")
+    assert cache.get("a" * 64) == b"HEADaudio"
+    assert cache.total_bytes == 9
+
+    # commit しなかったもの・入りきらないものは残さない
+    with cache.open_writer("b" * 64) as writer:
+        writer.write(b"audio")
+    with cache.open_writer("c" * 64) as writer:
+        writer.write(b"0" * 101)
+        writer.commit()
+    assert cache.get("b" * 64) is None
+    assert cache.get("c" * 64) is None
+    assert sorted(path.name for path in tmp_path.glob("*/*")) == ["a" * 64 + ".wav"]
+
+
+def test_async_access_runs_file_io_off_the_event_loop(tmp_path: pathlib.Path) -> None:
+    cache = AudioCache(tmp_path, max_bytes=100)
+    io_threads = set()
+
+    def record_thread(method):
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            io_threads.add(threading.current_thread())
+            return method(*args, **kwargs)
+
+        return wrapper
+
+    async def run():
+        async with cache.aopen_writer("a" * 64, header_size=4) as writer:
+            await writer.awrite(b"audio")
+            await writer.acommit(b"HEAD")
+        async with cache.aopen_writer("b" * 64) as writer:
+            await writer.awrite(b"discarded")
+        return await cache.aget("a" * 64), await cache.aget("b" * 64)
+
+    with (
+        mock.patch.object(AudioCache, "_load", record_thread(AudioCache._load)),
+        mock.patch.object(AudioCache, "_read", record_thread(AudioCache._read)),
+        mock.patch.object(AudioCache, "_open_temporary_file", record_thread(AudioCache._open_temporary_file)),
+    ):
+        assert asyncio.run(run()) == (b"HEADaudio", None)
+
+    assert io_threads
+    assert threading.main_thread() not in io_threads
+    assert sorted(path.name for path in tmp_path.glob("*/*")) == ["a" * 64 + ".wav"]
+
+
+def test_text_to_speech_uses_cache(tmp_path: pathlib.Path) -> None:
+    fake_client = FakeElevenLabs(FAST_SERVICES)
+    with (
+        mock.patch("src.text_to_speech.tts_cache", AudioCache(tmp_path, max_bytes=10**8)),
+        mock.patch("src.text_to_speech.client", fake_client),
+        mock.patch.object(fake_client.text_to_speech, "convert_as_stream", wraps=fake_client.text_to_speech.convert_as_stream) as convert_as_stream,
+    ):
+        first = asyncio.run(TextToSpeech().text_to_speech_stream("こんにちは"))
+        second = asyncio.run(TextToSpeech().text_to_speech_stream("こんにちは"))
+
+    assert first == second
+    assert convert_as_stream.call_count == 1
+
+
+def test_fallback_audio_is_not_cached_as_elevenlabs(tmp_path: pathlib.Path) -> None:
+    cache = AudioCache(tmp_path, max_bytes=10**8)
+    broken_client = mock.Mock()
+    broken_client.text_to_speech.convert_as_stream.side_effect = RuntimeError("ElevenLabs is down")
+    with (
+        mock.patch("src.text_to_speech.tts_cache", cache),
+        mock.patch("src.text_to_speech.client", broken_client),
+        mock.patch("src.text_to_speech.azure_synthesizer_pool", AzureSpeechSynthesizerPool(factory=functools.partial(FakeAzureSpeechSynthesizer, FAST_SERVICES))),
+    ):
+        asyncio.run(TextToSpeech().text_to_speech_stream("フォールバックのテスト"))
+
+    # Azure の音声は Azure のキーでのみ保存される
+    azure_key = audio_cache_key("フォールバックのテスト", engine="azure_tts", voice_name="ja-JP-KeitaNeural", rate="+10%", pitch="+10%", output_format="pcm_44100", postprocess=True)
+    assert [path.stem for path in tmp_path.glob("*/*.wav")] == [azure_key]
+
+
+def test_voice_returns_etag(tmp_path: pathlib.Path) -> None:
+    client = TestClient(app)
+    with (
+        mock.patch("src.text_to_speech.tts_cache", AudioCache(tmp_path, max_bytes=10**8)),
+        mock.patch("src.text_to_speech.azure_synthesizer_pool", AzureSpeechSynthesizerPool(factory=functools.partial(FakeAzureSpeechSynthesizer, FAST_SERVICES))),
+    ):
+        response = client.post("/voice/azure", params={"text": "こんにちは"})
+        assert response.status_code == 200
+        etag = response.headers["ETag"]
+
+        revalidated = client.post("/voice/azure", params={"text": "こんにちは"}, headers={"If-None-Match": etag})
+        assert revalidated.status_code == 304
+        assert revalidated.content == b""
+        assert revalidated.headers["ETag"] == etag